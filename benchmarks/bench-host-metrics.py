@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of host metrics collection: the former shell pipelines
+against the /proc readers used by opennode.cli.actions.host.metrics().
+
+Usage: bench-host-metrics.py [iterations]
+"""
+import sys
+import timeit
+
+from opennode.cli.actions import host
+from opennode.cli.actions.utils import execute
+from opennode.cli.config import get_config
+
+
+def pipeline_metrics():
+    iface = get_config().getstring('general', 'main_iface')
+    execute("head -n 1 /proc/stat")
+    execute("cat /proc/loadavg | awk '{print $1}'")
+    execute("free | tail -n 2 | head -n 1 | awk '{print $3 / 1024}'")
+    try:
+        execute("grep %s: /proc/net/dev | awk -F: '{print $2}' | awk '{print $1, $9}'" % iface)
+    except Exception:
+        pass
+    execute("df -P | grep ' /$' | head -n 1 | awk '{print $3/1024}'")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    for name, fun in (('shell pipelines', pipeline_metrics), ('/proc readers', host.metrics)):
+        total = timeit.timeit(fun, number=iterations)
+        print '%-16s %8.3f ms/call' % (name, total * 1000 / iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of reading template settings from OVF files: the former
+per-setting lookups, each rescanning VirtualHardwareSection through
+Ovf.getDict, against the single pass of ovfutil.get_ovf_settings().
+
+Usage: bench-ovf-settings.py <ovf file or directory>... [-n iterations]
+"""
+import os
+import sys
+import timeit
+
+from ovf import Ovf, OvfLibvirt
+from ovf.OvfFile import OvfFile
+
+from opennode.cli.actions.vm import ovfutil
+
+
+def _legacy_resource(ovf_file, resource_type, bound):
+    virtual_hardware_node = ovf_file.document.getElementsByTagName("VirtualHardwareSection")[0]
+    for resource in Ovf.getDict(virtual_hardware_node)['children']:
+        if (resource.get('rasd:ResourceType') == resource_type and
+                resource.get('ovf:bound', 'normal') == bound):
+            return resource
+    return None
+
+
+def legacy_settings(ovf_file):
+    settings = {'vm_type': ovfutil.get_vm_type(ovf_file)}
+    for bound in ('min', 'normal', 'max'):
+        resource = _legacy_resource(ovf_file, '4', bound)
+        if resource is not None:
+            units = resource['rasd:AllocationUnits']
+            if units.startswith('byte') or units.startswith('bit'):
+                units = units.replace('^', '**').split(' ', 1)
+                units[0] = '2**-10' if units[0] == 'byte' else '2**-13'
+                factor = eval(' '.join(units), {}, {})
+            else:
+                factor = ovfutil._MEMORY_UNITS[units]
+            settings['memory_' + bound] = str(float(resource['rasd:VirtualQuantity']) * factor / 1024 ** 2)
+        resource = _legacy_resource(ovf_file, '3', bound)
+        if resource is not None:
+            settings['vcpu_' + bound] = resource['rasd:VirtualQuantity']
+    oss = ovf_file.document.getElementsByTagName("OperatingSystemSection")
+    if oss:
+        for e in Ovf.getDict(oss[0])['children']:
+            if e['name'] == u'Description':
+                settings['os_type'] = e['text']
+    virtual_hardware_node = ovf_file.document.getElementsByTagName("VirtualHardwareSection")[0]
+    settings['networks'] = OvfLibvirt.getOvfNetworks(virtual_hardware_node)
+    return settings
+
+
+def _ovf_files(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            for fnm in sorted(os.listdir(p)):
+                if fnm.endswith('.ovf'):
+                    yield os.path.join(p, fnm)
+        else:
+            yield p
+
+
+def main():
+    args = sys.argv[1:]
+    iterations = 100
+    if '-n' in args:
+        i = args.index('-n')
+        iterations = int(args[i + 1])
+        del args[i:i + 2]
+    ovf_files = [OvfFile(fnm) for fnm in _ovf_files(args)]
+    if not ovf_files:
+        print __doc__.strip()
+        sys.exit(1)
+    results = []
+    for name, fun in (('per-setting', legacy_settings), ('single pass', ovfutil.get_ovf_settings)):
+        total = timeit.timeit(lambda: [fun(ovf_file) for ovf_file in ovf_files], number=iterations)
+        per_file = total * 1000 / iterations / len(ovf_files)
+        results.append(per_file)
+        print '%-12s %8.3f ms/file' % (name, per_file)
+    print '%d files, speedup %.1fx' % (len(ovf_files), results[0] / results[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,13 @@ from func.minion.modules import func_module
 import sys
 
 import opennode.cli.actions
+from opennode.cli.actions import samples
 
 sys.path.append('/home/marko/Projects/opennode/opennode-tui')
 
+# funcd is long running, metric samples are kept in memory
+samples.use_memory_store()
+
 
 class OpenNode(func_module.FuncModule):
     version = "0.0.1"
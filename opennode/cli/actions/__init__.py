@@ -1,10 +1,18 @@
 import sys
 
 from opennode.cli.actions import oms, console, host, templates, storage, vm, sysresources, network
+from opennode.cli.actions import samples
 
 
 __context__ = {}
 
+
+def __init__(opts):
+    """Called by the Salt loader of the minion. Metric samples are kept in
+    memory unless every job runs in a process of its own."""
+    if not opts.get('multiprocessing', True):
+        samples.use_memory_store()
+
 _hardware = None
 
 def smolt_hardware_info():
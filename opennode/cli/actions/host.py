@@ -1,14 +1,12 @@
 import netifaces
 import os
 import subprocess
-import time
 
-from opennode.cli.actions.utils import execute
 from opennode.cli.config import get_config
 
 
 def uptime():
-    return execute("awk '{print $1}' /proc/uptime")
+    return _read_first_line('/proc/uptime').split()[0]
 
 
 def interfaces():
@@ -85,13 +83,44 @@ def disk_usage(partition=None):
     return results
 
 
+def _read_first_line(path):
+    with open(path) as f:
+        return f.readline()
+
+
+def _meminfo():
+    """Return /proc/meminfo as a dict of values in kB"""
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0])
+    return info
+
+
+def _netdev_counters(iface):
+    """Return (rx bytes, tx bytes) of the interface from /proc/net/dev"""
+    with open('/proc/net/dev') as f:
+        for line in f:
+            name, sep, counters = line.partition(':')
+            if sep and name.strip() == iface:
+                counters = counters.split()
+                return int(counters[0]), int(counters[8])
+    raise ValueError('Interface %s not found in /proc/net/dev' % iface)
+
+
 def metrics():
-    from opennode.cli.actions.utils import execute, roll_data
+    """
+    Host metrics read directly from /proc and statvfs, without forking shell
+    pipelines. See benchmarks/bench-host-metrics.py for the per-call cost.
+    """
+    from opennode.cli.actions import samples
 
     def cpu_usage():
-        time_list_now = map(int, execute("head -n 1 /proc/stat").split(' ')[2:6])
-        time_list_was = roll_data('/tmp/func-cpu-host', time_list_now, [0] * 6)
-        deltas = [yi - xi for yi, xi in zip(time_list_now, time_list_was)]
+        # user, nice, system, idle
+        time_list_now = map(int, _read_first_line('/proc/stat').split()[1:5])
+        # without an earlier sample the average since boot is reported
+        deltas = (samples.deltas('host-cpu', time_list_now) or (None, time_list_now))[1]
         try:
             cpu_pct = 1 - (float(deltas[-1]) / sum(deltas))
         except ZeroDivisionError:
@@ -99,27 +128,25 @@ def metrics():
         return cpu_pct
 
     def load():
-        return float(execute("cat /proc/loadavg | awk '{print $1}'"))
+        return float(_read_first_line('/proc/loadavg').split()[0])
 
     def memory_usage():
-        return float(execute("free | tail -n 2 | head -n 1 | awk '{print $3 / 1024}'"))
+        # used memory without buffers and page cache, in MB
+        info = _meminfo()
+        return (info['MemTotal'] - info['MemFree'] - info.get('Buffers', 0) -
+                info.get('Cached', 0)) / 1024.0
 
     def network_usage():
         def get_netstats():
-            iface = get_config().getstring('general', 'main_iface')
-            return [int(v) for v in execute("grep %s: /proc/net/dev | awk -F: '{print $2}' | "
-                                            "awk '{print $1, $9}'" % iface).split(' ')]
+            return _netdev_counters(get_config().getstring('general', 'main_iface'))
         try:
-            t2, (rx2, tx2) = time.time(), get_netstats()
-            t1, rx1, tx1 = roll_data("/tmp/func-network-host", (t2, rx2, tx2), (0, 0, 0))
-
-            window = t2 - t1
-            return ((rx2 - rx1) / window, (tx2 - tx1) / window)
+            return tuple(samples.rates('host-network', get_netstats()) or (0, 0))
         except ValueError:
             return (0, 0)  # better this way
 
     def diskspace_usage():
-        return float(execute("df -P | grep ' /$' | head -n 1 | awk '{print $3/1024}'"))
+        st = os.statvfs('/')
+        return (st.f_blocks - st.f_bfree) * st.f_frsize / 1024.0 / 1024
 
     return {'cpu_usage': cpu_usage(),
             'load': load(),
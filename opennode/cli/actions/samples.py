@@ -0,0 +1,187 @@
+"""
+History of metric counter samples used to compute usage rates.
+
+Every series (e.g. 'host-cpu' or 'kvm-cpu-<uuid>') keeps a small ring buffer
+of (timestamp, counters) samples. Long running processes can keep the rings
+in memory (sample_store = memory); by default they are kept in a single
+memory-mapped file shared, under an flock, by all processes polling metrics.
+Deltas are computed against the newest sample that is at least sample_window
+seconds old, so overlapping pollers don't shrink each other's window.
+"""
+
+import collections
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from opennode.cli.actions.utils import mkdir_p
+from opennode.cli.config import get_config
+from opennode.cli.log import get_logger
+
+
+MAX_VALUES = 8
+SLOTS = 16
+MAX_SERIES = 2048
+NAME_SIZE = 64
+
+_HEADER = struct.Struct('8sIII')
+_ENTRY = struct.Struct('%dsIII' % NAME_SIZE)  # name, next slot, sample count, values
+_SAMPLE = struct.Struct('%dd' % (MAX_VALUES + 1))  # timestamp followed by values
+
+_MAGIC = 'ONSMPL01'
+_ENTRY_SIZE = _ENTRY.size + SLOTS * _SAMPLE.size
+_FILE_SIZE = _HEADER.size + MAX_SERIES * _ENTRY_SIZE
+
+
+def _baseline(samples, now, window, max_age):
+    """Pick the sample to compute deltas against from samples ordered oldest
+    first: the newest one at least window seconds old, else the oldest one"""
+    candidates = [s for s in samples if now - max_age <= s[0] < now]
+    if not candidates:
+        return None
+    old_enough = [s for s in candidates if s[0] <= now - window]
+    return old_enough[-1] if old_enough else candidates[0]
+
+
+class _MemoryStore(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def record(self, series, values, now, window, max_age):
+        with self._lock:
+            samples = self._series.setdefault(series, collections.deque(maxlen=SLOTS))
+            baseline = _baseline(list(samples), now, window, max_age)
+            samples.append((now, tuple(values)))
+        return baseline
+
+
+class _FileStore(object):
+    """Ring buffers in a fixed size file mapped into memory, indexed by an open
+    addressing hash table of series names"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        mkdir_p(os.path.dirname(filename))
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != _FILE_SIZE:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, _FILE_SIZE)
+            self._map = mmap.mmap(self._fd, _FILE_SIZE)
+            if _HEADER.unpack_from(self._map, 0) != (_MAGIC, SLOTS, MAX_VALUES, MAX_SERIES):
+                self._map[:] = '\0' * _FILE_SIZE
+                _HEADER.pack_into(self._map, 0, _MAGIC, SLOTS, MAX_VALUES, MAX_SERIES)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _entry_offset(self, series):
+        start = zlib.crc32(series) % MAX_SERIES
+        for i in xrange(MAX_SERIES):
+            offset = _HEADER.size + ((start + i) % MAX_SERIES) * _ENTRY_SIZE
+            name = _ENTRY.unpack_from(self._map, offset)[0].rstrip('\0')
+            if name == series:
+                return offset
+            if not name:
+                _ENTRY.pack_into(self._map, offset, series, 0, 0, 0)
+                return offset
+        # the table is full: reuse the home slot of the series
+        offset = _HEADER.size + start * _ENTRY_SIZE
+        _ENTRY.pack_into(self._map, offset, series, 0, 0, 0)
+        return offset
+
+    def record(self, series, values, now, window, max_age):
+        assert len(values) <= MAX_VALUES and len(series) <= NAME_SIZE, series
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset = self._entry_offset(series)
+                _, head, count, nvalues = _ENTRY.unpack_from(self._map, offset)
+                samples = []
+                if nvalues == len(values):
+                    for i in xrange(count):
+                        slot = (head - count + i) % SLOTS
+                        sample = _SAMPLE.unpack_from(self._map, offset + _ENTRY.size +
+                                                     slot * _SAMPLE.size)
+                        samples.append((sample[0], sample[1:nvalues + 1]))
+                else:
+                    count = 0
+                baseline = _baseline(samples, now, window, max_age)
+
+                padded = list(values) + [0.0] * (MAX_VALUES - len(values))
+                _SAMPLE.pack_into(self._map, offset + _ENTRY.size + head * _SAMPLE.size,
+                                  now, *padded)
+                _ENTRY.pack_into(self._map, offset, series, (head + 1) % SLOTS,
+                                 min(count + 1, SLOTS), len(values))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return baseline
+
+
+_store = {}
+_store_lock = threading.Lock()
+
+
+def _get_store():
+    with _store_lock:
+        if 'store' not in _store:
+            config = get_config()
+            if config.getstring('general', 'sample_store', 'file') == 'memory':
+                _store['store'] = _MemoryStore()
+            else:
+                filename = config.getstring('general', 'sample_file',
+                                             '/var/lib/opennode/metric-samples')
+                try:
+                    _store['store'] = _FileStore(filename)
+                except (IOError, OSError, mmap.error) as e:
+                    get_logger().warning('Cannot use %s for metric samples, keeping them in '
+                                         'memory: %s', filename, e)
+                    _store['store'] = _MemoryStore()
+        return _store['store']
+
+
+def use_memory_store():
+    """Keep samples in memory, called by the entry points of long running
+    processes (TUI, func and Salt minions)"""
+    with _store_lock:
+        _store['store'] = _MemoryStore()
+
+
+def record(series, values, timestamp=None):
+    """Record a sample of the counters of the series. Return the (timestamp,
+    values) sample to compute deltas against or None if there is none."""
+    config = get_config()
+    now = time.time() if timestamp is None else timestamp
+    return _get_store().record(series, [float(v) for v in values], now,
+                               config.getfloat('general', 'sample_window', 5),
+                               config.getfloat('general', 'sample_max_age', 900))
+
+
+def deltas(series, values, timestamp=None):
+    """Record a sample and return (elapsed seconds, counter deltas) against the
+    baseline sample, or None without a baseline or after a counter reset."""
+    now = time.time() if timestamp is None else timestamp
+    baseline = record(series, values, now)
+    if baseline is None:
+        return None
+    then, old_values = baseline
+    result = [float(v) - o for v, o in zip(values, old_values)]
+    if any(d < 0 for d in result):
+        return None
+    return now - then, result
+
+
+def rates(series, values, timestamp=None):
+    """Record a sample and return per second rates of the counters or None"""
+    delta = deltas(series, values, timestamp)
+    if delta is None:
+        return None
+    elapsed, changes = delta
+    return [change / elapsed for change in changes]
@@ -86,6 +86,7 @@ def delete_pool(pool_name):
         execute("virsh 'pool-destroy %s'" % pool_name)
         execute("virsh 'pool-undefine %s'" % pool_name)
         del_folder(get_pool_path(pool_name))
+        _pool_paths.pop(pool_name, None)
         if pool_name == config.getstring('general', 'default-storage-pool'):
             set_default_pool('')
     except Exception, e:
@@ -112,9 +113,27 @@ def add_pool(pool_name, careful=True):
         get_logger().error(msg)
 
 
+LIBVIRT_POOL_DIR = '/etc/libvirt/storage'
+
+_pool_paths = {}  # pool -> (stat of its libvirt config, path)
+
+
 def get_pool_path(storage_pool):
-    return parseString(execute("virsh 'pool-dumpxml %s'" % storage_pool)).\
+    # virsh is asked again only after libvirt rewrote the pool config, e.g. when
+    # the pool was undefined or defined anew by another process
+    try:
+        st = os.stat(os.path.join(LIBVIRT_POOL_DIR, '%s.xml' % storage_pool))
+        key = (st.st_ino, st.st_mtime, st.st_size)
+    except OSError:
+        key = None
+    cached = _pool_paths.get(storage_pool)
+    if key is not None and cached is not None and cached[0] == key:
+        return cached[1]
+    path = parseString(execute("virsh 'pool-dumpxml %s'" % storage_pool)).\
         getElementsByTagName('path')[0].lastChild.nodeValue
+    if key is not None:
+        _pool_paths[storage_pool] = (key, path)
+    return path
 
 
 def prepare_storage_pool(storage_pool=get_default_pool(), check_libvirt=True):
@@ -1,3 +1,4 @@
+import os
 import re
 
 from opennode.cli.actions.utils import execute
@@ -50,3 +51,24 @@ def get_min_disc_space_gb(vm_id):
     output = execute("vzquota stat %s | grep 1k-blocks" % str(vm_id))
     vals = output.split()
     return round(float(vals[1]) / 1024 ** 2, 2)
+
+
+def get_resources():
+    """Return a snapshot of the host resources available to new VMs, so that a
+    batch of VMs can be checked against it without probing the host again"""
+    return {'ram_gb': get_ram_size_gb(),
+            'swap_gb': get_swap_size_gb(),
+            'cpu_count': get_cpu_count(),
+            'disk_gb': get_disc_space_gb() if os.path.exists('/vz') else None}
+
+
+def get_disk_io_bytes():
+    """Return the number of bytes read from and written to the disks of the host"""
+    total = 0
+    with open('/proc/diskstats') as f:
+        for line in f:
+            values = line.split()
+            # physical disks only, partitions, device mapper or loop devices would count twice
+            if len(values) >= 10 and os.path.exists('/sys/block/%s/device' % values[2].replace('/', '!')):
+                total += (int(values[5]) + int(values[9])) * 512
+    return total
@@ -1,17 +1,23 @@
+from contextlib import closing
+
 import cPickle as pickle
+import copy
 import os
+import Queue
 import re
 import shutil
 import tarfile
+import threading
 import urlparse
-import httplib
 
 from ovf.OvfFile import OvfFile
 
 from opennode.cli.config import get_config
 from opennode.cli.actions import storage, vm as vm_ops
-from opennode.cli.actions.utils import delete, calculate_hash, execute_in_screen, execute, download
-from opennode.cli.actions.utils import urlopen, TemplateException
+from opennode.cli.actions.vm import backing
+from opennode.cli.actions.utils import delete, mkdir_p, calculate_hash, execute_in_screen, execute, download
+from opennode.cli.actions.utils import http_get, http_session, parallel_map, copy_file, TemplateException
+from opennode.cli.actions.utils import DOWNLOAD_CHUNK_SIZE
 from opennode.cli.log import get_logger
 
 __all__ = ['get_template_repos', 'get_template_list', 'sync_storage_pool', 'sync_template',
@@ -54,10 +60,8 @@ def get_template_list(remote_repo):
     """Retrieves a tmpl_list of templates from the specified repository"""
     url = get_config().getstring(remote_repo, 'url')
     url = url.rstrip('/') + '/'
-    tmpl_list = urlopen(urlparse.urljoin(url, 'templatelist.txt'))
-    templates = [template.strip() for template in tmpl_list]
-    tmpl_list.close()
-    return templates
+    tmpl_list = http_get(urlparse.urljoin(url, 'templatelist.txt'))
+    return [template.strip() for template in tmpl_list.splitlines()]
 
 
 def sync_storage_pool(storage_pool, remote_repo, templates,
@@ -104,8 +108,21 @@ def sync_storage_pool(storage_pool, remote_repo, templates,
         sync_templates_list(sync_tasks_fnm)
 
 
-def sync_template(remote_repo, template, storage_pool, silent=False):
-    """Synchronizes local template (cache) with the remote one (master)"""
+def sync_template(remote_repo, template, storage_pool, silent=False, hook=None):
+    """Synchronizes local template (cache) with the remote one (master). Download
+    progress is reported to hook(count, blockSize, totalSize)."""
+    if _fetch_template(remote_repo, template, storage_pool, silent=silent, hook=hook):
+        vm_type = get_config().getstring(remote_repo, 'type')
+        unpack_template(storage_pool, vm_type, os.path.join(storage.get_pool_path(storage_pool),
+                                                            vm_type, template))
+
+
+def _fetch_template(remote_repo, template, storage_pool, silent=False, verifying=None,
+                    hook=None):
+    """Download template and its hash into the storage pool unless a fresh copy is
+    already there. Return True if a new copy was downloaded and needs unpacking.
+    verifying() is called before the downloaded copy is checked, download progress
+    is reported to hook."""
     config = get_config()
     url = config.getstring(remote_repo, 'url')
     vm_type = config.getstring(remote_repo, 'type')
@@ -114,32 +131,168 @@ def sync_template(remote_repo, template, storage_pool, silent=False):
 
     # only download if we don't already have a fresh copy
     if is_fresh(localfile, remotefile):
-        return
+        return False
+    # a new copy would be unpacked over the disks backing deployed VMs
+    _check_not_backing(storage_pool, vm_type, template,
+                       _unpacked_names(os.path.dirname(localfile), template))
 
-    extension = "ova" if _url_exists("%s.ova" % remotefile) else "tar"
+    extension, remote_hash = _remote_hash(remotefile)
 
     unfinished_local = "%s.%s.unfinished" % (localfile, extension)
     unfinished_local_hash = "%s.%s.pfff.unfinished" % (localfile, extension)
+    unfinished_local_sha1 = "%s.%s.sha1.unfinished" % (localfile, extension)
+    unfinished_manifest = "%s.manifest.unfinished" % localfile
 
-    remote_url = "%s.%s" % (remotefile, extension)
+    # streamed templates are unpacked while they are being downloaded
+    streaming = config.getboolean('general', 'template_streaming', True)
+    keep_archive = not streaming or config.getboolean('general', 'keep_template_archive', True)
 
-    if not _url_exists(remote_url):
-        raise TemplateException("Remote template was not found: %s" % remote_url)
+    remote_url = "%s.%s" % (remotefile, extension)
 
     retries = 5
     retry = 0
-    while not is_fresh(localfile, remotefile, unfinished=True) and retries > retry:
+    while not is_fresh(localfile, remotefile, unfinished=True):
         # for resilience
+        if retry >= retries:
+            raise TemplateException("Failed to download %s after %s attempts" % (remote_url, retries))
         retry += 1
         storage.prepare_storage_pool(storage_pool)
-        download("%s.%s" % (remotefile, extension), unfinished_local, continue_=True, silent=silent)
+        expected_sha1 = _remote_sha1(remote_url)
+        # the SHA1 is computed while the data arrives. Without a SHA1 to check
+        # against, the archive may be downloaded in parallel segments instead.
+        if streaming:
+            sha1, names, staging_dir = _stream_template(remote_url, unfinished_local if keep_archive else None,
+                                                        storage_pool, vm_type, localfile, silent, hook)
+        else:
+            sha1 = download(remote_url, unfinished_local, continue_=True, silent=silent, hook=hook,
+                            checksum=bool(expected_sha1))
+
+        if verifying:
+            verifying()
+        if expected_sha1 and expected_sha1 != sha1:
+            log.warning("Checksum mismatch of %s, downloading again", remote_url)
+            delete(unfinished_local)
+            if streaming:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            continue
+
+        if streaming:
+            _commit_staged(storage_pool, vm_type, staging_dir, names)
+            if not keep_archive:
+                with open(unfinished_manifest, 'w') as f:
+                    f.write('\n'.join(names))
 
-        r_template_hash = "%s.%s.pfff" % (remotefile, extension)
-        download(r_template_hash, unfinished_local_hash, continue_=True, silent=silent)
+        if sha1:
+            with open(unfinished_local_sha1, 'w') as f:
+                f.write(sha1)
+        else:
+            delete(unfinished_local_sha1)
+        # the hash marks the download as complete
+        with open(unfinished_local_hash, 'w') as f:
+            f.write(remote_hash)
 
-    os.rename(unfinished_local, '%s.%s' % (localfile, extension))
+    if keep_archive:
+        os.rename(unfinished_local, '%s.%s' % (localfile, extension))
+    else:
+        os.rename(unfinished_manifest, '%s.manifest' % localfile)
+    if os.path.exists(unfinished_local_sha1):
+        os.rename(unfinished_local_sha1, '%s.%s.sha1' % (localfile, extension))
+    else:
+        delete('%s.%s.sha1' % (localfile, extension))
     os.rename(unfinished_local_hash, '%s.%s.pfff' % (localfile, extension))
-    unpack_template(storage_pool, vm_type, localfile)
+    return not streaming
+
+
+class _ChunkStream(object):
+    """Read-only file object fed with chunks of data from another thread"""
+
+    def __init__(self, max_chunks=64):
+        self._queue = Queue.Queue(max_chunks)
+        self._buffer = ''
+        self._eof = False
+        self.aborted = False
+
+    def feed(self, chunk):
+        if self.aborted:
+            raise IOError('Reader of the stream failed')
+        self._queue.put(chunk)
+
+    def close(self):
+        self._queue.put(None)
+
+    def abort(self):
+        """Stop reading; chunks fed meanwhile are discarded until close()"""
+        self.aborted = True
+        while not self._eof:
+            self._eof = self._queue.get() is None
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _stream_template(remote_url, local, storage_pool, vm_type, tmpl_name, silent=False, hook=None):
+    """Download template archive and unpack it at the same time into a staging
+    directory, to be moved into place with _commit_staged() once the archive
+    is verified. The archive itself is stored only if local is given. Return
+    SHA1 of the archive, names of the unpacked files and the staging directory."""
+    stream = _ChunkStream()
+    result = {}
+    staging_dir = os.path.join(storage.get_pool_path(storage_pool), vm_type, 'unpacked',
+                               '.%s.staging' % os.path.basename(tmpl_name))
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def extract():
+        try:
+            result['names'] = unpack_template(storage_pool, vm_type, tmpl_name, stream=stream,
+                                              staging_dir=staging_dir)
+            # consume padding after the end of archive marker
+            while stream.read(DOWNLOAD_CHUNK_SIZE):
+                pass
+        except Exception as e:
+            result['error'] = e
+            stream.abort()
+
+    extractor = threading.Thread(target=extract, name='template-extractor')
+    extractor.start()
+    try:
+        sha1 = download(remote_url, local, continue_=True, silent=silent, hook=hook,
+                        consumer=stream.feed)
+    except Exception:
+        # the extractor failure, if any, is the interesting one
+        stream.close()
+        extractor.join()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        if 'error' in result:
+            raise result['error']
+        raise
+    stream.close()
+    extractor.join()
+    if 'error' in result:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise result['error']
+    return sha1, result['names'], staging_dir
+
+
+def _commit_staged(storage_pool, vm_type, staging_dir, names):
+    """Move the files of a verified template from the staging directory into
+    the 'unpacked' folder and add the symlinks needed by the vm_type"""
+    unpacked_dir = os.path.dirname(staging_dir)
+    for top in sorted(set(os.path.normpath(name).split(os.sep)[0] for name in names) - set(['.'])):
+        target = os.path.join(unpacked_dir, top)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        os.rename(os.path.join(staging_dir, top), target)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    _link_unpacked(storage_pool, vm_type, names)
 
 
 def import_template(template, vm_type, storage_pool=None):
@@ -157,9 +310,11 @@ def import_template(template, vm_type, storage_pool=None):
 
     tmpl_name = os.path.basename(template)
     target_file = os.path.join(storage.get_pool_path(storage_pool), vm_type, tmpl_name)
+    with closing(tarfile.open(template)) as tmpl:
+        _check_not_backing(storage_pool, vm_type, template, tmpl.getnames())
 
     log.info("Copying template to the storage pool... %s -> %s" % (template, target_file))
-    shutil.copyfile(template, target_file)
+    copy_file(template, target_file)
     calculate_hash(target_file)
 
     log.info("Unpacking template %s..." % target_file)
@@ -173,47 +328,118 @@ def delete_template(storage_pool, vm_type, template):
     config = get_config()
     log.info("Deleting %s (%s) from %s..." % (template, vm_type, storage_pool))
     storage_endpoint = config.getstring('general', 'storage-endpoint')
-    templatefile = "%s/%s/%s/%s.tar" % (storage_endpoint, storage_pool, vm_type, template)
-    if not os.path.exists(templatefile):
-        templatefile = os.path.splitext(templatefile)[0] + '.ova'
-    tmpl = tarfile.open(templatefile)
-    for packed_file in tmpl.getnames():
-        fnm = "%s/%s/%s/unpacked/%s" % (storage_endpoint, storage_pool, vm_type, packed_file)
+    basedir = "%s/%s/%s" % (storage_endpoint, storage_pool, vm_type)
+    templatefile = _template_archive(basedir, template)
+    if templatefile is not None:
+        packed_files = tarfile.open(templatefile).getnames()
+    else:
+        packed_files = _read_manifest(basedir, template)
+    _check_not_backing(storage_pool, vm_type, template, packed_files)
+    for packed_file in packed_files:
+        fnm = "%s/unpacked/%s" % (basedir, packed_file)
         if not os.path.isdir(fnm):
             delete(fnm)
         else:
             shutil.rmtree(fnm)
-    # remove master copy
-    delete(templatefile)
-    delete("%s.pfff" % templatefile)
+    # remove master copy (or the manifest of a template stored without it) and hashes
+    for extension in ('ova', 'tar'):
+        templatefile = "%s/%s.%s" % (basedir, template, extension)
+        delete(templatefile)
+        delete("%s.pfff" % templatefile)
+        delete("%s.sha1" % templatefile)
+    delete("%s/%s.manifest" % (basedir, template))
     # also remove symlink for openvz vm_type
     if vm_type == 'openvz':
         delete("%s/%s" % (config.getstring('general', 'openvz-templates'), "%s.tar.gz" % template))
 
 
-def unpack_template(storage_pool, vm_type, tmpl_name):
+def _check_not_backing(storage_pool, vm_type, template, names):
+    """Raise TemplateException if one of the unpacked files of the template is
+    the backing file of qcow2 overlays, which must not be replaced or deleted"""
+    if vm_type not in ('kvm', 'qemu'):
+        return
+    storage_endpoint = get_config().getstring('general', 'storage-endpoint')
+    images_dir = "%s/%s/images" % (storage_endpoint, storage_pool)
+    overlays = []
+    for name in names:
+        overlays += backing.overlays_of(images_dir, "%s/%s/%s/unpacked/%s" % (storage_endpoint, storage_pool,
+                                                                            vm_type, name))
+    if overlays:
+        raise TemplateException("Template %s backs the disks %s, flatten or undeploy "
+                                "those VMs first" % (os.path.basename(template), ', '.join(overlays)))
+
+
+def _unpacked_names(basedir, tmpl_name):
+    """Return names of the files of the template unpacked so far"""
+    tar_name = _template_archive(basedir, tmpl_name)
+    if tar_name is not None:
+        with closing(tarfile.open(tar_name)) as tmpl:
+            return tmpl.getnames()
+    if os.path.exists(os.path.join(basedir, "%s.manifest" % tmpl_name)):
+        return _read_manifest(basedir, tmpl_name)
+    return []
+
+
+def unpack_template(storage_pool, vm_type, tmpl_name, stream=None, staging_dir=None):
     """Unpacks template into the 'unpacked' folder of the storage pool.
-       Adds symlinks as needed by the VM template vm_type."""
+       Adds symlinks as needed by the VM template vm_type. With stream, the
+       archive is read sequentially from the file object, e.g. while it is being
+       downloaded. With staging_dir, the files are unpacked there instead and
+       left for _commit_staged(). Returns names of the unpacked files."""
     # we assume location of the 'unpacked' to be the same as the location of the file
     basedir = os.path.join(storage.get_pool_path(storage_pool), vm_type)
-    tar_name = ""
-    if os.path.exists(os.path.join(basedir, "%s.tar" % tmpl_name)):
-        tar_name = os.path.join(basedir, "%s.tar" % tmpl_name)
-    if os.path.exists(os.path.join(basedir, "%s.ova" % tmpl_name)):
-        tar_name = os.path.join(basedir, "%s.ova" % tmpl_name)
-    tmpl = tarfile.open(tar_name)
     unpacked_dir = os.path.join(basedir, 'unpacked')
-    tmpl.extractall(unpacked_dir)
+    if stream is not None:
+        tmpl = tarfile.open(fileobj=stream, mode='r|*')
+    else:
+        tar_name = _template_archive(basedir, tmpl_name)
+        if tar_name is None:
+            # the archive was not kept, the template is unpacked already
+            names = _read_manifest(basedir, tmpl_name)
+            tmpl = None
+        else:
+            tmpl = tarfile.open(tar_name)
+    if tmpl is not None:
+        if stream is None:
+            _check_not_backing(storage_pool, vm_type, tmpl_name, tmpl.getnames())
+            tmpl.extractall(unpacked_dir)
+        else:
+            # members of a stream are only known as they arrive
+            for member in tmpl:
+                _check_not_backing(storage_pool, vm_type, tmpl_name, [member.name])
+                tmpl.extract(member, staging_dir or unpacked_dir)
+        names = tmpl.getnames()
+        tmpl.close()
+    if staging_dir is None:
+        _link_unpacked(storage_pool, vm_type, names)
+    return names
+
+
+def _link_unpacked(storage_pool, vm_type, names):
     # special case for openvz vm_type
     if vm_type == 'openvz':
         from opennode.cli.actions import vm
-        tmpl_name = [fnm for fnm in tmpl.getnames()
+        tmpl_name = [fnm for fnm in names
                      if fnm.endswith('tar.gz') and not fnm.endswith('scripts.tar.gz')]
         # make sure we have only a single tarball with the image
         assert len(tmpl_name) == 1
         vm.openvz.link_template(storage_pool, tmpl_name[0])
 
 
+def _template_archive(basedir, tmpl_name):
+    """Return path of the template archive (.ova or .tar) or None if it wasn't kept"""
+    for extension in ('ova', 'tar'):
+        tar_name = os.path.join(basedir, "%s.%s" % (tmpl_name, extension))
+        if os.path.exists(tar_name):
+            return tar_name
+
+
+def _read_manifest(basedir, tmpl_name):
+    """Return names of unpacked files of a template whose archive wasn't kept"""
+    with open(os.path.join(basedir, "%s.manifest" % tmpl_name)) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
 def get_local_templates(vm_type, storage_pool=None):
     """Returns a list of templates of a certain vm_type from the storage pool"""
     config = get_config()
@@ -221,28 +447,28 @@ def get_local_templates(vm_type, storage_pool=None):
     if not storage_pool:
         storage_pool = config.getstring('general', 'default-storage-pool')
 
-    return [os.path.splitext(tmpl)[0] for tmpl in
-            os.listdir("%s/%s" % (storage.get_pool_path(storage_pool), vm_type))
-            if tmpl.endswith('tar') or tmpl.endswith('ova')]
+    templates = []
+    # templates stored without their archive are listed by their manifest
+    for tmpl in os.listdir("%s/%s" % (storage.get_pool_path(storage_pool), vm_type)):
+        if tmpl.endswith('tar') or tmpl.endswith('ova') or tmpl.endswith('.manifest'):
+            if os.path.splitext(tmpl)[0] not in templates:
+                templates.append(os.path.splitext(tmpl)[0])
+    return templates
 
 
-def sync_oms_template(storage_pool=None):
+def sync_oms_template(storage_pool=None, silent=False, hook=None):
     """Synchronize OMS template"""
     config = get_config()
     if not storage_pool:
         storage_pool = config.getstring('general', 'default-storage-pool')
     repo = config.getstring('opennode-oms-template', 'repo')
     tmpl = config.getstring('opennode-oms-template', 'template_name')
-    sync_template(repo, tmpl, storage_pool)
+    sync_template(repo, tmpl, storage_pool, silent=silent, hook=hook)
 
 
 def is_fresh(localfile, remotefile, unfinished=False):
     """Checks whether local copy matches remote file"""
-    # get remote hash
-    extension = "ova" if _url_exists("%s.ova" % remotefile) else "tar"
-    remote_hashfile = urlopen("%s.%s.pfff" % (remotefile, extension))
-    remote_hash = remote_hashfile.read()
-    remote_hashfile.close()
+    extension, remote_hash = _remote_hash(remotefile)
     # get a local one
     try:
         with open("%s.%s.pfff%s" % (localfile, extension,
@@ -285,26 +511,119 @@ def get_purely_local_templates(storage_pool, vm_type, remote_repo):
     return list(set(local_templates) - set(remote_templates))
 
 
+class _TemplateCatalogue(object):
+    """
+    Parsed settings of local templates keyed by the path of their OVF file and
+    validated by its mtime and size and by the mtime of the vm_type config file
+    holding the ovf-defaults merged into them. The catalogue is persisted, so
+    listing templates needs neither OVF parsing nor subprocesses unless a
+    template or the defaults changed.
+    """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._entries = None
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # pick up entries added by other processes
+        try:
+            mtime = os.stat(self.fnm).st_mtime
+        except OSError:
+            mtime = None
+        if self._entries is not None and mtime == self._loaded_mtime:
+            return
+        self._entries = {}
+        if mtime is not None:
+            try:
+                with open(self.fnm) as f:
+                    self._entries = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError) as e:
+                log.warning("Ignoring broken template catalogue %s: %s", self.fnm, e)
+        self._loaded_mtime = mtime
+
+    def _save(self):
+        try:
+            mkdir_p(os.path.dirname(self.fnm))
+            with open(self.fnm + '.tmp', 'w') as f:
+                pickle.dump(self._entries, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(self.fnm + '.tmp', self.fnm)
+            self._loaded_mtime = os.stat(self.fnm).st_mtime
+        except (IOError, OSError) as e:
+            log.debug("Cannot save template catalogue %s: %s", self.fnm, e)
+
+    def settings(self, ovf_path, vm_type):
+        try:
+            st = os.stat(ovf_path)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, ovf_path)
+        try:
+            defaults_mtime = os.stat(get_config(vm_type).config_file).st_mtime
+        except OSError:
+            defaults_mtime = None
+        key = (st.st_mtime, st.st_size, defaults_mtime)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(ovf_path)
+            if entry and entry[0] == key:
+                return copy.deepcopy(entry[1])
+
+        vm = vm_ops.get_module(vm_type)
+        read_settings = getattr(vm, 'read_template_settings', vm.get_ovf_template_settings)
+        settings = read_settings(OvfFile(ovf_path))
+
+        with self._lock:
+            self._load()
+            self._entries[ovf_path] = (key, settings)
+            # forget deleted templates
+            for stale in [p for p in self._entries if not os.path.exists(p)]:
+                del self._entries[stale]
+            self._save()
+        return copy.deepcopy(settings)
+
+
+_catalogue = {}
+
+
+def _template_catalogue():
+    if 'catalogue' not in _catalogue:
+        _catalogue['catalogue'] = _TemplateCatalogue(get_config().getstring(
+            'general', 'template_catalogue', '/var/cache/opennode/template-catalogue'))
+    return _catalogue['catalogue']
+
+
 def get_template_info(template_name, vm_type, storage_pool=None):
+    """Return settings of a local template"""
     config = get_config()
     if not storage_pool:
         storage_pool = config.getstring('general', 'default-storage-pool')
-    ovf_file = OvfFile(os.path.join(storage.get_pool_path(storage_pool),
-                                    vm_type, "unpacked",
-                                    template_name + ".ovf"))
-    vm = vm_ops.get_module(vm_type)
-    template_settings = vm.get_ovf_template_settings(ovf_file)
+    ovf_path = os.path.join(storage.get_pool_path(storage_pool), vm_type, "unpacked",
+                            template_name + ".ovf")
+    template_settings = _template_catalogue().settings(ovf_path, vm_type)
     # XXX handle modification to system params
     #errors = vm.adjust_setting_to_systems_resources(template_settings)
     return template_settings
 
 
+SYNC_STATES = ('queued', 'downloading', 'verifying', 'unpacking', 'done', 'failed', 'unpack_failed')
+
+
+def _sync_task(task):
+    """Convert (template, storage_pool, remote_repo) tuples of older task lists"""
+    if isinstance(task, dict):
+        return task
+    template, storage_pool, remote_repo = task
+    return {'template': template, 'storage_pool': storage_pool,
+            'remote_repo': remote_repo, 'state': 'queued', 'error': None}
+
+
 def get_templates_sync_list(sync_tasks_fnm=None):
     """Return current template synchronisation list"""
     if not sync_tasks_fnm:
         sync_tasks_fnm = get_config().getstring('general', 'sync_task_list')
     with open(sync_tasks_fnm, 'r') as tf:
-        return pickle.load(tf)
+        return [_sync_task(task) for task in pickle.load(tf)]
 
 
 def set_templates_sync_list(tasks, sync_tasks_fnm=None):
@@ -312,28 +631,84 @@ def set_templates_sync_list(tasks, sync_tasks_fnm=None):
     as some retrieval might be in progress"""
     if not sync_tasks_fnm:
         sync_tasks_fnm = get_config().getstring('general', 'sync_task_list')
-    with open(sync_tasks_fnm, 'w') as tf:
-        pickle.dump(tasks, tf)
+    # write a complete copy first, so that a crash never leaves a truncated list
+    with open(sync_tasks_fnm + '.tmp', 'w') as tf:
+        pickle.dump([_sync_task(task) for task in tasks], tf)
+        tf.flush()
+        os.fsync(tf.fileno())
+    os.rename(sync_tasks_fnm + '.tmp', sync_tasks_fnm)
 
 
 def sync_templates_list(sync_tasks_fnm=None):
-    """Sync a list of templates defined in a file. After synchronizing a template,
-    removes it from the list. NB: multiple copies of this function should be run
-    against the same task list file!"""
+    """Sync a list of templates defined in a file. Templates are downloaded by
+    sync_workers concurrent workers, while downloaded ones are unpacked by a
+    separate thread. The state of every task is persisted in the list, so an
+    interrupted synchronisation resumes where it stopped. The list is removed
+    once all templates are done. NB: only a single copy of this function should
+    be run against the same task list file!"""
     if not sync_tasks_fnm:
         sync_tasks_fnm = get_config().getstring('general', 'sync_task_list')
-    if os.path.exists(sync_tasks_fnm):
-        tasks = get_templates_sync_list(sync_tasks_fnm)
-        while tasks:
-            # this doesn't make sense the first time, but for resilience we reread a list
-            # each time a template was downloaded
-            tasks = get_templates_sync_list(sync_tasks_fnm)
-            template, storage_pool, remote_repo = tasks[0]
-            # XXX a separate download hook for dumping progress to a file?
-            sync_template(remote_repo, template, storage_pool)
-            del tasks[0]
+    if not os.path.exists(sync_tasks_fnm):
+        return
+
+    tasks = get_templates_sync_list(sync_tasks_fnm)
+    lock = threading.Lock()
+
+    def set_state(task, state, error=None):
+        with lock:
+            task['state'], task['error'] = state, error
             set_templates_sync_list(tasks, sync_tasks_fnm)
-        os.unlink(sync_tasks_fnm)
+
+    unpack_queue = Queue.Queue()
+
+    def unpacker():
+        for task in iter(unpack_queue.get, None):
+            set_state(task, 'unpacking')
+            vm_type = get_config().getstring(task['remote_repo'], 'type')
+            try:
+                unpack_template(task['storage_pool'], vm_type,
+                                os.path.join(storage.get_pool_path(task['storage_pool']),
+                                             vm_type, task['template']))
+            except Exception as e:
+                log.error("Failed to unpack %s: %s", task['template'], e)
+                # the archive is fresh, so a rerun would not download and unpack it again
+                set_state(task, 'unpack_failed', str(e))
+            else:
+                set_state(task, 'done')
+
+    def fetch(task):
+        set_state(task, 'downloading')
+        try:
+            fetched = _fetch_template(task['remote_repo'], task['template'], task['storage_pool'],
+                                      silent=True, verifying=lambda: set_state(task, 'verifying'))
+        except Exception as e:
+            log.error("Failed to download %s: %s", task['template'], e)
+            set_state(task, 'failed', str(e))
+            return
+        if fetched:
+            unpack_queue.put(task)
+        else:
+            set_state(task, 'done')
+
+    unpack_thread = threading.Thread(target=unpacker, name='template-unpacker')
+    unpack_thread.start()
+    try:
+        # the download of tasks interrupted or failed while unpacking is complete already
+        for task in tasks:
+            if task['state'] in ('unpacking', 'unpack_failed'):
+                unpack_queue.put(task)
+        parallel_map(fetch, [task for task in tasks
+                             if task['state'] not in ('done', 'unpacking', 'unpack_failed')],
+                     get_config().getint('general', 'sync_workers', 3))
+    finally:
+        unpack_queue.put(None)
+        unpack_thread.join()
+
+    failed = [task['template'] for task in tasks if task['state'] != 'done']
+    if failed:
+        raise TemplateException("Failed to synchronize templates %s, run the synchronization "
+                                "again to resume" % ', '.join(failed))
+    os.unlink(sync_tasks_fnm)
 
 
 def is_syncing():
@@ -341,11 +716,28 @@ def is_syncing():
     return int(execute("screen -ls 2>/dev/null | grep OPENNODE-SYNC| wc -l")) == 1
 
 
-def _url_exists(url):
-    """Check if remote url exists (is not 404)"""
-    parsed_url = urlparse.urlparse(url)
-    conn = httplib.HTTPConnection(parsed_url.netloc)
-    conn.request('HEAD', parsed_url.path)
-    response = conn.getresponse()
-    conn.close()
-    return response.status != 404
+def _remote_hash(remotefile):
+    """Return extension (ova or tar) and hash of the remote template. Responses
+    are cached by the HTTP session, so repeated checks are cheap."""
+    for extension in ('ova', 'tar'):
+        body = _http_get_or_none("%s.%s.pfff" % (remotefile, extension))
+        if body is not None:
+            return extension, body
+    raise TemplateException("Remote template was not found: %s" % remotefile)
+
+
+def _remote_sha1(remote_url):
+    """Return SHA1 published next to the remote template or None"""
+    body = _http_get_or_none("%s.sha1" % remote_url)
+    return body.split()[0] if body and body.split() else None
+
+
+def _http_get_or_none(url):
+    """Return body of the remote URL or None if it is not found. Other HTTP
+    and network errors are raised as IOError."""
+    status, _, body = http_session().request('GET', url)
+    if status == 404:
+        return None
+    if status != 200:
+        raise IOError('HTTP error %s for %s' % (status, url))
+    return body
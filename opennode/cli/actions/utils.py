@@ -1,18 +1,34 @@
+import base64
+import collections
+import ctypes
+import ctypes.util
+import fcntl
 import os
 import errno
+import hashlib
 import commands
+import multiprocessing
+import struct
 import subprocess
 import shlex
+import sys
+import threading
+import time
 import ConfigParser
+import httplib
+import Queue
 import shutil
+import socket
 import urllib
 import urlparse
 import cPickle as pickle
 import tarfile
+import zlib
 
 from progressbar import Bar, ETA, FileTransferSpeed, Percentage, ProgressBar, RotatingMarker
 
 from openvz_exit_status import OpenVZ_EXIT_STATUS
+from opennode.cli.config import get_config
 from opennode.cli.log import get_logger
 
 
@@ -86,6 +102,85 @@ def execute2(cmd):
             break
 
 
+def parallel_map(fun, items, workers=8, timeout=None, timed_out=None):
+    """
+    Apply fun to every item using a bounded pool of worker threads. Results are
+    returned in the order of items. The first exception raised by fun is re-raised
+    once all items are processed.
+
+    If timeout (in seconds) is given, an item which is processed longer than that is
+    given up on: its result is timed_out(item) (or None) and its worker thread is
+    abandoned and replaced, so that a stuck call does not hold up the other items.
+    """
+    items = list(items)
+    if len(items) == 0:
+        return []
+    if timeout is None and (workers <= 1 or len(items) <= 1):
+        return map(fun, items)
+
+    results = [None] * len(items)
+    errors = []
+    tasks = Queue.Queue()
+    for task in enumerate(items):
+        tasks.put(task)
+
+    cond = threading.Condition()
+    running = {}  # item index -> start time
+    finished = set()
+
+    def worker():
+        while True:
+            try:
+                idx, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            with cond:
+                running[idx] = time.time()
+            try:
+                result, error = fun(item), None
+            except Exception:
+                result, error = None, sys.exc_info()
+            with cond:
+                if idx in finished:
+                    # timed out and replaced by another worker, which owns the slot now
+                    return
+                results[idx] = result
+                if error is not None:
+                    errors.append(error)
+                running.pop(idx, None)
+                finished.add(idx)
+                cond.notify()
+
+    def start_worker():
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for _ in range(max(1, min(workers, len(items)))):
+        start_worker()
+
+    with cond:
+        while len(finished) < len(items):
+            wait = 1.0
+            if timeout is not None:
+                now = time.time()
+                for idx, started in running.items():
+                    if now - started >= timeout:
+                        get_logger().warning('Giving up on %s after %ss', items[idx], timeout)
+                        results[idx] = timed_out(items[idx]) if timed_out else None
+                        del running[idx]
+                        finished.add(idx)
+                        start_worker()
+                if running:
+                    wait = min(wait, max(0.01, min(running.values()) + timeout - now))
+            if len(finished) < len(items):
+                cond.wait(wait)
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
 def calculate_hash(target_file):
     """Hash contents of a file and write hashes out to a file"""
     execute("pfff -k 6996807 -B \"%s\" > \"%s\".pfff" % (target_file, target_file))
@@ -139,8 +234,7 @@ class ConsoleProgressBar(object):
     pbar = None
 
     def update_url(self, url):
-        if self.pbar.start_time is not None and self.pbar.finished is False:
-            self.finish()
+        self.finish()
         self.pbar.maxval = None
 
     def __init__(self, tmpl_name):
@@ -157,7 +251,8 @@ class ConsoleProgressBar(object):
         self.pbar.update(min(self.pbar.maxval, blockSize * count))
 
     def finish(self):
-        self.pbar.finish()
+        if self.pbar.start_time is not None and self.pbar.finished is False:
+            self.pbar.finish()
 
 
 class BasicURLOpener(urllib.FancyURLopener):
@@ -171,35 +266,447 @@ class BasicURLOpener(urllib.FancyURLopener):
         return (self.username, self.password)
 
 
-def download(remote, local, continue_=False, silent=False):
+class _RateLimiter(object):
+    """Bandwidth limit shared by all segments of a download"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + nbytes / float(self.rate)
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _save_parts(parts_fnm, parts):
+    with open(parts_fnm + '.tmp', 'w') as f:
+        pickle.dump(parts, f)
+    os.rename(parts_fnm + '.tmp', parts_fnm)
+
+
+FICLONE = 0x40049409
+SEEK_DATA, SEEK_HOLE = 3, 4
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_libc = {}
+
+
+def _copy_file_range():
+    """Return the copy_file_range(2) wrapper of libc or None"""
+    if 'copy_file_range' not in _libc:
+        fun = getattr(ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True),
+                      'copy_file_range', None)
+        if fun is not None:
+            fun.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                            ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                            ctypes.c_size_t, ctypes.c_uint]
+            fun.restype = ctypes.c_ssize_t
+        _libc['copy_file_range'] = fun
+    return _libc['copy_file_range']
+
+
+def _data_extents(fd, size):
+    """Yield (start, end) of the data regions of a file, skipping holes"""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # only a hole is left
+                return
+            if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield offset, size
+                return
+            raise
+        yield start, min(end, size)
+        offset = end
+
+
+def _kernel_copy(src_fd, dst_fd, start, end):
+    copy_file_range = _copy_file_range()
+    src_offset, dst_offset = ctypes.c_longlong(start), ctypes.c_longlong(start)
+    while src_offset.value < end:
+        copied = copy_file_range(src_fd, ctypes.byref(src_offset), dst_fd, ctypes.byref(dst_offset),
+                                 min(end - src_offset.value, 1024 ** 3), 0)
+        if copied < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if copied == 0:
+            break
+
+
+def _sparse_copy(src_fd, dst_fd, start, end):
+    zeros = '\0' * COPY_CHUNK_SIZE
+    os.lseek(src_fd, start, os.SEEK_SET)
+    offset = start
+    while offset < end:
+        chunk = os.read(src_fd, min(COPY_CHUNK_SIZE, end - offset))
+        if not chunk:
+            break
+        # blocks of zeros are left as holes
+        if chunk != zeros[:len(chunk)]:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            data = buffer(chunk)
+            while data:
+                data = data[os.write(dst_fd, data):]
+        offset += len(chunk)
+
+
+def copy_file(src, dst, hook=None):
+    """Copy the contents and stat info of src to dst as cheaply as the file
+    systems allow: a reflink sharing the data (FICLONE), else an in-kernel
+    copy_file_range of the data regions, else a userspace copy of the data
+    regions. Holes are preserved either way. Progress is reported to
+    hook(count, blockSize, totalSize). Return (method, bytes, seconds)."""
+    started = time.time()
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                method = 'reflink'
+            except (IOError, OSError):
+                method = 'copy_file_range' if _copy_file_range() else 'sparse copy'
+                copied = 0
+                for start, end in _data_extents(src_fd, size):
+                    if method == 'copy_file_range':
+                        try:
+                            _kernel_copy(src_fd, dst_fd, start, end)
+                        except OSError as e:
+                            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                               errno.EOPNOTSUPP, errno.EBADF):
+                                raise
+                            method = 'sparse copy'
+                    if method == 'sparse copy':
+                        _sparse_copy(src_fd, dst_fd, start, end)
+                    copied += end - start
+                    if hook:
+                        hook(copied, 1, size)
+                # a trailing hole
+                os.ftruncate(dst_fd, size)
+    shutil.copystat(src, dst)
+    elapsed = time.time() - started
+    get_logger().info('Copied %s to %s by %s: %.1f MB in %.1f s (%.1f MB/s)', src, dst, method,
+                      size / 1048576.0, elapsed, size / 1048576.0 / max(elapsed, 0.001))
+    return method, size, elapsed
+
+
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+
+class ParallelGzipWriter(object):
+    """
+    Write-only gzip file compressing blocks of the data in worker threads, as
+    zlib releases the GIL while compressing. Like pigz, the blocks are deflated
+    independently and joined by sync flushes into a single gzip member, which
+    any gzip reader can decompress. SHA1 and size of the compressed output are
+    computed as it is written.
+    """
+
+    def __init__(self, fnm, workers=None, level=None, block_size=COMPRESS_BLOCK_SIZE):
+        config = get_config()
+        workers = workers or config.getint('general', 'archive_workers', 0) or multiprocessing.cpu_count()
+        self.level = level or config.getint('general', 'archive_compression_level', 6)
+        self.block_size = block_size
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self._fileobj = open(fnm, 'wb')
+        self._crc = zlib.crc32('') & 0xffffffff
+        self._isize = 0
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._max_pending = 2 * workers
+        self._jobs = Queue.Queue()
+        self._workers = [threading.Thread(target=self._work, name='gzip-%d' % i) for i in xrange(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        # gzip header: deflate, no flags, no mtime, unknown OS
+        self._output(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, 0, 255))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            block, done, result = job
+            try:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                result.append(compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH))
+            except Exception as e:
+                result.append(e)
+            done.set()
+
+    def _output(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        self._fileobj.write(data)
+
+    def _collect(self):
+        done, result = self._pending.popleft()
+        done.wait()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        self._output(result[0])
+
+    def _submit(self):
+        block = ''.join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        self._crc = zlib.crc32(block, self._crc) & 0xffffffff
+        self._isize += len(block)
+        if len(self._pending) >= self._max_pending:
+            self._collect()
+        done, result = threading.Event(), []
+        self._pending.append((done, result))
+        self._jobs.put((block, done, result))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def tell(self):
+        return self._isize + self._buffered
+
+    def close(self):
+        if self._fileobj.closed:
+            return
+        try:
+            if self._buffered:
+                self._submit()
+            while self._pending:
+                self._collect()
+            # an empty final block ends the deflate stream
+            self._output(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self._output(struct.pack('<II', self._crc, self._isize & 0xffffffff))
+        finally:
+            for _ in self._workers:
+                self._jobs.put(None)
+            self._fileobj.close()
+
+
+def _hash_file(fnm, sha=None, limit=None, consumer=None):
+    sha = sha or hashlib.sha1()
+    remaining = limit
+    with open(fnm, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE if remaining is None
+                           else min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha.update(chunk)
+            if consumer:
+                consumer(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return sha
+
+
+def download(remote, local, continue_=False, silent=False, hook=None, consumer=None,
+             checksum=True):
     """Download a remote file to a local file, using optional username/password
-    for basic HTTP authentication. Using cURL as external dependency"""
+    for basic HTTP authentication. A partial local file is resumed with continue_.
+    Progress is reported to hook(count, blockSize, totalSize). Return SHA1 of the
+    file, or None without checksum. download_rate_limit (bytes/s) is honoured.
+
+    As SHA1 needs the data in order, only files downloaded without checksum can
+    be fetched in download_segments (1 by default, i.e. off) parallel byte
+    ranges, when the server supports them.
+
+    With consumer the data is also passed in order to consumer(chunk) as it
+    arrives; local may then be None if the file itself is not needed."""
     msg = "Getting remote file %s" % remote
     get_logger().info(msg)
-    print msg
-    url = urlparse.urlsplit(remote)
-    curl_cmd = ['curl']
-    curl_file_args = ['-o', '%s' % local, '%s' % remote]
-
-    if url.username:
-        if 'http_proxy' in os.environ:
-            if url.password:
-                remote = remote.replace('%s:%s@' % (url.username, url.password), '')
-                userauth = '%s:%s' % (url.username, url.password)
-            else:
-                remote = remote.replace('%s@' % url.username, '')
-                userauth = url.username
-            curl_cmd += ['--anyauth', '--user', userauth]
-    else:
-        curl_cmd.append('-L')
+    bar = None
+    if not silent:
+        print msg
+        if hook is None:
+            bar = ConsoleProgressBar(os.path.basename(local or remote))
+            hook = bar.download_hook
+    try:
+        return _download(remote, local, continue_, hook, consumer, checksum)
+    finally:
+        if bar:
+            bar.finish()
+
+
+def _download(remote, local, continue_, hook, consumer, checksum):
+    config = get_config()
+    session = http_session()
+    limiter = _RateLimiter(config.getint('general', 'download_rate_limit', 0))
+    retries = config.getint('general', 'download_retries', 3)
+    segments = config.getint('general', 'download_segments', 1)
+    segment_min = config.getint('general', 'download_segment_min_size', 64 * 1024 * 1024)
+
+    # the consumer needs the data in order
+    segmented = local is not None and consumer is None and not checksum and segments > 1
+    total = None
+    if segmented:
+        # segments are planned before anything is downloaded, a stream learns
+        # the size from its own response
+        status, headers, _ = session.request('HEAD', remote, use_cache=False)
+        total = int(headers['content-length']) if status == 200 and 'content-length' in headers else None
+        segmented = headers.get('accept-ranges') == 'bytes' and total is not None
+
+    if local is not None and os.path.exists(local + '.parts') and not (continue_ and segmented):
+        # the file of unfinished segments is preallocated and can only be resumed
+        # in segments, so start over
+        delete(local + '.parts')
+        delete(local)
+    offset = os.path.getsize(local) if local and continue_ and os.path.exists(local) else 0
+
+    if not segmented or (not os.path.exists(local + '.parts')
+                         and total - offset < 2 * segment_min):
+        sha = _download_stream(session, remote, local, offset, total, retries,
+                               limiter, hook, consumer)
+        return sha.hexdigest() if checksum else None
+    _download_segments(session, remote, local, offset, total, segments, retries, limiter, hook)
+
+
+def _download_stream(session, remote, local, offset, total, retries, limiter, hook, consumer=None):
+    """Download (the rest of) the file in a single stream hashing it on the fly"""
+    # the part downloaded earlier is hashed (and consumed) first
+    sha = _hash_file(local, limit=offset, consumer=consumer) if offset else hashlib.sha1()
+    for attempt in xrange(retries + 1):
+        response = session.open(remote, {'Range': 'bytes=%d-' % offset} if offset else {})
+        if response.status == 416:
+            # nothing left to download
+            response.read()
+            break
+        if response.status not in (200, 206):
+            response.read()
+            raise IOError('HTTP error %s for %s' % (response.status, remote))
+        if total is None:
+            total = _response_total(response)
+        if response.status == 200 and offset:
+            if consumer:
+                session.reset(remote)
+                raise IOError('%s does not support resuming a streamed download' % remote)
+            # the server ignored the range, start over
+            offset, sha = 0, hashlib.sha1()
+        f = open(local, 'r+b' if offset else 'wb') if local else None
+        try:
+            if f:
+                f.seek(offset)
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if f:
+                    f.write(chunk)
+                sha.update(chunk)
+                if consumer:
+                    consumer(chunk)
+                offset += len(chunk)
+                limiter.consume(len(chunk))
+                if hook:
+                    hook(offset, 1, total or offset)
+        except (httplib.HTTPException, socket.error) as e:
+            session.reset(remote)
+            if attempt == retries:
+                raise IOError('Download of %s failed: %s' % (remote, e))
+            get_logger().warning('Download of %s interrupted at %s bytes, resuming: %s',
+                                 remote, offset, e)
+            continue
+        except Exception:
+            # e.g. the consumer failed, the rest of the response is not read
+            session.reset(remote)
+            raise
+        finally:
+            if f:
+                f.close()
+        break
+    if total is not None and offset != total:
+        raise IOError('Incomplete download of %s: %s of %s bytes' % (remote, offset, total))
+    return sha
+
+
+def _response_total(response):
+    """Return size of the whole file from the headers of a (range) response"""
+    try:
+        if response.status == 206:
+            size = response.getheader('content-range', '').rpartition('/')[2]
+            return int(size) if size != '*' else None
+        if response.status == 200:
+            return int(response.getheader('content-length'))
+    except (TypeError, ValueError):
+        pass
+    return None
 
-    if silent:
-        curl_cmd += ['-s']
 
-    if continue_:
-        curl_cmd += ['-C', '-']
+def _download_segments(session, remote, local, offset, total, segments, retries, limiter, hook):
+    """Download the file in parallel byte range segments. Progress of every
+    segment is kept in <local>.parts so that an interrupted download resumes."""
+    parts_fnm = local + '.parts'
+    if os.path.exists(parts_fnm):
+        with open(parts_fnm) as f:
+            parts = pickle.load(f)
+    else:
+        size = (total - offset) / segments + 1
+        parts = [[start, min(start + size, total)] for start in xrange(offset, total, size)]
+        with open(local, 'r+b' if offset else 'wb') as f:
+            f.truncate(total)
+        _save_parts(parts_fnm, parts)
+
+    lock = threading.Lock()
+    progress = {'done': total - sum(end - pos for pos, end in parts), 'saved': 0}
+
+    def fetch(part):
+        for attempt in xrange(retries + 1):
+            if part[0] >= part[1]:
+                return
+            response = http_session().open(remote, {'Range': 'bytes=%d-%d' % (part[0], part[1] - 1)})
+            if response.status != 206:
+                http_session().reset(remote)
+                raise IOError('HTTP error %s for a range of %s' % (response.status, remote))
+            try:
+                # unbuffered, so that the persisted progress is always on disk
+                with open(local, 'r+b', 0) as f:
+                    f.seek(part[0])
+                    while part[0] < part[1]:
+                        chunk = response.read(min(DOWNLOAD_CHUNK_SIZE, part[1] - part[0]))
+                        if not chunk:
+                            raise httplib.IncompleteRead(chunk)
+                        f.write(chunk)
+                        limiter.consume(len(chunk))
+                        with lock:
+                            part[0] += len(chunk)
+                            progress['done'] += len(chunk)
+                            done = progress['done']
+                            # persist progress every few MB
+                            if done - progress['saved'] >= 16 * 1024 * 1024:
+                                _save_parts(parts_fnm, parts)
+                                progress['saved'] = done
+                            # the hook is called from one segment at a time
+                            if hook:
+                                hook(done, 1, total)
+            except (httplib.HTTPException, socket.error) as e:
+                http_session().reset(remote)
+                if attempt == retries:
+                    raise IOError('Download of %s failed: %s' % (remote, e))
+                get_logger().warning('Segment of %s interrupted at %s, resuming: %s',
+                                     remote, part[0], e)
 
-    subprocess.call(curl_cmd + curl_file_args)
+    try:
+        parallel_map(fetch, parts, len(parts))
+    finally:
+        with lock:
+            _save_parts(parts_fnm, parts)
+    delete(parts_fnm)
 
 
 def urlopen(remote):
@@ -210,21 +717,141 @@ def urlopen(remote):
     return opener.open(remote)
 
 
-def roll_data(filename, data, default=None):
-    """Save data in a file. Return previous value of the data."""
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as od:
-                res = pickle.load(od)
-            with open(filename, 'w') as od:
-                pickle.dump(data, od)
-            return res
+class _HTTPSession(object):
+    """
+    HTTP(S) client keeping a persistent connection per thread and host.
+    Follows redirects and keeps GET responses for ttl seconds; afterwards they
+    are revalidated with a conditional request (ETag/Last-Modified).
+    """
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, ttl=60, max_redirects=5):
+        self.ttl = ttl
+        self.max_redirects = max_redirects
+        self._local = threading.local()
+        self._cache = {}  # (method, url) -> (timestamp, status, headers, body)
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, netloc, reconnect=False):
+        connections = self._local.__dict__.setdefault('connections', {})
+        key = (scheme, netloc)
+        if reconnect and key in connections:
+            connections.pop(key).close()
+        if key not in connections:
+            host = netloc.rpartition('@')[2]
+            conn_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            proxy = urllib.getproxies().get(scheme)
+            if proxy and not urllib.proxy_bypass(host.split(':')[0]):
+                conn = conn_class(urlparse.urlsplit(proxy).netloc)
+                if scheme == 'https':
+                    conn.set_tunnel(host)
+                else:
+                    conn.use_proxy = True
+            else:
+                conn = conn_class(host)
+            connections[key] = conn
+        return connections[key]
+
+    def _send(self, method, url, headers):
+        """Send the request and return the response with its body unread"""
+        parts = urlparse.urlsplit(url)
+        headers = dict(headers)
+        if parts.username:
+            headers['Authorization'] = 'Basic ' + base64.b64encode(
+                '%s:%s' % (urllib.unquote(parts.username), urllib.unquote(parts.password or '')))
+        for attempt in (0, 1):
+            conn = self._connection(parts.scheme, parts.netloc, reconnect=attempt > 0)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            if getattr(conn, 'use_proxy', False):
+                path = urlparse.urlunsplit((parts.scheme, parts.netloc.rpartition('@')[2],
+                                            path, '', ''))
+            try:
+                conn.request(method, path, headers=headers)
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed an idle keep-alive connection
+                if attempt:
+                    raise
+
+    def _request(self, method, url, headers):
+        response = self._send(method, url, headers)
+        # the body must be consumed before the connection can be reused
+        body = response.read()
+        if response.getheader('connection', '').lower() == 'close':
+            self.reset(url)
+        return response.status, dict(response.getheaders()), body
+
+    def reset(self, url):
+        """Drop the connection of this thread to the host of the URL, e.g. after
+        a response body was not read completely"""
+        parts = urlparse.urlsplit(url)
+        self._connection(parts.scheme, parts.netloc, reconnect=True)
+
+    def open(self, url, headers=None):
+        """Send a GET request following redirects and return the response with
+        its body unread. Read the body completely or reset() the connection."""
+        location = url
+        for _ in xrange(self.max_redirects + 1):
+            response = self._send('GET', location, headers or {})
+            if response.status not in self.REDIRECTS or not response.getheader('location'):
+                return response
+            response.read()
+            location = urlparse.urljoin(location, response.getheader('location'))
+        raise IOError('Too many redirects for %s' % url)
+
+    def request(self, method, url, use_cache=True):
+        """Return (status, headers, body) of the response to the URL"""
+        key = (method, url)
+        with self._lock:
+            cached = self._cache.get(key) if use_cache else None
+        if cached and time.time() - cached[0] < self.ttl:
+            return cached[1:]
+
+        headers = {}
+        if cached and cached[1] == 200:
+            if 'etag' in cached[2]:
+                headers['If-None-Match'] = cached[2]['etag']
+            if 'last-modified' in cached[2]:
+                headers['If-Modified-Since'] = cached[2]['last-modified']
+
+        location = url
+        for _ in xrange(self.max_redirects + 1):
+            status, response_headers, body = self._request(method, location, headers)
+            if status not in self.REDIRECTS or 'location' not in response_headers:
+                break
+            location = urlparse.urljoin(location, response_headers['location'])
+            if status == 303:
+                method = 'GET'
         else:
-            with open(filename, 'w') as od:
-                pickle.dump(data, od)
-            return default
-    except EOFError:
-        return default
+            raise IOError('Too many redirects for %s' % url)
+
+        if status == 304 and cached:
+            status, response_headers, body = cached[1:]
+        with self._lock:
+            self._cache[key] = (time.time(), status, response_headers, body)
+        return status, response_headers, body
+
+
+_http_session = {}
+
+
+def http_session():
+    """Return the shared keep-alive HTTP session"""
+    if 'session' not in _http_session:
+        _http_session['session'] = _HTTPSession(
+            get_config().getfloat('general', 'http_cache_ttl', 60))
+    return _http_session['session']
+
+
+def http_get(url):
+    """Return body of the remote URL, raise IOError if it is not available"""
+    status, _, body = http_session().request('GET', url)
+    if status != 200:
+        raise IOError('HTTP error %s for %s' % (status, url))
+    return body
 
 
 def test_passwordless_ssh(remote_host, port=22):
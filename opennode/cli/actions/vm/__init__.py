@@ -1,24 +1,29 @@
+from contextlib import contextmanager
 from functools import wraps
 from uuid import UUID
 from xml.etree import ElementTree
+import copy
 import libvirt
 import logging
 import os
+import threading
 import time
 import urlparse
 
 from ovf.OvfFile import OvfFile
 
+from opennode.cli.actions import sysresources as sysres
 from opennode.cli.actions.storage import get_pool_path
-from opennode.cli.actions.utils import execute, CommandException
-from opennode.cli.actions.utils import cleanup_files
-from opennode.cli.actions.vm import kvm, openvz
+from opennode.cli.actions.utils import execute
+from opennode.cli.actions.utils import cleanup_files, parallel_map
+from opennode.cli.actions.vm import ctids, events, kvm, openvz, uuidindex
 from opennode.cli.config import get_config
 from opennode.cli.log import get_logger
 
 __all__ = ['autodetected_backends', 'list_vms', 'info_vm', 'start_vm', 'shutdown_vm',
            'destroy_vm', 'reboot_vm', 'suspend_vm', 'resume_vm', 'deploy_vm',
-           'undeploy_vm', 'get_local_templates', 'metrics', 'update_vm']
+           'undeploy_vm', 'get_local_templates', 'metrics', 'update_vm',
+           'connection_stats', 'flatten_vm', 'deploy_vms', 'start_vms', 'shutdown_vms']
 
 
 vm_types = {
@@ -28,7 +33,149 @@ vm_types = {
 }
 
 
-_connections = {}
+# libvirt error codes which mean that the connection itself is broken
+_CONNECTION_ERRORS = set(getattr(libvirt, code) for code in
+                         ('VIR_ERR_NO_CONNECT', 'VIR_ERR_INVALID_CONN',
+                          'VIR_ERR_SYSTEM_ERROR', 'VIR_ERR_RPC')
+                         if hasattr(libvirt, code))
+
+
+class _ConnectionPool(object):
+    """
+    Persistent libvirt connections keyed by URI, shared by the threads using
+    them. get() checks a connection out and release() hands it back. A cached
+    connection is checked for liveness before it is handed out and transparently
+    reopened if it died. Connections are only closed once nobody uses them: at
+    most max_idle unused ones are kept, least recently used ones are closed, and
+    a discarded or replaced connection is closed by its last user.
+    """
+
+    def __init__(self, max_idle=None):
+        self._max_idle = max_idle
+        self._connections = {}  # uri -> cached connection
+        self._users = {}  # connection -> number of checkouts, for all open connections
+        self._last_used = {}  # connection -> when it was last released
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'reused': 0, 'failed': 0, 'closed': 0}
+
+    @property
+    def max_idle(self):
+        # read lazily, so that importing the module doesn't need the config
+        if self._max_idle is None:
+            self._max_idle = get_config().getint('general', 'libvirt_max_idle_connections', 4)
+        return self._max_idle
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+    def _is_alive(self, conn):
+        try:
+            is_alive = getattr(conn, 'isAlive', None)
+            if callable(is_alive):
+                return is_alive() == 1
+            # older libvirt bindings: a cheap remote call as a ping
+            conn.getURI()
+            return True
+        except libvirt.libvirtError:
+            return False
+
+    def _close(self, conn):
+        events.unwatch(conn)
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+        self._count('closed')
+
+    def _unused(self):
+        """Untrack and return the connections to close. Called with the lock held."""
+        cached = set(self._connections.values())
+        unused = [conn for conn, users in self._users.items() if not users and conn not in cached]
+        idle = sorted((conn for conn in cached if not self._users[conn]),
+                      key=lambda conn: self._last_used.get(conn, 0))
+        unused += idle[:max(len(idle) - self.max_idle, 0)]
+        for conn in unused:
+            del self._users[conn]
+            self._last_used.pop(conn, None)
+            for uri, cached_conn in self._connections.items():
+                if cached_conn is conn:
+                    del self._connections[uri]
+        return unused
+
+    def get(self, uri, reopen=False):
+        with self._lock:
+            conn = self._connections.get(uri)
+            if conn is not None:
+                self._users[conn] += 1
+
+        if conn is not None:
+            if not reopen and self._is_alive(conn):
+                self._count('reused')
+                return conn
+            self.discard(uri, conn)
+            self.release(conn)
+
+        try:
+            conn = libvirt.open(uri)
+        except libvirt.libvirtError:
+            self._count('failed')
+            raise
+        self._count('opened')
+        events.opened(conn)
+
+        with self._lock:
+            # a connection cached by another thread meanwhile is replaced and
+            # closed by its last user
+            self._connections[uri] = conn
+            self._users[conn] = 1
+            unused = self._unused()
+        for old in unused:
+            self._close(old)
+        return conn
+
+    def acquire(self, conn):
+        """Check a connection out once more, e.g. for a thread outliving the caller"""
+        with self._lock:
+            if conn in self._users:
+                self._users[conn] += 1
+
+    def release(self, conn):
+        """Hand back a connection returned by get()"""
+        with self._lock:
+            if conn not in self._users:
+                return
+            self._users[conn] -= 1
+            self._last_used[conn] = time.time()
+            unused = self._unused()
+        for old in unused:
+            self._close(old)
+
+    def discard(self, uri, conn=None):
+        """Stop handing out the cached connection (or only conn, if it is still
+        the cached one), e.g. after an error or an out-of-band change. It is
+        closed once it is not used anymore."""
+        with self._lock:
+            if conn is None or self._connections.get(uri) is conn:
+                conn = self._connections.pop(uri, None)
+            else:
+                conn = None
+            unused = self._unused()
+        if conn is not None:
+            # a discarded connection is not the one the caches listen to anymore
+            events.unwatch(conn)
+        for old in unused:
+            self._close(old)
+
+    def handle_error(self, uri, conn, error):
+        """Discard the connection that raised the libvirt error if the error
+        means it is broken. A connection that already replaced it is kept."""
+        if error.get_error_code() in _CONNECTION_ERRORS:
+            get_logger().warning('Dropping broken libvirt connection to %s: %s', uri, error)
+            self.discard(uri, conn)
+
+
+_connections = _ConnectionPool()
 
 
 __context__ = {}
@@ -56,9 +203,13 @@ def vm_method_kw(fun):
         try:
             args = strip_async_func_junk(args)
             return fun(conn, *args, **kwargs)
+        except libvirt.libvirtError as e:
+            _connections.handle_error(backend, conn, e)
+            raise
         finally:
             if backend.startswith('test://') and backend != 'test:///default':
                 _dump_state(conn, '/tmp/func_vm_test_state.xml')
+            _connections.release(conn)
 
     return wrapper
 
@@ -71,9 +222,13 @@ def vm_method(fun):
         try:
             args = strip_async_func_junk(args)
             return fun(conn, *args)
+        except libvirt.libvirtError as e:
+            _connections.handle_error(backend, conn, e)
+            raise
         finally:
             if backend.startswith('test://') and backend != 'test:///default':
                 _dump_state(conn, '/tmp/func_vm_test_state.xml')
+            _connections.release(conn)
 
     return wrapper
 
@@ -100,12 +255,19 @@ def autodetected_backends():
     return auto
 
 
-def _connection(backend):
+def _connection(backend, reopen=False):
+    """Return a pooled connection to the backend, to be handed back with
+    _connections.release() or used through _connected(). Use reopen=True when
+    the cached connection may not know about changes done outside of libvirt."""
     bs = backends()
     assert type(backend) == str
     if bs and (backend not in bs and not backend.startswith('test://')):
         raise Exception("unsupported backend %s" % backend)
 
+    # test driver connections carry their own state, so they are never shared
+    if not backend.startswith('test://'):
+        return _connections.get(backend, reopen=reopen)
+
     conn = libvirt.open(backend)
 
     # implement the 'status="inactive"' extension in the test:/// xml dump
@@ -122,6 +284,16 @@ def _connection(backend):
     return conn
 
 
+@contextmanager
+def _connected(backend, reopen=False):
+    """Check a pooled connection to the backend out for the with block"""
+    conn = _connection(backend, reopen)
+    try:
+        yield conn
+    finally:
+        _connections.release(conn)
+
+
 def _dump_state(conn, filename):
     with open(filename, 'w') as f:
         os.chmod(filename, 0666)
@@ -141,15 +313,40 @@ def dom_dom(conn, uuid):
 
 
 def list_vm_ids(backend):
-    conn = _connection(backend)
-    return map(str, conn.listDefinedDomains() + conn.listDomainsID())
+    with _connected(backend) as conn:
+        return map(str, conn.listDefinedDomains() + conn.listDomainsID())
 
 
 def get_uuid(vm):
     return str(UUID(bytes=vm.UUID()))
 
 
-def _render_vm(conn, vm):
+class _DomainContext(object):
+    """Per-domain data shared by the render helpers. The domain XML is fetched
+    and parsed at most once and the UUID is only computed once."""
+
+    def __init__(self, conn, dom):
+        self.conn = conn
+        self.dom = dom
+        self.uuid = get_uuid(dom)
+        self._xml = None
+        self._diskspace = None
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = ElementTree.fromstring(self.dom.XMLDesc(0))
+        return self._xml
+
+    @property
+    def diskspace(self):
+        """Total size of KVM disks in MB, probed via blockInfo on the open connection"""
+        if self._diskspace is None:
+            self._diskspace = kvm.get_diskspace(self.dom, self.xml)
+        return self._diskspace
+
+
+def _render_vm(conn, vm, inventory=None):
     STATE_MAP = {
        0: "active",
        1: "active",
@@ -172,21 +369,28 @@ def _render_vm(conn, vm):
 
     # vm.info() is a relatively heavy operation, no need to call it multiple times!
     info = vm.info()
+    context = _DomainContext(conn, vm)
+
+    # OpenVZ parameters are read from a batched inventory table (see openvz.get_inventory)
+    ct = {}
+    if conn.getType() == 'OpenVZ':
+        ct = (inventory or {}).get(vm.name()) or \
+                openvz.get_inventory([vm.name()]).get(vm.name(), {})
 
     # TODO: This needs refactoring!
     def vm_name(vm):
         if conn.getType() == 'OpenVZ':
-            return openvz.get_hostname(vm.name())
+            return ct.get('hostname')
         return vm.name()
 
     def vm_template_name(vm):
         if conn.getType() == 'OpenVZ':
-            return openvz.get_template_name(vm.name())
+            return ct.get('template')
 
     def vm_memory(vm):
         # libvirt doesn't work well with openvz
         if conn.getType() == 'OpenVZ':
-            return openvz.get_memory(vm.name())
+            return ct.get('memory')
         # memory is expected in MB
         return info[1] / 1024
 
@@ -195,55 +399,36 @@ def _render_vm(conn, vm):
             return
         # libvirt doesn't work with openvz
         if conn.getType() == 'OpenVZ':
-            return openvz.get_uptime(vm.name())
+            return ct.get('uptime')
         # uptime in s
         return info[4] / 100000000.0
 
     def vm_diskspace(vm):
-        log = get_logger()
         if conn.getType() == 'OpenVZ':
-            return {'/': openvz.get_diskspace(vm.name())}
-        # return a total sum of block devices used by KVM VM
-        # get list of block devices of a file type
-        
-        try:
-            script_path = get_config().getstring('general', 'script_prefix', '/opt/opennode/bin/')
-            cmd = os.path.join(script_path, 'libvirt_detect_domain_devices.sh %s' % vm.name())
-            devices = execute(cmd).split('\n')
-            total_bytes = 0.0
-            for dev_path in devices:
-                if dev_path.strip() == '-':
-                    continue  # simple protection against non-disk base devices
-                cmd = os.path.join(script_path, 'libvirt_get_device_size.sh %s %s' % 
-                                        (vm.name(), dev_path))
-                total_bytes += int(execute(cmd)) / 1024.0 / 1024.0  # we want result to be in MB
-        except CommandException as ce:
-            log.debug('Failed diskspace detection: \'%s\'' % ce)
-            total_bytes = 0.0
-        except ValueError as ve:
-            log.debug('Failed diskspace conversion: \'%s\'' % ve)
-            total_bytes = 0.0
-        return {'/': total_bytes}
+            return {'/': ct.get('diskspace')}
+        # return a total sum of file based block devices used by KVM VM
+        return {'/': context.diskspace}
 
     def vm_swap(vm):
         # we don't support the notion of swap disks for libvirt/KVM for now
         if conn.getType() == 'OpenVZ':
-            return openvz.get_swap(vm.name())
+            return ct.get('swap')
 
     def vm_bmounts(vm):
         if conn.getType() == 'OpenVZ':
-            return openvz.get_bmounts(vm.name())
+            return ct.get('bind_mounts', '')
         return ''
 
     def vm_ctid(vm):
         if conn.getType() == 'OpenVZ':
-            return openvz.get_ctid_by_uuid(conn, get_uuid(vm))
+            # libvirt OpenVZ domains are named after their CTID
+            return vm.name()
         else:
-            return kvm.get_id_by_uuid(conn, get_uuid(vm))
+            return None if vm.ID() < 0 else vm.ID()
 
     def vm_owner(vm):
         if conn.getType() == 'OpenVZ':
-            return openvz.get_owner(conn, get_uuid(vm))
+            return ct.get('owner', '')
 
     def vm_kernel(vm):
         if conn.getType() == 'OpenVZ':
@@ -252,7 +437,7 @@ def _render_vm(conn, vm):
         else:
             return 'unknown'
 
-    return {"uuid": get_uuid(vm),
+    return {"uuid": context.uuid,
             "name": vm_name(vm),
             "memory": vm_memory(vm),
             "uptime": vm_uptime(vm, STATE_MAP[info[0]]),
@@ -265,20 +450,242 @@ def _render_vm(conn, vm):
             "vm_type": conn.getType().lower(),
             "swap": vm_swap(vm),
             "vcpu": info[3],
-            'consoles': [i for i in [_vm_console_vnc(conn, get_uuid(vm)),
-                                     _vm_console_pty(conn, get_uuid(vm))] if i],
-            'interfaces': _vm_interfaces(conn, get_uuid(vm)),
+            'consoles': [i for i in [_vm_console_vnc(conn, context.uuid, context.xml),
+                                     _vm_console_pty(conn, context.uuid, context.xml)] if i],
+            'interfaces': _vm_interfaces(conn, context.uuid, context.xml),
             'ctid': vm_ctid(vm),
             'owner': vm_owner(vm),
             'kernel': vm_kernel(vm)}
 
 
+def _render_vms(conn, vms, inventory=None):
+    """
+    Render domains concurrently on a bounded pool of vm_list_workers threads.
+    A domain that takes longer than vm_render_timeout seconds (e.g. a hung vzctl
+    exec) comes back as an error marker instead of blocking the whole listing.
+    """
+    config = get_config()
+    uri, vm_type = conn.getURI(), conn.getType().lower()
+
+    def timed_out(vm):
+        # same keys as _render_vm, filled with what is known without asking the domain
+        name = vm.name()
+        ct = (inventory or {}).get(name, {})
+        return {'uuid': get_uuid(vm),
+                'name': ct.get('hostname', name),
+                'memory': ct.get('memory'),
+                'uptime': None,
+                'diskspace': {'/': ct.get('diskspace')},
+                'bind_mounts': ct.get('bind_mounts', ''),
+                'template': ct.get('template'),
+                'state': 'unknown',
+                'run_state': 'unknown',
+                'vm_uri': uri,
+                'vm_type': vm_type,
+                'swap': ct.get('swap'),
+                'vcpu': ct.get('vcpu'),
+                'consoles': [dict(type='openvz', cid=name)] if vm_type == 'openvz' else [],
+                'interfaces': [],
+                'ctid': name if vm_type == 'openvz' else None,
+                'owner': ct.get('owner', '') if vm_type == 'openvz' else None,
+                'kernel': None,
+                '_error': 'Timed out while collecting VM information'}
+
+    return _map_domains(conn, lambda vm: _render_vm(conn, vm, inventory), vms,
+                        config.getint('general', 'vm_list_workers', 8),
+                        config.getfloat('general', 'vm_render_timeout', 30), timed_out)
+
+
+def _map_domains(conn, fun, vms, workers, timeout, timed_out):
+    """parallel_map() of fun over domains of the pooled connection. Every call
+    holds the connection itself, as the thread of a call that timed out keeps
+    using it after the caller handed it back."""
+    vms = list(vms)
+    started = []
+
+    def call(vm):
+        started.append(vm)
+        try:
+            return fun(vm)
+        finally:
+            _connections.release(conn)
+
+    for vm in vms:
+        _connections.acquire(conn)
+    try:
+        return parallel_map(call, vms, workers, timeout=timeout, timed_out=timed_out)
+    finally:
+        # calls never started after an error
+        for vm in vms[len(started):]:
+            _connections.release(conn)
+
+
 def _list_vms(conn):
-    online = [_render_vm(conn, vm) for vm in
-               (conn.lookupByID(i) for i in _get_running_vm_ids(conn))]
-    offline = [_render_vm(conn, vm) for vm in
-               (conn.lookupByName(i) for i in _get_stopped_vm_ids(conn))]
-    return online + offline
+    if conn.getType() == 'OpenVZ':
+        # a single vzlist call provides both the list of CTs and their parameters
+        inventory = openvz.get_inventory()
+        ctids = sorted(inventory, key=lambda ctid: (inventory[ctid]['status'] != 'running', int(ctid)))
+        try:
+            vms = [conn.lookupByName(ctid) for ctid in ctids]
+        except libvirt.libvirtError:
+            # CTs created with vzctl are not known to an older pooled connection
+            with _connected(conn.getURI(), reopen=True) as conn:
+                vms = [conn.lookupByName(ctid) for ctid in ctids]
+                return _render_vms(conn, vms, inventory)
+        return _render_vms(conn, vms, inventory)
+
+    vms = [conn.lookupByID(i) for i in _get_running_vm_ids(conn)] + \
+          [conn.lookupByName(i) for i in _get_stopped_vm_ids(conn)]
+    return _render_vms(conn, vms)
+
+
+class _InventoryCache(object):
+    """
+    Rendered VMs of a single backend keyed by UUID.
+
+    On connections delivering libvirt lifecycle events only the domains that
+    changed are rendered again, a define/undefine invalidates the whole list.
+    Backends without reliable events (OpenVZ) are rendered again after
+    vm_cache_ttl seconds; event driven entries expire after vm_cache_max_age.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vms = {}  # uuid -> (rendered vm, render timestamp)
+        self._order = []
+        self._stale = set()
+        self._listed_at = None  # when the whole list was last rendered
+        self._conn = None  # connection we receive events from
+        self._watched = False
+
+    def on_lifecycle_event(self, conn, dom, event, detail):
+        with self._lock:
+            if conn is not self._conn:
+                return
+            if event in (libvirt.VIR_DOMAIN_EVENT_DEFINED, libvirt.VIR_DOMAIN_EVENT_UNDEFINED):
+                self._listed_at = None
+            self._stale.add(get_uuid(dom))
+
+    def invalidate(self, uuid=None):
+        """Mark a single VM or, with no uuid, the whole list as changed"""
+        with self._lock:
+            if uuid is None:
+                self._listed_at = None
+            else:
+                self._stale.add(uuid)
+
+    def _ttl(self):
+        if self._watched:
+            # changes of memory or vcpus are not lifecycle events
+            return get_config().getfloat('general', 'vm_cache_max_age', 30)
+        return get_config().getfloat('general', 'vm_cache_ttl', 30)
+
+    def _attach(self, conn):
+        if conn is self._conn:
+            return
+        # a new (re)opened connection: whatever happened meanwhile was missed
+        watched = events.watch_lifecycle(conn)
+        uri = conn.getURI()
+        if not watched and events.delivers_events(uri) and events.start_event_loop():
+            # opened before the event loop ran, the pool opens one receiving events
+            _connections.discard(uri, conn)
+        with self._lock:
+            self._conn, self._watched = conn, watched
+            self._listed_at = None
+
+    def _store(self, vm, rendered_at):
+        # markers of VMs that failed to render are not worth keeping
+        if vm.get('_error'):
+            self._stale.add(vm['uuid'])
+        if vm['uuid'] not in self._vms:
+            self._order.append(vm['uuid'])
+        self._vms[vm['uuid']] = (vm, rendered_at)
+
+    def _serve(self, uuid):
+        vm, rendered_at = self._vms[uuid]
+        vm = copy.deepcopy(vm)
+        if vm.get('state') == 'active' and vm.get('uptime') is not None:
+            vm['uptime'] += time.time() - rendered_at
+        return vm
+
+    def _refresh(self, conn, uuid):
+        rendered_at = time.time()
+        try:
+            vm = _render_vm(conn, conn.lookupByUUIDString(uuid))
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            vm = None
+        with self._lock:
+            if vm is None:
+                self._vms.pop(uuid, None)
+                if uuid in self._order:
+                    self._order.remove(uuid)
+            else:
+                self._store(vm, rendered_at)
+        return vm
+
+    def list(self, conn):
+        self._attach(conn)
+        with self._lock:
+            valid = self._listed_at is not None and time.time() - self._listed_at < self._ttl()
+            stale, self._stale = self._stale, set()
+
+        if not valid:
+            rendered_at = time.time()
+            vms = _list_vms(conn)
+            with self._lock:
+                self._vms, self._order = {}, []
+                for vm in vms:
+                    self._store(vm, rendered_at)
+                self._listed_at = rendered_at
+            return copy.deepcopy(vms)
+
+        for uuid in stale:
+            self._refresh(conn, uuid)
+        with self._lock:
+            return [self._serve(uuid) for uuid in self._order]
+
+    def info(self, conn, uuid):
+        self._attach(conn)
+        with self._lock:
+            rendered_at = self._vms.get(uuid, (None, 0))[1]
+            if uuid not in self._stale and time.time() - rendered_at < self._ttl():
+                return self._serve(uuid)
+            self._stale.discard(uuid)
+        vm = self._refresh(conn, uuid)
+        if vm is None:
+            # let libvirt report the missing domain as usual
+            conn.lookupByUUIDString(uuid)
+        return copy.deepcopy(vm)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _inventory_cache(conn):
+    """Return the inventory cache of the backend or None if caching is disabled"""
+    uri = conn.getURI()
+    if uri.startswith('test://') or not get_config().getboolean('general', 'vm_cache', True):
+        return None
+    with _caches_lock:
+        if uri not in _caches:
+            _caches[uri] = _InventoryCache()
+            events.add_listener(_caches[uri].on_lifecycle_event)
+        return _caches[uri]
+
+
+def _invalidate(conn, uuid=None):
+    """Forget cached rendering of a VM (or of all VMs) after changing it"""
+    cache = _caches.get(conn.getURI())
+    if cache is not None:
+        cache.invalidate(uuid)
+
+
+def connection_stats():
+    """Return counters of opened, reused, failed and closed libvirt connections"""
+    return dict(_connections.stats)
 
 
 def free_mem():
@@ -293,96 +700,238 @@ def free_mem():
     backends_ = backends()
 
     # Start with the physical memory and subtract
-    memory = _connection(backends_[0]).getInfo()[1]
+    with _connected(backends_[0]) as conn:
+        memory = conn.getInfo()[1]
 
     # Take 256M off which is reserved for Domain-0
     memory = memory - 256
 
-    for conn in (_connection(b) for b in backends_):
-        for vm in (conn.lookupByID(i) for i in conn.listDomainsID()):
-            # Exclude stopped vms and Domain-0 by using
-            # ids greater than 0
-            # NOTE: is this needed ? Seems that with kvm and lxc dom-0 is not
-            # reported
-            if vm.ID() > 0:
-                # This node is active - remove its memory (in bytes)
-                memory = memory - int(vm.info()[2]) / 1024
+    for backend in backends_:
+        with _connected(backend) as conn:
+            for vm in (conn.lookupByID(i) for i in conn.listDomainsID()):
+                # Exclude stopped vms and Domain-0 by using
+                # ids greater than 0
+                # NOTE: is this needed ? Seems that with kvm and lxc dom-0 is not
+                # reported
+                if vm.ID() > 0:
+                    # This node is active - remove its memory (in bytes)
+                    memory = memory - int(vm.info()[2]) / 1024
 
     return memory
 
 
 @vm_method
 def list_vms(conn):
-    return _list_vms(conn)
+    cache = _inventory_cache(conn)
+    if cache is None:
+        return _list_vms(conn)
+    return cache.list(conn)
 
 
 @vm_method
 def info_vm(conn, uuid):
-    dom = conn.lookupByUUIDString(uuid)
-    return _render_vm(conn, dom)
+    cache = _inventory_cache(conn)
+    if cache is None:
+        dom = conn.lookupByUUIDString(uuid)
+        return _render_vm(conn, dom)
+    return cache.info(conn, uuid)
 
 
 @vm_method
 def start_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.create()
+    _invalidate(conn, uuid)
 
 
-@vm_method
-def shutdown_vm(conn, uuid):
+def _shutdown_vm(conn, uuid):
+    started = time.time()
     # XXX hack for OpenVZ because of a bad libvirt driver
     if conn.getType() == 'OpenVZ':
         openvz.shutdown_vm(conn, uuid)
     else:
         dom = conn.lookupByUUIDString(uuid)
         dom.shutdown()
-        try :
-            time.sleep(5*60)
-            dom.destroy()
-        except libvirt.libvirtError as e:
-            logging.error("Got libvirt exception when trying to force shutdown %s. Error code %s"
-                                    % (uuid, e.get_error_code()))
+        if not events.wait_for_shutoff(conn, dom, get_config().getfloat('general', 'shutdown_timeout', 300)):
+            try:
+                dom.destroy()
+            except libvirt.libvirtError as e:
+                logging.error("Got libvirt exception when trying to force shutdown %s. Error code %s"
+                                        % (uuid, e.get_error_code()))
+    _invalidate(conn, uuid)
+    return time.time() - started
+
+
+@vm_method
+def shutdown_vm(conn, uuid):
+    """Shut the VM down, forcing it off if it still runs after shutdown_timeout
+    seconds. Return the number of seconds it took."""
+    elapsed = _shutdown_vm(conn, uuid)
+    get_logger().info('Shut down %s in %.1fs', uuid, elapsed)
+    return elapsed
 
 
 @vm_method
 def destroy_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.destroy()
+    _invalidate(conn, uuid)
 
 
 @vm_method
 def reboot_vm(conn, uuid):
+    """Reboot the VM, by a shutdown and start if the driver can't reboot.
+    Return the number of seconds it took."""
+    started = time.time()
     dom = conn.lookupByUUIDString(uuid)
     try:
         dom.reboot(0)
     except libvirt.libvirtError as e:
         if e.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT:
             dom.shutdown()
-            while True:
-                try:
-                    if dom.info()[0] == 5:
-                        break
-                    time.sleep(1)
-                except libvirt.libvirtError as e:
-                    # see opennode-management #34, or
-                    # https://bugzilla.redhat.com/show_bug.cgi?id=519667
-                    if e.get_error_domain() == libvirt.VIR_FROM_QEMU and \
-                        e.get_error_code() == libvirt.VIR_ERR_OPERATION_FAILED:
-                        continue
-                    raise e
+            if not events.wait_for_shutoff(conn, dom, get_config().getfloat('general', 'shutdown_timeout', 300)):
+                dom.destroy()
             dom.create()
+    _invalidate(conn, uuid)
+    return time.time() - started
 
 
 @vm_method
 def suspend_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.suspend()
+    _invalidate(conn, uuid)
 
 
 @vm_method
 def resume_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.resume()
+    _invalidate(conn, uuid)
+
+
+def _power_candidates(conn):
+    """Return {uuid: (running, starts on boot, boot order)} of all VMs, read
+    with one vzlist call for OpenVZ"""
+    if conn.getType() == 'OpenVZ':
+        return dict((ct['uuid'], (ct['status'] == 'running', ct['onboot'] == 1, ct['bootorder']))
+                    for ct in openvz.get_inventory().itervalues() if ct.get('uuid'))
+    doms = [conn.lookupByID(i) for i in conn.listDomainsID()] + \
+           [conn.lookupByName(i) for i in conn.listDefinedDomains()]
+    return dict((get_uuid(dom), (dom.isActive() == 1, dom.autostart() == 1, None)) for dom in doms)
+
+
+def _power_waves(candidates, uuids, start):
+    """Split the VMs into waves by boot order: higher boot order first, VMs
+    without one last, like vzctl does on boot. Shutdown goes in reverse."""
+    waves = {}
+    for uuid in uuids:
+        # vzlist shows no boot order as ''
+        bootorder = candidates[uuid][2] if candidates[uuid][2] != '' else None
+        waves.setdefault(bootorder, []).append(uuid)
+    order = sorted(waves, key=lambda key: (key is None, -(key or 0)))
+    if not start:
+        order.reverse()
+    return [waves[key] for key in order]
+
+
+def _run_wave(fun, uuids, workers, io_budget):
+    """Apply fun to the VMs on up to workers threads. With an I/O budget
+    (MB/s), the next VM is only started while the disk throughput of the host
+    is below it, so that booting VMs don't starve each other."""
+    if not io_budget:
+        return parallel_map(fun, uuids, workers)
+
+    results = [None] * len(uuids)
+
+    def run(idx):
+        results[idx] = fun(uuids[idx])
+
+    pending = range(len(uuids))
+    running = []
+    sampled_at, io_bytes = time.time(), sysres.get_disk_io_bytes()
+    while pending or running:
+        time.sleep(0.5)
+        running = [t for t in running if t.is_alive()]
+        now, io_now = time.time(), sysres.get_disk_io_bytes()
+        rate = (io_now - io_bytes) / (now - sampled_at) / 1024 ** 2
+        sampled_at, io_bytes = now, io_now
+        # one VM per tick at most, and always one if none is running
+        if pending and len(running) < workers and (rate < io_budget or not running):
+            worker = threading.Thread(target=run, args=(pending.pop(0),))
+            worker.start()
+            running.append(worker)
+    return results
+
+
+def _power_vms(conn, uuids, start, logger=None):
+    """Start (or shut down) the VMs in boot order waves. The VMs of a wave are
+    handled by up to power_workers threads within power_io_budget MB/s of
+    disk throughput (0 for no limit). Without uuids all VMs starting on boot
+    are started, or all running VMs shut down."""
+    log = get_logger()
+    config = get_config()
+    # XXX: unsafe conversion
+    uuids = eval(uuids) if type(uuids) is str else uuids
+
+    candidates = _power_candidates(conn)
+    if uuids is None:
+        uuids = [uuid for uuid, (running, onboot, _) in candidates.iteritems()
+                 if (onboot and not running if start else running)]
+
+    def report(result):
+        msg = '%(uuid)s: %(status)s' % result
+        if result.get('error'):
+            msg += ' (%s)' % result['error']
+        elif result.get('elapsed') is not None:
+            msg += ' in %.1fs' % result['elapsed']
+        log.info(msg)
+        if logger:
+            logger(msg)
+        return result
+
+    results = {}
+    for uuid in uuids:
+        if uuid not in candidates:
+            results[uuid] = report({'uuid': uuid, 'status': 'failed', 'error': 'No such VM'})
+        elif candidates[uuid][0] == start:
+            results[uuid] = report({'uuid': uuid, 'status': 'running' if start else 'stopped'})
+
+    def power(uuid):
+        started = time.time()
+        result = {'uuid': uuid}
+        try:
+            if start:
+                conn.lookupByUUIDString(uuid).create()
+                _invalidate(conn, uuid)
+            else:
+                _shutdown_vm(conn, uuid)
+            result['status'] = 'started' if start else 'stopped'
+        except Exception as e:
+            result['status'], result['error'] = 'failed', str(e)
+        result['elapsed'] = time.time() - started
+        return report(result)
+
+    workers = config.getint('general', 'power_workers', 4)
+    io_budget = config.getfloat('general', 'power_io_budget', 0)
+    for wave in _power_waves(candidates, [uuid for uuid in uuids if uuid not in results], start):
+        for result in _run_wave(power, wave, workers, io_budget):
+            results[result['uuid']] = result
+    return [results[uuid] for uuid in uuids]
+
+
+@vm_method_kw
+def start_vms(conn, uuids=None, **kwargs):
+    """Start VMs in boot order waves, see _power_vms. Return {'uuid', 'status',
+    'elapsed', 'error'} of every VM."""
+    return _power_vms(conn, uuids, True, kwargs.get('logger'))
+
+
+@vm_method_kw
+def shutdown_vms(conn, uuids=None, **kwargs):
+    """Shut VMs down in reverse boot order waves, see _power_vms. Return
+    {'uuid', 'status', 'elapsed', 'error'} of every VM."""
+    return _power_vms(conn, uuids, False, kwargs.get('logger'))
 
 
 @vm_method_kw
@@ -399,17 +948,136 @@ def deploy_vm(conn, *args, **kwargs):
     vm_parameters['nameservers'] = eval(vm_parameters['nameservers'])
 
     _deploy_vm(vm_parameters)
+    _invalidate(conn)
 
     owner = vm_parameters.get('owner')
 
     if owner:
         # XXX: HACK: reconnect to find the newly deployed VM
-        conn = libvirt.open(conn.getType().lower() + ':///system')
-        _set_owner(conn, vm_parameters['uuid'], owner)
+        with _connected(conn.getType().lower() + ':///system', reopen=True) as conn:
+            _set_owner(conn, vm_parameters['uuid'], owner)
 
     return "OK"
 
 
+@vm_method_kw
+def deploy_vms(conn, batch, **kwargs):
+    """
+    Deploy a batch of VMs, each given by a dict of deploy_vm parameters (with
+    kwargs applied to all of them). Templates are parsed once, the whole batch
+    is checked against a single snapshot of the host resources and CTIDs are
+    reserved together, then up to deploy_workers VMs are deployed concurrently.
+    Return {'uuid', 'vm_id', 'status', 'error'} of every VM, in batch order.
+    """
+    from opennode.cli import actions
+    # XXX: unsafe conversion
+    batch = eval(batch) if type(batch) is str else batch
+    assert type(batch) is list, 'Batch must be a list: %s' % batch
+
+    storage_pool = actions.storage.get_default_pool()
+    if storage_pool is None:
+        raise Exception("Storage pool not defined")
+
+    log = get_logger()
+    config = get_config()
+    resources = None
+    if not config.getboolean('general', 'disable_vm_sys_adjustment', False):
+        resources = sysres.get_resources()
+
+    results, prepared = [], []
+    templates, deployed = {}, {}
+    for vm_parameters in batch:
+        vm_parameters = dict(vm_parameters, **kwargs)
+        result = {'uuid': vm_parameters.get('uuid'), 'vm_id': None, 'status': 'failed', 'error': None}
+        results.append(result)
+        try:
+            _check_deploy_parameters(vm_parameters)
+            if not result['uuid']:
+                raise Exception('VM parameters have no uuid')
+            if isinstance(vm_parameters.get('nameservers'), basestring):
+                # XXX: unsafe conversion
+                vm_parameters['nameservers'] = eval(vm_parameters['nameservers'])
+
+            vm_type = vm_parameters['vm_type']
+            if vm_type not in deployed:
+                deployed[vm_type] = _deployed_uuids(vm_type)
+            if result['uuid'] in deployed[vm_type]:
+                raise Exception('A VM with UUID %s is already deployed' % result['uuid'])
+
+            key = (vm_type, vm_parameters['template_name'])
+            if key not in templates:
+                templates[key] = _template_settings(storage_pool, vm_type, key[1])
+            settings = _deploy_settings(templates[key], vm_parameters, resources)
+        except Exception as e:
+            result['error'] = str(e)
+            log.error('Not deploying %s: %s', result['uuid'], e)
+            continue
+
+        if resources is not None:
+            # VMs later in the batch get what is left
+            resources['ram_gb'] -= float(settings['memory'])
+            if vm_type == 'openvz' and resources['disk_gb'] is not None:
+                resources['disk_gb'] -= float(settings['disk'])
+        deployed[vm_type].add(result['uuid'])
+        prepared.append((settings, result))
+
+    cts = [(s, r) for s, r in prepared if s['vm_type'] == 'openvz']
+    if cts:
+        try:
+            allocated = ctids.allocate_many([s['uuid'] for s, _ in cts],
+                                            [s.get('vm_id') or None for s, _ in cts])
+        except ValueError:
+            # a requested CTID is taken, reserve one by one to fail only those VMs
+            allocated = []
+            for s, r in cts:
+                try:
+                    allocated.append(ctids.allocate(s.get('vm_id') or None, s['uuid']))
+                except ValueError as e:
+                    allocated.append(None)
+                    r['error'] = str(e)
+        for (s, r), ctid in zip(cts, allocated):
+            s['vm_id'] = r['vm_id'] = ctid
+        prepared = [(s, r) for s, r in prepared if not r['error']]
+
+    def deploy(item):
+        settings, result = item
+        log.info('Deploying %s', result['uuid'])
+        try:
+            get_module(settings['vm_type']).deploy(settings, storage_pool)
+        except Exception as e:
+            result['error'] = str(e)
+            log.error('Deployment of %s failed: %s', result['uuid'], e)
+            return
+        finally:
+            if settings['vm_type'] == 'openvz':
+                ctids.release(settings['vm_id'])
+        result['status'] = 'deployed'
+        log.info('Deployed %s', result['uuid'])
+
+    parallel_map(deploy, prepared, config.getint('general', 'deploy_workers', 4))
+
+    deployed_by_uri = {}
+    for settings, result in prepared:
+        if result['status'] == 'deployed':
+            uri = 'openvz:///system' if settings['vm_type'] == 'openvz' else 'qemu:///system'
+            deployed_by_uri.setdefault(uri, []).append((settings, result))
+    if 'openvz:///system' in deployed_by_uri:
+        # the new CTs were created with vzctl, so cached connections don't know about them
+        _connections.discard('openvz:///system')
+    for uri, vms in deployed_by_uri.iteritems():
+        # XXX: HACK: reconnect to find the newly deployed VMs
+        with _connected(uri, reopen=True) as vm_conn:
+            for settings, result in vms:
+                if settings.get('owner'):
+                    try:
+                        _set_owner(vm_conn, result['uuid'], settings['owner'])
+                    except Exception as e:
+                        result['error'] = 'Failed to set owner: %s' % e
+            _invalidate(vm_conn)
+    _invalidate(conn)
+    return results
+
+
 @vm_method
 def undeploy_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
@@ -422,10 +1090,32 @@ def undeploy_vm(conn, uuid):
 
     cleanup_list = compile_cleanup(conn, dom) if callable(compile_cleanup) else []
 
+    name = dom.name()
     flags = libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE if conn.getType().lower() == 'kvm' else 0
     dom.undefineFlags(flags)
+    if vm_type == 'openvz':
+        uuidindex.refresh(name)
+    else:
+        uuidindex.refresh_domains(name)
 
     cleanup_files(cleanup_list)
+    _invalidate(conn)
+
+
+@vm_method
+def flatten_vm(conn, uuid):
+    """Copy the template data into the qcow2 overlays of a KVM VM in the
+    background, so that it no longer depends on its template"""
+    if conn.getType() == 'OpenVZ':
+        raise NotImplementedError("VM type '%s' is not (yet) supported" % conn.getType())
+    # the flattening thread keeps using the connection after we return
+    _connections.acquire(conn)
+    try:
+        return kvm.flatten_vm(conn, uuid, done=lambda: _connections.release(conn))
+    except Exception:
+        # no thread was started
+        _connections.release(conn)
+        raise
 
 
 @vm_method
@@ -436,6 +1126,7 @@ def get_local_templates(conn):
         vm_type = 'kvm'
     tmpls = []
     from opennode.cli.actions.templates import get_template_info, get_local_templates as local_templates
+    # settings come from the template catalogue, CTIDs are allocated at deploy time
     for tmpl_name in local_templates(vm_type):
         tmpl_data = get_template_info(tmpl_name, vm_type)
         tmpl_data['template_name'] = tmpl_name
@@ -443,9 +1134,13 @@ def get_local_templates(conn):
     return tmpls
 
 
-def _vm_console_vnc(conn, uuid):
+def _vm_console_vnc(conn, uuid, dom_xml=None):
+    """Return VNC console of the domain. dom_xml is an already parsed domain
+    XML tree, which saves a libvirt round trip when given"""
+    if dom_xml is None:
+        dom_xml = dom_dom(conn, uuid)
     # python 2.6 etree library doesn't support xpath with predicate
-    element = ([i for i in dom_dom(conn, uuid).findall('.//graphics') if \
+    element = ([i for i in dom_xml.findall('.//graphics') if \
                     i.attrib.get('type', None) == 'vnc'] or [None])[0]
     # elementtree element without children is treated as false
     if element is not None:
@@ -456,23 +1151,31 @@ def _vm_console_vnc(conn, uuid):
 vm_console_vnc = vm_method(_vm_console_vnc)
 
 
-def _vm_console_pty(conn, uuid):
+def _vm_console_pty(conn, uuid, dom_xml=None):
+    """Return PTY (or OpenVZ) console of the domain. dom_xml is an already
+    parsed domain XML tree, which saves a libvirt round trip when given"""
+    if dom_xml is None:
+        dom_xml = dom_dom(conn, uuid)
     # python 2.6 etree library doesn't support xpath with predicate
-    element = ([i for i in dom_dom(conn, uuid).findall('.//console') if \
+    element = ([i for i in dom_xml.findall('.//console') if \
                     i.attrib.get('type', None) == 'pty'] or [None])[0]
     if element is not None:
         pty = element.attrib.get('tty', None)
         if pty:
             return dict(type='pty', pty=pty)
     elif conn.getType() == 'OpenVZ':
-        return dict(type='openvz', cid=conn.lookupByUUIDString(uuid).name())
+        return dict(type='openvz', cid=dom_xml.findtext('name'))
 
 
 vm_console_pty = vm_method(_vm_console_pty)
 
 
-def _vm_interfaces(conn, uuid):
-    elements = dom_dom(conn, uuid).findall('.//interface')
+def _vm_interfaces(conn, uuid, dom_xml=None):
+    """Return network interfaces of the domain. dom_xml is an already parsed
+    domain XML tree, which saves a libvirt round trip when given"""
+    if dom_xml is None:
+        dom_xml = dom_dom(conn, uuid)
+    elements = dom_xml.findall('.//interface')
 
     def interface(idx, i):
         type = i.attrib.get('type')
@@ -509,11 +1212,24 @@ vm_interfaces = vm_method(_vm_interfaces)
 @vm_method
 def metrics(conn):
     vm_type = conn.getType().lower()
-    vm_metrics = get_module(vm_type).vm_metrics
+    module = get_module(vm_type)
+    vm_metrics = module.vm_metrics
+    config = get_config()
 
     try:
-        return dict((get_uuid(vm), vm_metrics(conn, vm)) for vm in
-                    (conn.lookupByID(i) for i in conn.listDomainsID()))
+        vms = [conn.lookupByID(i) for i in conn.listDomainsID()]
+        # backends able to collect metrics of all domains in one pass; they
+        # return None when the bulk mode is not supported by libvirt
+        bulk_vm_metrics = getattr(module, 'bulk_vm_metrics', None)
+        bulk = bulk_vm_metrics(conn, vms) if callable(bulk_vm_metrics) else None
+        if bulk is not None:
+            return bulk
+        # a domain that doesn't respond in time gets an error marker
+        results = _map_domains(conn, lambda vm: vm_metrics(conn, vm), vms,
+                               config.getint('general', 'vm_list_workers', 8),
+                               config.getfloat('general', 'vm_render_timeout', 30),
+                               lambda vm: {'_error': 'Timed out while collecting metrics'})
+        return dict(zip(map(get_uuid, vms), results))
     except libvirt.libvirtError:
         return {}
 
@@ -525,14 +1241,8 @@ def get_module(vm_type):
         raise NotImplementedError("VM type '%s' is not (yet) supported" % vm_type)
 
 
-def _deploy_vm(vm_parameters, logger=None):
-    from opennode.cli import actions
-    storage_pool = actions.storage.get_default_pool()
-    if storage_pool is None:
-        raise Exception("Storage pool not defined")
-
+def _check_deploy_parameters(vm_parameters, logger=None):
     assert type(vm_parameters) is dict, 'Parameters must be a dict: %s' % vm_parameters
-    vm_type = vm_parameters['vm_type']
     template = vm_parameters['template_name']
     # convert diskspace from MBs to GBs
     if 'disk' in vm_parameters:
@@ -544,26 +1254,25 @@ def _deploy_vm(vm_parameters, logger=None):
             logger("Cannot deploy because template is '%s'" % (template))
         raise Exception("Cannot deploy because template is '%s'" % (template))
 
+
+def _deployed_uuids(vm_type):
+    """Return UUIDs of the deployed VMs to check new ones against, from the
+    UUID index"""
     if vm_type == 'openvz':
-        uuid = vm_parameters['uuid']
-        try:
-            conn = libvirt.open('openvz:///system')
-            deployed_uuid_list = [ivm['uuid'] for ivm in _list_vms(conn)]
+        return uuidindex.uuids()
+    return uuidindex.domain_uuids()
 
-            if uuid in deployed_uuid_list:
-                msg = ('Deployment failed: a VM with UUID %s is already deployed '
-                       '(%s)' % (uuid, deployed_uuid_list))
-                logging.error(msg)
-                return
-            logging.info('Deploying %s: %s', uuid, deployed_uuid_list)
-        finally:
-            conn.close()
 
+def _template_settings(storage_pool, vm_type, template):
     ovf_file = OvfFile(os.path.join(get_pool_path(storage_pool),
                                     vm_type, "unpacked", template + ".ovf"))
-    vm = actions.vm.get_module(vm_type)
-    settings = vm.get_ovf_template_settings(ovf_file)
+    return get_module(vm_type).get_ovf_template_settings(ovf_file)
+
 
+def _deploy_settings(template_settings, vm_parameters, resources=None, logger=None):
+    """Return deploy settings of a VM from the parsed template settings and the
+    VM parameters, adjusted to the host resources (by default the current ones)"""
+    settings = copy.deepcopy(template_settings)
     settings.update(vm_parameters)
 
     for disk in settings.get("disks", []):
@@ -573,13 +1282,41 @@ def _deploy_vm(vm_parameters, logger=None):
                                                  disk.get('template_format', 'qcow2'))
 
     if not get_config().getboolean('general', 'disable_vm_sys_adjustment', False):
-        errors = vm.adjust_setting_to_systems_resources(settings)
+        errors = get_module(settings['vm_type']).adjust_setting_to_systems_resources(settings, resources)
         if errors:
             if logger:
                 logger("Got %s" % (errors,))
             raise Exception("got errors %s" % (errors,))
+    return settings
 
-    vm.deploy(settings, storage_pool)
+
+def _deploy_vm(vm_parameters, logger=None):
+    from opennode.cli import actions
+    storage_pool = actions.storage.get_default_pool()
+    if storage_pool is None:
+        raise Exception("Storage pool not defined")
+
+    _check_deploy_parameters(vm_parameters, logger)
+    vm_type = vm_parameters['vm_type']
+
+    if vm_type == 'openvz':
+        uuid = vm_parameters['uuid']
+        deployed_uuid_list = sorted(_deployed_uuids(vm_type))
+        if uuid in deployed_uuid_list:
+            msg = ('Deployment failed: a VM with UUID %s is already deployed '
+                   '(%s)' % (uuid, deployed_uuid_list))
+            logging.error(msg)
+            return
+        logging.info('Deploying %s: %s', uuid, deployed_uuid_list)
+
+    settings = _deploy_settings(_template_settings(storage_pool, vm_type, vm_parameters['template_name']),
+                                vm_parameters, logger=logger)
+
+    get_module(vm_type).deploy(settings, storage_pool)
+
+    if vm_type == 'openvz':
+        # the new CT was created with vzctl, so cached connections don't know about it
+        _connections.discard('openvz:///system')
 
 
 def _get_running_vm_ids(conn):
@@ -618,6 +1355,7 @@ def update_vm(conn, uuid, *args, **kwargs):
         openvz_settings.update(dict((param_name_map.get(key, key), value)
                                     for key, value in settings.iteritems()))
         openvz.update_vm(conn, openvz_settings)
+        _invalidate(conn)
         return
 
     dom = conn.lookupByUUIDString(uuid)
@@ -636,6 +1374,7 @@ def update_vm(conn, uuid, *args, **kwargs):
 
     for key, value in settings.iteritems():
         action_map.get(key, unknown_param)(value)
+    _invalidate(conn, uuid)
 
 
 @vm_method_kw
@@ -643,6 +1382,7 @@ def migrate(conn, uuid, target_host, *args, **kwargs):
     """ Migrate VM to another host """
     if conn.getType() == 'OpenVZ':
         openvz.migrate(conn, uuid, target_host, *args, **kwargs)
+        _invalidate(conn)
         return
 
     raise NotImplementedError("VM type '%s' is not (yet) supported" % conn.getType())
@@ -651,7 +1391,9 @@ def migrate(conn, uuid, target_host, *args, **kwargs):
 def _set_owner(conn, uuid, owner):
     vm_type = conn.getType().lower()
     module = get_module(vm_type)
-    return module.set_owner(conn, uuid, owner)
+    result = module.set_owner(conn, uuid, owner)
+    _invalidate(conn, uuid)
+    return result
 
 
 @vm_method
@@ -672,6 +1414,9 @@ def change_ctid(conn, uuid, new_ctid):
         ctid = openvz.get_ctid_by_uuid(conn, uuid)
         get_logger().info('Change ctid from %s to %s', ctid, new_ctid)
         openvz.change_ctid(ctid, new_ctid)
+        # the cached connection still knows the CT under the old CTID
+        _connections.discard(conn.getURI())
+        _invalidate(conn)
     else:
         raise NotImplementedError("VM type '%s' is not (yet) supported" % conn.getType())
 
@@ -699,8 +1444,9 @@ def clone_vm(conn, uuid, *args, **kwargs):
         openvz_settings['uuid'] = openvz.get_uuid_by_ctid(settings['ctid'])
         # XXX: connection to libvirt must be re-opened as old connection does
         # not know about newly created VM.
-        conn = _connection(openvz_settings['vm_uri'])
-        openvz.update_vm(conn, openvz_settings)
+        with _connected(openvz_settings['vm_uri'], reopen=True) as conn:
+            openvz.update_vm(conn, openvz_settings)
+            _invalidate(conn)
         return
     else:
         raise NotImplementedError("VM type '%s' is not (yet) supported" %
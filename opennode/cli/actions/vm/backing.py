@@ -0,0 +1,153 @@
+"""
+qcow2 overlays of KVM template disks.
+
+In the overlay deploy mode the disks of a KVM VM are thin qcow2 images backed
+by the unpacked template disk instead of full copies. The overlays referring
+to a base are recorded per storage pool in images/.backing-refs, so that a
+template still backing a VM is not deleted. References of removed or
+flattened overlays are dropped when they are looked at.
+"""
+
+from contextlib import contextmanager
+from xml.etree import ElementTree as ET
+
+import fcntl
+import os
+import struct
+import threading
+import time
+
+from opennode.cli.actions.utils import execute
+from opennode.cli.log import get_logger
+
+
+REGISTRY = '.backing-refs'
+
+_QCOW2_MAGIC = 'QFI\xfb'
+# magic, version, backing file offset, backing file size, cluster bits, virtual size
+_QCOW2_HEADER = struct.Struct('>4sIQIIQ')
+
+
+def image_info(fnm):
+    """Return (format, virtual size in bytes, backing file) of a disk image,
+    read from the qcow2 header without forking qemu-img"""
+    with open(fnm, 'rb') as f:
+        header = f.read(_QCOW2_HEADER.size)
+        if len(header) < _QCOW2_HEADER.size or not header.startswith(_QCOW2_MAGIC):
+            return 'raw', os.fstat(f.fileno()).st_size, None
+        _, _, backing_offset, backing_size, _, virtual_size = _QCOW2_HEADER.unpack(header)
+        backing = None
+        if backing_offset:
+            f.seek(backing_offset)
+            backing = f.read(backing_size)
+            backing = os.path.normpath(os.path.join(os.path.dirname(fnm), backing))
+        return 'qcow2', virtual_size, backing
+
+
+@contextmanager
+def _registry(images_dir):
+    """Yield the {overlay: base} references of the storage pool under an
+    exclusive lock and save them back if they were changed"""
+    with open(os.path.join(images_dir, REGISTRY), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        refs = dict(line.rstrip('\n').split('\t', 1) for line in f if '\t' in line)
+        original = dict(refs)
+        yield refs
+        if refs != original:
+            f.truncate(0)
+            f.write(''.join('%s\t%s\n' % ref for ref in sorted(refs.items())))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def add_reference(overlay, base):
+    overlay, base = os.path.normpath(overlay), os.path.normpath(base)
+    with _registry(os.path.dirname(overlay)) as refs:
+        refs[overlay] = base
+
+
+def remove_reference(overlay):
+    overlay = os.path.normpath(overlay)
+    with _registry(os.path.dirname(overlay)) as refs:
+        refs.pop(overlay, None)
+
+
+def overlays_of(images_dir, base):
+    """Return the existing overlays of the storage pool backed by base"""
+    if not os.path.isdir(images_dir):
+        return []
+    base = os.path.normpath(base)
+    with _registry(images_dir) as refs:
+        for overlay, backing in refs.items():
+            if backing != base:
+                continue
+            try:
+                if image_info(overlay)[2] == base:
+                    continue
+            except IOError:
+                pass
+            del refs[overlay]
+        return sorted(overlay for overlay, backing in refs.items() if backing == base)
+
+
+def create_overlay(base, overlay, size_gb=None):
+    """Create a qcow2 overlay backed by base with the virtual size of the base
+    or size_gb if that is larger"""
+    base = os.path.normpath(base)
+    base_format, base_size, _ = image_info(base)
+    size = ''
+    if size_gb and int(size_gb) * 1024 ** 3 > base_size:
+        size = '%sG' % int(size_gb)
+    execute("qemu-img create -f qcow2 -o backing_file=%s,backing_fmt=%s %s %s"
+            % (base, base_format, overlay, size))
+    add_reference(overlay, base)
+
+
+def _file_disks(dom):
+    """Return (target device, source file) pairs of the file based disks of a domain"""
+    disks = []
+    for disk in ET.fromstring(dom.XMLDesc(0)).findall('./devices/disk'):
+        source, target = disk.find('./source'), disk.find('./target')
+        if (disk.attrib.get('type') == 'file' and disk.attrib.get('device') == 'disk' and
+                source is not None and source.attrib.get('file') and target is not None):
+            disks.append((target.attrib['dev'], source.attrib['file']))
+    return disks
+
+
+def _flatten(dom, disks, active, done=None):
+    log = get_logger()
+    try:
+        _flatten_disks(dom, disks, active, log)
+    finally:
+        if done:
+            done()
+
+
+def _flatten_disks(dom, disks, active, log):
+    for target, overlay in disks:
+        try:
+            if active:
+                dom.blockPull(target, 0, 0)
+                while dom.blockJobInfo(target, 0):
+                    time.sleep(1)
+            else:
+                execute('qemu-img rebase -b "" %s' % overlay)
+            remove_reference(overlay)
+            log.info('Flattened %s of %s', overlay, dom.name())
+        except Exception as e:
+            log.error('Failed to flatten %s of %s: %s', overlay, dom.name(), e)
+
+
+def flatten(dom, wait=False, done=None):
+    """Copy the data of the bases into the overlays of the domain in the
+    background, by a block pull if it is running or by qemu-img rebase
+    otherwise, making it independent of its templates. done() is called once
+    that is over. Return the overlays being flattened."""
+    disks = [(target, fnm) for target, fnm in _file_disks(dom) if image_info(fnm)[2]]
+    worker = threading.Thread(target=_flatten, args=(dom, disks, dom.isActive(), done),
+                              name='flatten-%s' % dom.name())
+    worker.start()
+    if wait:
+        worker.join()
+    return [fnm for _, fnm in disks]
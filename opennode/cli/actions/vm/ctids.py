@@ -0,0 +1,144 @@
+"""
+Allocation of OpenVZ container IDs.
+
+Used CTIDs are taken from the CT configs in /etc/vz/conf and cached as a
+sorted list until the directory changes, so no vzlist is spawned. A CTID is
+handed out under an flock of the reservation file and reserved for
+ctid_reservation_ttl seconds, so concurrent deploys can't get the same CTID
+before vzctl create has written its config. CTIDs come from ctid_ranges
+(e.g. "101-999, 5000-5999"), after the highest used one of a range or, with
+ctid_fill_gaps, the lowest free one.
+"""
+
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+
+import fcntl
+import os
+import re
+import threading
+import time
+
+from opennode.cli.actions.utils import mkdir_p
+from opennode.cli.config import get_config
+
+
+CONF_DIR = '/etc/vz/conf'
+
+_CONF_NAME = re.compile(r'^(\d+)\.conf$')
+
+_used = {'mtime': None, 'ctids': []}
+_used_lock = threading.Lock()
+
+
+def used_ctids():
+    """Return the sorted list of CTIDs with a config"""
+    with _used_lock:
+        try:
+            mtime = os.stat(CONF_DIR).st_mtime
+        except OSError:
+            return []
+        if mtime != _used['mtime']:
+            _used['ctids'] = sorted(int(m.group(1)) for m in map(_CONF_NAME.match, os.listdir(CONF_DIR))
+                                    if m)
+            _used['mtime'] = mtime
+        return list(_used['ctids'])
+
+
+def _ranges():
+    ranges = []
+    for spec in get_config().getstring('general', 'ctid_ranges', '101-2147483647').split(','):
+        start, _, end = spec.strip().partition('-')
+        ranges.append((int(start), int(end or start)))
+    return ranges
+
+
+def _free_in_range(taken, start, end, fill_gaps):
+    """Return a CTID of the range not in the sorted list taken, or None"""
+    if fill_gaps:
+        candidate, i = start, bisect_left(taken, start)
+        while i < len(taken) and taken[i] == candidate:
+            candidate, i = candidate + 1, i + 1
+    else:
+        i = bisect_right(taken, end)
+        candidate = taken[i - 1] + 1 if i and taken[i - 1] >= start else start
+    return candidate if candidate <= end else None
+
+
+def _pick(taken):
+    fill_gaps = get_config().getboolean('general', 'ctid_fill_gaps', False)
+    ranges = _ranges()
+    for start, end in ranges:
+        ctid = _free_in_range(taken, start, end, fill_gaps)
+        if ctid is not None:
+            return ctid
+    if not fill_gaps:
+        # the ends of all ranges are taken, look for a gap
+        for start, end in ranges:
+            ctid = _free_in_range(taken, start, end, True)
+            if ctid is not None:
+                return ctid
+    raise ValueError("No free CTID left in %s" % ', '.join('%s-%s' % r for r in ranges))
+
+
+@contextmanager
+def _reservations():
+    """Yield the {ctid: (expiry, owner)} reservations under an exclusive lock,
+    with expired ones dropped, and save them back on exit"""
+    fnm = get_config().getstring('general', 'ctid_reservations', '/var/run/opennode/ctid-reservations')
+    mkdir_p(os.path.dirname(fnm))
+    with open(fnm, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        now = time.time()
+        reservations = {}
+        for line in f:
+            values = line.split()
+            if len(values) == 3 and float(values[1]) > now:
+                reservations[int(values[0])] = (float(values[1]), values[2])
+        yield reservations
+        f.truncate(0)
+        f.write(''.join('%s %s %s\n' % (ctid, expiry, owner)
+                        for ctid, (expiry, owner) in sorted(reservations.items())))
+        f.flush()
+
+
+def next_free():
+    """Return the CTID a deploy would get now, without reserving it"""
+    with _reservations() as reservations:
+        return _pick(sorted(set(used_ctids()) | set(reservations)))
+
+
+def allocate(ctid=None, owner=None):
+    """Reserve the given CTID or a free one for owner (e.g. the UUID of the VM)
+    and return it. The reservation lasts until release() or ctid_reservation_ttl
+    seconds; the owner of a reservation may allocate its CTID again."""
+    return allocate_many([owner], [ctid])[0]
+
+
+def allocate_many(owners, requested=None):
+    """Reserve CTIDs for several owners at once, see allocate(). requested
+    optionally gives a CTID (or None) per owner."""
+    ttl = get_config().getint('general', 'ctid_reservation_ttl', 600)
+    requested = requested or [None] * len(owners)
+    allocated = []
+    with _reservations() as reservations:
+        used = set(used_ctids())
+        for owner, ctid in zip(owners, requested):
+            owner = str(owner or '-')
+            if ctid is None:
+                ctid = _pick(sorted(used | set(reservations)))
+            else:
+                ctid = int(ctid)
+                reserved_by = reservations[ctid][1] if ctid in reservations else None
+                if ctid in used or (reserved_by is not None and (owner == '-' or reserved_by != owner)):
+                    raise ValueError("CTID %s is already in use" % ctid)
+            reservations[ctid] = (time.time() + ttl, owner)
+            allocated.append(ctid)
+    return allocated
+
+
+def release(ctid):
+    """Drop the reservation of a CTID, once its config exists or the deploy failed"""
+    with _reservations() as reservations:
+        reservations.pop(int(ctid), None)
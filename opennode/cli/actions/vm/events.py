@@ -0,0 +1,171 @@
+"""
+libvirt domain lifecycle events.
+
+libvirt delivers events only to connections opened after the default event
+implementation was registered and only while its event loop is running. The
+loop is started on demand, by the inventory cache of a backend delivering
+events, and connections opened before are reported by opened() as not
+receiving any.
+"""
+
+import threading
+import time
+import weakref
+
+import libvirt
+
+from opennode.cli.log import get_logger
+
+
+_lock = threading.Lock()
+
+_loop_state = {'started': False, 'available': False}
+
+_watched = weakref.WeakKeyDictionary()  # connection -> callback id
+
+_evented = weakref.WeakKeyDictionary()  # connections opened while the loop ran
+
+# drivers which never send domain events
+_NO_EVENTS = ('openvz://', 'test://')
+
+_listeners = []
+
+
+def start_event_loop():
+    """Register the default libvirt event implementation and run its loop in a
+    daemon thread. Return True if events are available."""
+    with _lock:
+        if _loop_state['started']:
+            return _loop_state['available']
+        _loop_state['started'] = True
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except (AttributeError, libvirt.libvirtError) as e:
+            get_logger().warning('libvirt events are not available: %s', e)
+            return False
+
+        def run():
+            while True:
+                try:
+                    libvirt.virEventRunDefaultImpl()
+                except libvirt.libvirtError as e:
+                    get_logger().error('libvirt event loop failed: %s', e)
+                    time.sleep(1)
+
+        t = threading.Thread(target=run, name='libvirt-event-loop')
+        t.daemon = True
+        t.start()
+        _loop_state['available'] = True
+        return True
+
+
+def delivers_events(uri):
+    """Return True if connections to the URI may deliver domain events"""
+    return not uri.startswith(_NO_EVENTS)
+
+
+def opened(conn):
+    """Note a newly opened connection, it receives events if the loop runs"""
+    if _loop_state['available']:
+        with _lock:
+            _evented[conn] = True
+
+
+def _dispatch(conn, dom, event, detail, opaque):
+    for listener in list(_listeners):
+        try:
+            listener(conn, dom, event, detail)
+        except Exception:
+            get_logger().exception('Failed to handle libvirt event %s of %s', event, dom.name())
+
+
+def watch_lifecycle(conn):
+    """Deliver lifecycle events (start, stop, define, undefine...) of the domains of
+    the connection to the registered listeners. Return False if the driver or the
+    connection doesn't support events (e.g. OpenVZ), or if the connection was
+    opened before the event loop was started."""
+    with _lock:
+        if conn not in _evented:
+            return False
+        if conn in _watched:
+            return True
+        try:
+            _watched[conn] = conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _dispatch, None)
+        except (AttributeError, libvirt.libvirtError) as e:
+            get_logger().debug('Lifecycle events are not supported by %s: %s', conn.getURI(), e)
+            return False
+    return True
+
+
+def unwatch(conn):
+    """Stop delivering events of the connection, before it is closed"""
+    with _lock:
+        callback_id = _watched.pop(conn, None)
+        _evented.pop(conn, None)
+    if callback_id is not None:
+        try:
+            conn.domainEventDeregisterAny(callback_id)
+        except libvirt.libvirtError as e:
+            get_logger().debug('Cannot deregister lifecycle events of %s: %s', conn, e)
+
+
+def add_listener(listener):
+    """Register listener(conn, dom, event, detail) for lifecycle events"""
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def _is_shutoff(dom):
+    try:
+        return dom.info()[0] == libvirt.VIR_DOMAIN_SHUTOFF
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            # a transient domain is gone once it is shut off
+            return True
+        # see opennode-management #34, or
+        # https://bugzilla.redhat.com/show_bug.cgi?id=519667
+        if e.get_error_domain() == libvirt.VIR_FROM_QEMU and \
+                e.get_error_code() == libvirt.VIR_ERR_OPERATION_FAILED:
+            return False
+        raise
+
+
+def wait_for_shutoff(conn, dom, timeout):
+    """Wait at most timeout seconds for the domain to be shut off and return
+    True if it is. Waits for the stopped event on connections delivering
+    events, polls the state at growing intervals on the others. The event loop
+    is not started just for the wait."""
+    uuid = dom.UUIDString()
+    stopped = threading.Event()
+
+    def listener(event_conn, event_dom, event, detail):
+        if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and event_dom.UUIDString() == uuid:
+            stopped.set()
+
+    watched = watch_lifecycle(conn)
+    if watched:
+        add_listener(listener)
+    try:
+        deadline = time.time() + timeout
+        interval = 0.1
+        # the state is checked after registering the listener, so a domain
+        # stopping meanwhile is not missed
+        while not _is_shutoff(dom):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            # with events the state is polled rarely, only in case an event got lost
+            stopped.wait(min(remaining, 5 if watched else interval))
+            stopped.clear()
+            interval = min(interval * 2, 2)
+        return True
+    finally:
+        if watched:
+            remove_listener(listener)
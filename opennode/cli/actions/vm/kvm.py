@@ -5,7 +5,6 @@ from xml.etree import ElementTree as ET
 import libvirt
 import operator
 import os
-import shutil
 import tarfile
 import xml.dom
 
@@ -14,10 +13,10 @@ from ovf.OvfReferencedFile import OvfReferencedFile
 
 from opennode.cli.config import get_config
 from opennode.cli.log import get_logger
-from opennode.cli.actions.utils import execute, get_file_size_bytes, calculate_hash, TemplateException
-from opennode.cli.actions.vm import ovfutil
+from opennode.cli.actions.utils import execute, get_file_size_bytes, calculate_hash, copy_file, TemplateException
+from opennode.cli.actions.vm import backing, ovfutil, uuidindex
 from opennode.cli.actions import sysresources as sysres
-from opennode.cli.actions.utils import roll_data
+from opennode.cli.actions import samples
 
 
 def get_ovf_template_settings(ovf_file):
@@ -102,35 +101,28 @@ def read_ovf_settings(settings, ovf_file):
 
     settings["template_name"] = path.splitext(path.basename(ovf_file.path))[0]
 
-    sys_type, sys_arch = ovfutil.get_vm_type(ovf_file).split("-")
+    ovf_settings = ovfutil.get_ovf_settings(ovf_file)
+    sys_type, sys_arch = ovf_settings.vm_type.split("-")
     if sys_type != "kvm":
         raise TemplateException("The chosen template '%s' cannot run on KVM hypervisor." % sys_type)
     if sys_arch not in ["x86_64", "i686"]:
         raise TemplateException("Template architecture '%s' is not supported." % sys_arch)
     settings["arch"] = sys_arch
 
-    memory_settings = [
-        ("memory_min", ovfutil.get_ovf_min_memory_gb(ovf_file)),
-        ("memory", ovfutil.get_ovf_normal_memory_gb(ovf_file)),
-        ("memory_max", ovfutil.get_ovf_max_memory_gb(ovf_file))]
     # set only those settings that are explicitly specified in the ovf file (non-null)
-    settings.update(dict(filter(operator.itemgetter(1), memory_settings)))
+    for key, field in [("memory_min", "memory_min"), ("memory", "memory"),
+                       ("memory_max", "memory_max"), ("vcpu_min", "vcpu_min"),
+                       ("vcpu_normal", "vcpu"), ("vcpu_max", "vcpu_max")]:
+        if getattr(ovf_settings, field):
+            settings[key] = getattr(ovf_settings, field)
 
-    vcpu_settings = [
-        ("vcpu_min", ovfutil.get_ovf_min_vcpu(ovf_file)),
-        ("vcpu_normal", ovfutil.get_ovf_normal_vcpu(ovf_file)),
-        ("vcpu_max", ovfutil.get_ovf_max_vcpu(ovf_file))]
-    # set only those settings that are explicitly specified in the ovf file (non-null)
-    settings.update(dict(filter(operator.itemgetter(1), vcpu_settings)))
-
-    network_list = ovfutil.get_networks(ovf_file)
-    for network in network_list:
+    for network in ovf_settings.networks:
         settings["interfaces"].append({"type": "bridge", "source_bridge": network["sourceName"]})
 
-    settings["disks"] = ovfutil.get_disks(ovf_file)
-    settings["features"] = ovfutil.get_openode_features(ovf_file)
-    settings['passwd'] = ovfutil.get_root_password(ovf_file)
-    settings['username'] = ovfutil.get_admin_username(ovf_file)
+    settings["disks"] = ovf_settings.disks
+    settings["features"] = ovf_settings.features
+    settings['passwd'] = ovf_settings.root_password
+    settings['username'] = ovf_settings.admin_username
 
     return settings
 
@@ -145,7 +137,7 @@ def deploy(settings, storage_pool):
 
     log.info("Finalyzing KVM template deployment...")
     conn = libvirt.open("qemu:///system")
-    conn.defineXML(libvirt_conf_dom.toxml())
+    uuidindex.refresh_domains(conn.defineXML(libvirt_conf_dom.toxml()).name())
     log.info("Deployment done!")
 
 
@@ -153,7 +145,8 @@ def prepare_file_system(settings, storage_pool):
     """
     Prepare file system for VM template creation in OVF appliance format:
         - create template directory if it does not exist
-        - copy disk based images
+        - copy disk based images, or create qcow2 overlays backed by them
+          in the overlay deploy mode
         - convert block device based images to file based images
     """
     config = get_config()
@@ -162,22 +155,28 @@ def prepare_file_system(settings, storage_pool):
                            storage_pool, "images")
     target_dir = path.join(config.getstring("general", "storage-endpoint"),
                            storage_pool, "kvm", "unpacked")
+    overlay = config.getstring("general", "kvm_deploy_mode", "overlay") == "overlay"
     for disk_index, disk in enumerate(settings.get("disks", [])):
         disk_template_path = path.join(target_dir, disk["template_name"])
         if disk["deploy_type"] == "file":
             volume_name = "disk%s" % disk_index
+            # XXX we assume that the size was already adjusted to the template requirements
+            diskspace = settings.get('disk')
+            if diskspace:
+                diskspace = int(float(diskspace))  # it's str by default. 'string' > int is always true (LEV-116)
+            if overlay:
+                disk["template_format"] = "qcow2"
             disk["source_file"] = '%s-%s-%s.%s' % (settings["hostname"], settings["uuid"],
                                                    volume_name, disk.get('template_format', 'qcow2'))
             disk_deploy_path = path.join(images_dir, disk["source_file"])
-            shutil.copy2(disk_template_path, disk_deploy_path)
+            if overlay:
+                log.info('Creating overlay %s of %s' % (disk_deploy_path, disk_template_path))
+                backing.create_overlay(disk_template_path, disk_deploy_path, diskspace)
+                continue
+            copy_file(disk_template_path, disk_deploy_path)
             # resize disk to match the requested
-            # XXX we assume that the size was already adjusted to the template requirements
-            diskspace = settings.get('disk')
             if diskspace:
-                diskspace = int(float(diskspace))  # it's str by default. 'string' > int is always true (LEV-116)
-                # get the disk size
-                current_size = int(execute("qemu-img info %s |grep 'virtual size' |awk '{print $4}' |cut -b2- "
-                                   % disk_deploy_path)) / 1024 / 1024 / 1024  # to get to GB
+                current_size = backing.image_info(disk_deploy_path)[1] / 1024 / 1024 / 1024  # to get to GB
                 if diskspace > current_size:
                     log.info('Increasing image file %s from %s to %sG' % (disk_deploy_path,
                                                                           current_size, diskspace))
@@ -190,16 +189,19 @@ def prepare_file_system(settings, storage_pool):
             execute("qemu-img convert -f qcow2 -O raw %s %s" % (disk_template_path, disk_deploy_path))
 
 
-def adjust_setting_to_systems_resources(ovf_template_settings):
+def adjust_setting_to_systems_resources(ovf_template_settings, resources=None):
     """
-    Adjusts maximum required resources to match available system resources.
+    Adjusts maximum required resources to match available system resources,
+    by default the current ones.
     NB! Minimum bound is not adjusted.
     """
     st = ovf_template_settings
-    st["memory_max"] = str(min(sysres.get_ram_size_gb(), float(st.get("memory_max", 10 ** 30))))
+    ram_gb = resources['ram_gb'] if resources else sysres.get_ram_size_gb()
+    cpu_count = resources['cpu_count'] if resources else sysres.get_cpu_count()
+    st["memory_max"] = str(min(ram_gb, float(st.get("memory_max", 10 ** 30))))
     st["memory"] = str(min(float(st["memory"]), float(st["memory_max"])))
 
-    st["vcpu_max"] = str(min(sysres.get_cpu_count(), int(st.get("vcpu_max", 10 ** 10))))
+    st["vcpu_max"] = str(min(cpu_count, int(st.get("vcpu_max", 10 ** 10))))
     st["vcpu"] = str(min(int(st["vcpu"]), int(st["vcpu_max"])))
 
     # Checks if minimum required resources exceed maximum available resources
@@ -491,7 +493,11 @@ def _prepare_disks(vm_settings, target_dir):
             new_path = path.join(target_dir, filename)
             if disk_dom.getAttribute("type") == "file":
                 disk_path = source_dom.getAttribute("file")
-                shutil.copy2(disk_path, new_path)
+                if backing.image_info(disk_path)[2]:
+                    # an overlay: the template must not depend on our base
+                    execute("qemu-img convert -O qcow2 %s %s" % (disk_path, new_path))
+                else:
+                    copy_file(disk_path, new_path)
             elif disk_dom.getAttribute("type") == "block":
                 source_dev = source_dom.getAttribute("dev")
                 execute("qemu-img convert -f raw -O qcow2 %s %s" % (source_dev, new_path))
@@ -641,6 +647,34 @@ def _generate_ovf_file(vm_settings):
     return ovf
 
 
+def get_disk_files(dom_xml):
+    """Return source files of the file based block devices of a parsed domain XML"""
+    sources = (disk.find('./source') for disk in dom_xml.findall('./devices/disk')
+               if disk.attrib.get('type') == 'file')
+    return [source.attrib['file'] for source in sources
+            if source is not None and source.attrib.get('file')]
+
+
+def get_diskspace(dom, dom_xml):
+    """Return total capacity of the file based block devices of the domain in MB"""
+    total_bytes = 0.0
+    for disk_file in get_disk_files(dom_xml):
+        try:
+            total_bytes += dom.blockInfo(disk_file, 0)[0]
+        except libvirt.libvirtError as e:
+            get_logger().debug('Failed diskspace detection of %s: \'%s\'', disk_file, e)
+    return total_bytes / 1024.0 / 1024.0  # we want result to be in MB
+
+
+def get_name_by_uuid(conn, uuid):
+    """Return name of the domain with a given UUID"""
+    name = uuidindex.domain_of(uuid)
+    if name is None:
+        # transient domains have no config to index
+        name = conn.lookupByUUIDString(uuid).name()
+    return name
+
+
 def get_id_by_uuid(conn, uuid, backend="qemu:///system"):
     return None if conn.lookupByUUIDString(uuid).ID() < 0 else conn.lookupByUUIDString(uuid).ID()
 
@@ -725,28 +759,101 @@ def get_owner(conn, uuid):
         return owner.text
 
 
-def vm_metrics(conn, vm):
+# bulk stats groups collected by getAllDomainStats/domainListGetStats
+_BULK_STATS = ['VIR_DOMAIN_STATS_CPU_TOTAL', 'VIR_DOMAIN_STATS_BALLOON', 'VIR_DOMAIN_STATS_VCPU',
+               'VIR_DOMAIN_STATS_INTERFACE', 'VIR_DOMAIN_STATS_BLOCK']
 
-    def cpu_usage():
-        hn_stats = conn.getCPUStats(True, 0)
-        if hn_stats is None:
-            return 0.0
 
-        time_now = (vm.getCPUStats(True, 0)[0]['cpu_time'],
-                    sum(hn_stats.itervalues()))
-        time_was = roll_data('/tmp/kvm-vm-cpu-%s' % vm.ID(), time_now, [0] * 6)
-        deltas = [yi - xi for yi, xi in zip(time_now, time_was)]
-        try:
-            cpu_pct = deltas[0] / float(deltas[1])
-        except ZeroDivisionError:
-            cpu_pct = 0
-        return cpu_pct
+def _sum_stats(stats, group, *fields):
+    """Sum per device counters (e.g. net.0.rx.bytes, net.1.rx.bytes) of a bulk stats record"""
+    return [sum(stats.get('%s.%s.%s' % (group, i, field), 0)
+                for i in xrange(stats.get('%s.count' % group, 0)))
+            for field in fields]
+
 
-    def memory_usage():
-        return vm.memoryStats()['rss'] / 1024.0
+def _domain_uptime(name):
+    """Return seconds since the QEMU process of a running domain started, or None"""
+    try:
+        with open('/var/run/libvirt/qemu/%s.pid' % name) as f:
+            pid = int(f.read().strip())
+        with open('/proc/%s/stat' % pid) as f:
+            # starttime is the 22nd field, the 2nd one (comm) may contain spaces
+            start_ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as f:
+            host_uptime = float(f.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+    return host_uptime - start_ticks / float(os.sysconf('SC_CLK_TCK'))
 
-    return {'cpu_usage': cpu_usage(),
-            'memory_usage': memory_usage(),}
+
+def _metrics_from_counters(uuid, counters, memory_kb, host_cpus, uptime=None):
+    """
+    Compute usage from cumulative counters (cpu time in ns, rx, tx, read and
+    written bytes) against the sample history of the domain. Without an
+    earlier sample the cpu usage is the average since the domain started
+    (uptime in s), like for OpenVZ, and the rates are 0.
+    """
+    delta = samples.deltas('kvm-%s' % uuid, counters)
+    if delta is None:
+        rates = [0.0] * 4
+        cpu_usage = min(counters[0] / (uptime * 1e9 * host_cpus), 1.0) if uptime else 0.0
+    else:
+        elapsed, deltas = delta
+        cpu_usage = deltas[0] / (elapsed * 1e9 * host_cpus) if elapsed > 0 else 0.0
+        rates = [d / elapsed if elapsed > 0 else 0.0 for d in deltas[1:]]
+    return {'cpu_usage': cpu_usage,
+            'memory_usage': memory_kb / 1024.0,
+            'network_usage': max(rates[0], rates[1]),
+            'diskio_usage': rates[2] + rates[3]}
+
+
+def bulk_vm_metrics(conn, vms):
+    """
+    Metrics of all given domains fetched with a single domainListGetStats call.
+    Return a dict of metrics keyed by VM UUID or None if the libvirt library
+    or the driver doesn't support bulk stats.
+    """
+    if not vms or not hasattr(conn, 'domainListGetStats') or \
+            not all(hasattr(libvirt, group) for group in _BULK_STATS):
+        return None
+    try:
+        records = conn.domainListGetStats(vms, reduce(operator.or_, [getattr(libvirt, group)
+                                                                      for group in _BULK_STATS]))
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT:
+            return None
+        raise
+
+    host_cpus = conn.getInfo()[2]
+    metrics = {}
+    for dom, stats in records:
+        counters = [stats.get('cpu.time', 0)] + \
+                _sum_stats(stats, 'net', 'rx.bytes', 'tx.bytes') + \
+                _sum_stats(stats, 'block', 'rd.bytes', 'wr.bytes')
+        memory_kb = stats.get('balloon.rss', stats.get('balloon.current', 0))
+        metrics[dom.UUIDString()] = _metrics_from_counters(dom.UUIDString(), counters,
+                                                           memory_kb, host_cpus,
+                                                           _domain_uptime(dom.name()))
+    return metrics
+
+
+def vm_metrics(conn, vm):
+    """Metrics of a single domain, for libvirt versions without bulk stats"""
+    dom_xml = ET.fromstring(vm.XMLDesc(0))
+    counters = [vm.getCPUStats(True, 0)[0]['cpu_time'], 0, 0, 0, 0]
+    for target in dom_xml.findall('./devices/interface/target'):
+        stats = vm.interfaceStats(target.attrib['dev'])
+        counters[1] += stats[0]
+        counters[2] += stats[4]
+    for target in dom_xml.findall('./devices/disk/target'):
+        try:
+            stats = vm.blockStats(target.attrib['dev'])
+        except libvirt.libvirtError:
+            continue  # e.g. an empty cdrom drive
+        counters[3] += stats[1]
+        counters[4] += stats[3]
+    return _metrics_from_counters(vm.UUIDString(), counters, vm.memoryStats().get('rss', 0),
+                                  conn.getInfo()[2], _domain_uptime(vm.name()))
 
 
 def compile_cleanup(conn, vm):
@@ -768,3 +875,8 @@ def compile_cleanup(conn, vm):
             cleanup_list.append(source.attrib.get('file'))
 
     return cleanup_list
+
+
+def flatten_vm(conn, uuid, wait=False, done=None):
+    """Make the disks of the VM independent of the template disks backing them"""
+    return backing.flatten(conn.lookupByUUIDString(uuid), wait, done)
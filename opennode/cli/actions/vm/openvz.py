@@ -1,14 +1,14 @@
 from contextlib import closing
-from hashlib import sha1
 from os import path
-from uuid import UUID
 
 import datetime
-import errno
-import operator
 import os
+import pipes
+import re
 import shutil
+import socket
 import tarfile
+import threading
 import time
 
 from ovf.OvfFile import OvfFile
@@ -17,49 +17,31 @@ from ovf.OvfReferencedFile import OvfReferencedFile
 from opennode.cli.actions import oms
 from opennode.cli.actions import sysresources as sysres
 from opennode.cli.actions.network import list_nameservers
-from opennode.cli.actions.openvz_utils import get_openvz_all_ctids
 from opennode.cli.actions.storage import get_pool_path
-from opennode.cli.actions.utils import SimpleConfigParser, execute, get_file_size_bytes
+from opennode.cli.actions.utils import SimpleConfigParser, execute, ParallelGzipWriter
 from opennode.cli.actions.utils import calculate_hash, CommandException, TemplateException
 from opennode.cli.actions.utils import test_passwordless_ssh, execute2
-from opennode.cli.actions.utils import roll_data
-from opennode.cli.actions.vm import ovfutil
+from opennode.cli.actions import samples
+from opennode.cli.actions.vm import ctids, ovfutil, uuidindex
 from opennode.cli.actions.vm.config_template import openvz_template
 from opennode.cli.config import get_config
 from opennode.cli.log import get_logger
 
 
-def _list_vms(conn):
-    def _get_running_vm_ids(conn):
-        if conn.getType() == 'OpenVZ' and \
-            'missing' == execute("vzlist -H > /dev/null 2>&1; if [  $? -eq 1 ]; then echo missing; fi"):
-            return []
-        else:
-            return conn.listDomainsID()
-
-    def _get_stopped_vm_ids(conn):
-        # XXX a workaround for libvirt's  python API listDefinedDomains function not reportng last OpenVZ VM
-        # correctly on rare occasion
-        if conn.getType() == 'OpenVZ':
-            return execute('vzlist -H -S -o ctid').split()
-        else:
-            return conn.listDefinedDomains()
-
-    online = [str(UUID(bytes=vm.UUID())) for vm in
-               (conn.lookupByID(i) for i in _get_running_vm_ids(conn))]
-    offline = [str(UUID(bytes=vm.UUID())) for vm in
-               (conn.lookupByName(i) for i in _get_stopped_vm_ids(conn))]
-    return online + offline
-
-
 def get_ovf_template_settings(ovf_file):
     """ Parses ovf file and creates a dictionary of settings """
+    settings = read_template_settings(ovf_file)
+    # the CTID is allocated at deploy time
+    settings["vm_id"] = None
+    return settings
+
+
+def read_template_settings(ovf_file):
+    """Settings which depend only on the template, not on the state of the host
+    (e.g. the next free CTID), so that they can be cached in the catalogue"""
     settings = read_default_ovf_settings()
-    ovf_settings = read_ovf_settings(ovf_file)
-    settings.update(ovf_settings)
-    settings["vm_id"] = _get_available_ct_id()
-    # In case of template, both next items should be at default values
-    settings["bind_mounts"] = get_bmounts(settings["vm_id"])
+    settings.update(read_ovf_settings(ovf_file))
+    settings["bind_mounts"] = ''
     settings["ioprio"] = 4
     return settings
 
@@ -92,37 +74,31 @@ def read_ovf_settings(ovf_file):
 
     settings["template_name"] = os.path.splitext(os.path.basename(ovf_file.path))[0]
 
-    vm_type = ovfutil.get_vm_type(ovf_file)
+    ovf_settings = ovfutil.get_ovf_settings(ovf_file)
+    vm_type = ovf_settings.vm_type
     if vm_type != "openvz":
         raise RuntimeError("Given template is not compatible with OpenVZ on OpenNode server")
     settings["vm_type"] = vm_type
 
-    memory_settings = [
-        ("memory_min", ovfutil.get_ovf_min_memory_gb(ovf_file)),
-        ("memory", ovfutil.get_ovf_normal_memory_gb(ovf_file)),
-        ("memory_max", ovfutil.get_ovf_max_memory_gb(ovf_file))]
-
-    # set only those settings that are explicitly specified in the ovf file (non-null)
-    settings.update(dict(filter(operator.itemgetter(1), memory_settings)))
-
-    vcpu_settings = [
-        ("vcpu_min", ovfutil.get_ovf_min_vcpu(ovf_file)),
-        ("vcpu", ovfutil.get_ovf_normal_vcpu(ovf_file)),
-        ("vcpu_max", ovfutil.get_ovf_max_vcpu(ovf_file))]
     # set only those settings that are explicitly specified in the ovf file (non-null)
-    settings.update(dict(filter(operator.itemgetter(1), vcpu_settings)))
+    for key in ("memory_min", "memory", "memory_max", "vcpu_min", "vcpu", "vcpu_max"):
+        if getattr(ovf_settings, key):
+            settings[key] = getattr(ovf_settings, key)
 
-    settings["ostemplate"] = ovfutil.get_ovf_os_type(ovf_file)
+    settings["ostemplate"] = ovf_settings.os_type
 
     # TODO: apparently need to check disks also?
     return settings
 
 
-def adjust_setting_to_systems_resources(ovf_template_settings):
+def adjust_setting_to_systems_resources(ovf_template_settings, resources=None):
     """
-    Adjusts maximum required resources to match available system resources.
+    Adjusts maximum required resources to match available system resources,
+    by default a fresh sysresources.get_resources() snapshot.
     NB! Minimum bound is not adjusted.
     """
+    if resources is None:
+        resources = sysres.get_resources()
 
     def adjusted(norm, minvalue, maxvalue, valtype):
         if minvalue is None:
@@ -132,19 +108,20 @@ def adjust_setting_to_systems_resources(ovf_template_settings):
         return min(max(valtype(norm), valtype(minvalue)), valtype(maxvalue))
 
     st = ovf_template_settings
-    st["memory_max"] = min(sysres.get_ram_size_gb(), float(st.get("memory_max", 10 ** 30)))
+    st["memory_max"] = min(resources['ram_gb'], float(st.get("memory_max", 10 ** 30)))
     st["memory"] = adjusted(st.get("memory"), st.get("memory_min"), st.get("memory_max"), float)
 
-    st["swap_max"] = str(min(sysres.get_swap_size_gb(), float(st.get("swap_max", 10 ** 30))))
+    st["swap_max"] = str(min(resources['swap_gb'], float(st.get("swap_max", 10 ** 30))))
     st["swap"] = adjusted(st.get("swap"), st.get("swap_min"), st.get("swap_max"), float)
 
-    st["vcpu_max"] = str(min(sysres.get_cpu_count(), int(st.get("vcpu_max", 10 ** 10))))
+    st["vcpu_max"] = str(min(resources['cpu_count'], int(st.get("vcpu_max", 10 ** 10))))
     st["vcpu"] = adjusted(st.get("vcpu"), st.get("vcpu_min"), st.get("vcpu_max"), int)
 
-    st["vcpulimit_max"] = min(sysres.get_cpu_usage_limit(), int(st.get("vcpulimit_max", 100)))
+    st["vcpulimit_max"] = min(100 * resources['cpu_count'], int(st.get("vcpulimit_max", 100)))
     st["vcpulimit"] = adjusted(st.get("vcpulimit"), st.get("vcpulimit_min"), st.get("vcputlimit_max"), int)
 
-    st["disk_max"] = min(sysres.get_disc_space_gb(), float(st.get("disk_max", 10 ** 30)))
+    disk_gb = resources['disk_gb'] if resources['disk_gb'] is not None else sysres.get_disc_space_gb()
+    st["disk_max"] = min(disk_gb, float(st.get("disk_max", 10 ** 30)))
     st["disk"] = adjusted(st.get("disk"), st.get("disk_min"), st.get("disk_max"), float)
 
     dns = list_nameservers()
@@ -167,16 +144,6 @@ def adjust_setting_to_systems_resources(ovf_template_settings):
     return errors
 
 
-def _get_available_ct_id():
-    """
-    Get next available IF for new OpenVZ CT
-
-    @return: Next available ID for new OpenVZ CT
-    @rtype: Integer
-    """
-    return max(100, max([0] + get_openvz_all_ctids())) + 1
-
-
 def _compute_diskspace_hard_limit(soft_limit):
     return soft_limit * 1.1 if soft_limit <= 10 else soft_limit + 1
 
@@ -281,8 +248,131 @@ def generate_config(ovf_settings):
     execute("chmod 644 %s" % target_conf_fnm)
 
 
+_HOSTNAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
+
+def _ip(value):
+    address, _, mask = str(value).partition('/')
+    try:
+        socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+    except socket.error:
+        raise ValueError("'%s' is not an IP address" % value)
+    if mask and not mask.isdigit():
+        raise ValueError("'%s' has an invalid netmask" % value)
+    return str(value)
+
+
+def _size_gb(minimum):
+    def check(value):
+        value = float(value)
+        if value < minimum:
+            raise ValueError("must be at least %sG" % minimum)
+        return '%sG' % value
+    return check
+
+
+def _integer(minimum, maximum=None):
+    def check(value):
+        value = int(value)
+        if value < minimum or (maximum is not None and value > maximum):
+            raise ValueError("must be between %s and %s" % (minimum, maximum) if maximum is not None
+                             else "must be at least %s" % minimum)
+        return str(value)
+    return check
+
+
+def _hostname(value):
+    if not value or not _HOSTNAME.match(value):
+        raise ValueError("'%s' is not a valid hostname" % value)
+    return value
+
+
+def _onboot(value):
+    encoded = {1: 'yes', 0: 'no', 'yes': 'yes', 'no': 'no'}.get(value)
+    if encoded is None:
+        raise ValueError("must be yes or no")
+    return encoded
+
+
+def _userpasswd(value):
+    if not value:
+        raise ValueError("password cannot be empty")
+    return pipes.quote('root:%s' % value)
+
+
+# vzctl set options: validation and formatting of the value, and the key and
+# conversion of the current value in get_inventory() for skipping no-op changes
+VZCTL_OPTIONS = {
+    'nameserver': (_ip, None, None),
+    'ipadd': (_ip, None, None),
+    'hostname': (_hostname, 'hostname', str),
+    'userpasswd': (_userpasswd, None, None),
+    'diskspace': (_size_gb(0.001), 'diskspace', lambda mb: '%sG' % (mb / 1024.0)),
+    'ram': (_size_gb(0.001), 'memory', lambda mb: '%sG' % (mb / 1024.0)),
+    'swap': (_size_gb(0), 'swap', lambda mb: '%sG' % (mb / 1024.0)),
+    'cpus': (_integer(1), 'vcpu', str),
+    'cpulimit': (_integer(0), None, None),
+    'onboot': (_onboot, 'onboot', _onboot),
+    'bootorder': (_integer(0), 'bootorder', str),
+    'ioprio': (_integer(0, 7), 'ioprio', str),
+}
+
+
+class _ChangeSet(object):
+    """
+    Options of a CT applied with a single `vzctl set ... --save`, so that the
+    CT config is rewritten and the vzctl lock taken once. Values are validated
+    as they are added; options already at the current value are skipped.
+    """
+
+    def __init__(self, ctid, current=None):
+        self.ctid = ctid
+        self.current = current or {}
+        self.options = []
+        self.errors = []
+
+    def add(self, option, value):
+        check, current_key, convert = VZCTL_OPTIONS[option]
+        values = value if isinstance(value, (list, tuple)) else [value]
+        try:
+            formatted = [check(v) for v in values]
+        except (ValueError, TypeError) as e:
+            self.errors.append((option, "%s: %s" % (option, e)))
+            return self
+        if current_key is not None and self.current.get(current_key) not in (None, ''):
+            try:
+                if [convert(self.current[current_key])] == formatted:
+                    return self
+            except (ValueError, TypeError):
+                pass
+        self.options.extend((option, v) for v in formatted)
+        return self
+
+    def validate(self):
+        if self.errors:
+            raise ValueError("Invalid settings for CT %s: %s"
+                             % (self.ctid, '; '.join(msg for _, msg in self.errors)))
+
+    def apply(self):
+        """Run vzctl set with all changed options. Return False if nothing changed."""
+        self.validate()
+        if not self.options:
+            return False
+        execute("vzctl set %s %s --save" % (self.ctid, ' '.join('--%s %s' % o for o in self.options)))
+        return True
+
+
 def deploy(ovf_settings, storage_pool):
     """ Deploys OpenVZ container """
+    ovf_settings["vm_id"] = ctids.allocate(ovf_settings.get("vm_id") or None, ovf_settings.get("uuid"))
+    try:
+        _deploy(ovf_settings, storage_pool)
+    finally:
+        ctids.release(ovf_settings["vm_id"])
+        uuidindex.refresh(ovf_settings["vm_id"])
+
+
+def _deploy(ovf_settings, storage_pool):
     log = get_logger()
     # make sure we have required template present and symlinked
     link_template(storage_pool, ovf_settings["template_name"])
@@ -291,12 +381,6 @@ def deploy(ovf_settings, storage_pool):
     log.info(msg)
     generate_config(ovf_settings)
 
-    msg = "Creating OpenVZ container..."
-    log.info(msg)
-    create_container(ovf_settings)
-
-    msg = "Deploying..."
-    log.info(msg)
     nameservers = ovf_settings.get("nameservers", None)
     if not nameservers:
         nameservers = [ovf_settings.get("nameserver", '8.8.8.8')]
@@ -304,14 +388,28 @@ def deploy(ovf_settings, storage_pool):
     # XXX a hack to set a working dns if NS is malformed for some reason (OMS-444)
     if (type(nameservers) == str and len(nameservers) < 7):
         nameservers = ['8.8.8.8']
+    if isinstance(nameservers, basestring):
+        nameservers = nameservers.replace(',', ' ').split()
 
-    execute("vzctl set %s %s --save" % (ovf_settings["vm_id"],
-                                        ' '.join('--nameserver %s' % i for i in nameservers)))
-    execute("vzctl set %s --ipadd %s --save" % (ovf_settings["vm_id"], ovf_settings["ip_address"]))
-    execute("vzctl set %s --hostname %s --save" % (ovf_settings["vm_id"], ovf_settings["hostname"]))
+    changes = _ChangeSet(ovf_settings["vm_id"])
+    changes.add('nameserver', list(nameservers))
+    changes.add('ipadd', ovf_settings["ip_address"])
+    changes.add('hostname', ovf_settings["hostname"])
     if len(ovf_settings['passwd']) > 0:
-        execute("vzctl set %s --userpasswd 'root:%s' --save" % (ovf_settings["vm_id"],
-                                                                ovf_settings["passwd"]))
+        changes.add('userpasswd', ovf_settings["passwd"])
+    changes.add('onboot', 1 if ovf_settings.get("onboot", 0) == 1 else 0)
+    if ovf_settings.get("ioprio", 4):
+        changes.add('ioprio', ovf_settings["ioprio"])
+    # fail before the container is created
+    changes.validate()
+
+    msg = "Creating OpenVZ container..."
+    log.info(msg)
+    create_container(ovf_settings)
+
+    msg = "Deploying..."
+    log.info(msg)
+    changes.apply()
 
     msg = "Setting up action scripts..."
     log.info(msg)
@@ -323,14 +421,6 @@ def deploy(ovf_settings, storage_pool):
     if ovf_settings.get("startvm", 0) == 1:
         execute("vzctl start %s" % (ovf_settings["vm_id"]))
 
-    if ovf_settings.get("onboot", 0) == 1:
-        execute("vzctl set %s --onboot yes --save" % (ovf_settings["vm_id"]))
-    else:
-        execute("vzctl set %s --onboot no --save" % (ovf_settings["vm_id"]))
-
-    if ovf_settings.get("ioprio", 4):
-        execute("vzctl set %s --ioprio %d --save" % (ovf_settings["vm_id"], ovf_settings["ioprio"]))
-
     msg = "Template %s deployed successfully!" % ovf_settings["vm_id"]
     log.info(msg)
 
@@ -402,12 +492,11 @@ def link_template(storage_pool, tmpl_name, overwrite=True):
                                'unpacked', tmpl_name)
     dest_file = os.path.join(config.getstring('general', 'openvz-templates'), tmpl_name)
     if overwrite:
-        try:
-            os.unlink(dest_file)
-        except OSError as exc:
-            if exc.errno != errno.ENOENT:
-                raise
-    if not os.path.exists(dest_file):
+        # replace the link atomically, concurrent deploys may be using it
+        tmp_file = '%s.%s-%s' % (dest_file, os.getpid(), threading.current_thread().ident)
+        os.symlink(source_file, tmp_file)
+        os.rename(tmp_file, dest_file)
+    elif not os.path.exists(dest_file):
         os.symlink(source_file, dest_file)
 
 
@@ -428,9 +517,7 @@ def save_as_ovf(vm_settings, storage_pool):
     log = get_logger()
     msg = "Archiving VM container catalog %s. This may take a while..." % ct_source_dir
     log.info(msg)
-    with closing(tarfile.open(ct_archive_fnm, "w:gz")) as tar:
-        for f in os.listdir(ct_source_dir):
-            tar.add(path.join(ct_source_dir, f), arcname=f)
+    checksum, archive_size, populated_size = _archive_container(ct_source_dir, ct_archive_fnm)
 
     # Archive action scripts if they are present
     msg = "Adding action scripts..."
@@ -445,7 +532,7 @@ def save_as_ovf(vm_settings, storage_pool):
     # generate and save ovf configuration file
     msg = "Generating ovf file..."
     log.info(msg)
-    ovf = _generate_ovf_file(vm_settings, ct_archive_fnm)
+    ovf = _generate_ovf_file(vm_settings, ct_archive_fnm, checksum, archive_size, populated_size)
     ovf_fnm = path.join(unpacked_dir, "%s.ovf" % vm_settings["template_name"])
     with open(ovf_fnm, 'w') as f:
         ovf.writeFile(f, pretty=True, encoding='UTF-8')
@@ -463,7 +550,34 @@ def save_as_ovf(vm_settings, storage_pool):
     log.info("Done! Saved template at %s" % ovf_archive_fnm)
 
 
-def _generate_ovf_file(vm_settings, ct_archive_fnm):
+def _archive_container(ct_source_dir, ct_archive_fnm):
+    """
+    Pack the container directory into a gzipped tarball compressed in parallel.
+    The data is read once: SHA1 and size of the archive and the populated size
+    of the directory (as du -s counts it) are computed while packing.
+    """
+    populated_size, seen = 0, set()
+
+    def populate(fnm):
+        st = os.lstat(fnm)
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            return st.st_blocks * 512
+        return 0
+
+    gz = ParallelGzipWriter(ct_archive_fnm)
+    with closing(gz):
+        with closing(tarfile.open(fileobj=gz, mode="w|")) as tar:
+            populated_size += populate(ct_source_dir)
+            for root, dirs, files in os.walk(ct_source_dir):
+                for name in dirs + files:
+                    fnm = path.join(root, name)
+                    populated_size += populate(fnm)
+                    tar.add(fnm, arcname=path.relpath(fnm, ct_source_dir), recursive=False)
+    return gz.sha1.hexdigest(), gz.size, populated_size
+
+
+def _generate_ovf_file(vm_settings, ct_archive_fnm, checksum, archive_size, populated_size):
     ovf = OvfFile()
     # Workaround for broken OvfFile.__init__
     ovf.files = []
@@ -513,36 +627,22 @@ def _generate_ovf_file(vm_settings, ct_archive_fnm):
                 }, bound=bound)
             instanceId += 1
 
-    def get_checksum(fnm):
-        # calculate checksum for the file
-        chunk_size = 1024 ** 2  # 1Mb
-        sha = sha1()
-        with open(fnm) as chkfile:
-            while 1:
-                data = chkfile.read(chunk_size)
-                if not data:
-                    break
-                sha.update(data)
-        return sha.hexdigest()
-
     # add reference a file (see http://gitorious.org/open-ovf/mainline/blobs/master/py/ovf/OvfReferencedFile.py)
     ref_file = OvfReferencedFile(path.dirname(ct_archive_fnm),
                                  path.basename("%s.tar.gz" % vm_settings["template_name"]),
                                  file_id="diskfile1",
-                                 size=str(get_file_size_bytes(ct_archive_fnm)),
+                                 size=str(archive_size),
                                  compression="gz",
-                                 checksum=get_checksum(ct_archive_fnm))
+                                 checksum=checksum)
     ovf.addReferencedFile(ref_file)
     ovf.createReferences()
 
-    def get_ct_disk_usage_bytes(ctid):
-        return str(int(execute("du -s /vz/private/%s/" % ctid).split()[0]) * 1024)
     # add disk section
     ovf.createDiskSection([{
         "diskId": "vmdisk1",
         "capacity": str(round(float(vm_settings["disk"]) * 1024 ** 3)),  # in bytes
         "capacityAllocUnits": None,  # bytes default
-        "populatedSize": get_ct_disk_usage_bytes(vm_settings["vm_name"]),
+        "populatedSize": str(populated_size),
         "fileRef": "diskfile1",
         "parentRef": None,
         "format": "tar.gz"}],
@@ -550,16 +650,168 @@ def _generate_ovf_file(vm_settings, ct_archive_fnm):
     return ovf
 
 
+# vzlist reports page based limits in 4KB pages
+PAGE_SIZE_KB = 4
+
+# XXX: If ONBOOT is unset in conf (default for vzctl) then we use it as no
+ONBOOT_ENCODING = {"yes": 1,
+                   "no": 0,
+                   "-": 0}
+
+# approximate values of manually entered I/O priorities
+IOPRIO_ENCODING = {'0': 0,
+                   '1': 0,
+                   '2': 0,
+                   '3': 0,
+                   '4': 4,
+                   '5': 7,
+                   '6': 7,
+                   '7': 7}
+
+INVENTORY_FIELDS = ['ctid', 'hostname', 'ostemplate', 'privvmpages.l', 'physpages.l',
+                    'swappages.l', 'diskspace.s', 'cpus', 'cpulimit', 'onboot',
+                    'bootorder', 'ioprio', 'status']
+
+
+def _pages_to_mb(pages):
+    return int(pages) * PAGE_SIZE_KB / 1024
+
+
+def _memory_mb(privvmpages, physpages):
+    res = _pages_to_mb(privvmpages)
+    if res >= 2 ** 31 or res == 0:
+        res = _pages_to_mb(physpages)
+    return res
+
+
+def _bootorder(value):
+    return int(value) if value.isdigit() else ''
+
+
+def _ioprio(value):
+    return 4 if value == '-' else IOPRIO_ENCODING[value]
+
+
+def _cpulimit(limit, cpus):
+    return int(limit) / int(cpus)
+
+
+def _parse_inventory_row(values):
+    """Convert a line of vzlist output into CT parameters in the units used
+    by the single-value getters (get_memory, get_swap, etc)"""
+    raw = dict(zip(INVENTORY_FIELDS, values))
+
+    def converted(fun, *fields):
+        try:
+            return fun(*[raw[f] for f in fields])
+        except (ValueError, KeyError, ZeroDivisionError):
+            return None
+
+    return {'ctid': raw['ctid'],
+            'hostname': raw['hostname'],
+            'template': raw['ostemplate'],
+            'memory': converted(_memory_mb, 'privvmpages.l', 'physpages.l'),
+            'swap': converted(_pages_to_mb, 'swappages.l'),
+            'diskspace': converted(lambda v: float(v) / 1024, 'diskspace.s'),
+            'vcpu': converted(int, 'cpus'),
+            'vcpulimit': converted(_cpulimit, 'cpulimit', 'cpus'),
+            'onboot': ONBOOT_ENCODING.get(raw['onboot'], 0),
+            'bootorder': _bootorder(raw['bootorder']),
+            'ioprio': converted(_ioprio, 'ioprio'),
+            'status': raw['status']}
+
+
+def _read_vestat():
+    """Return (user, nice, system, uptime) in clock ticks of running CTs as
+    reported by /proc/vz/vestat"""
+    vestat = {}
+    try:
+        with open('/proc/vz/vestat') as f:
+            lines = f.readlines()
+    except IOError:
+        return vestat
+    for line in lines:
+        values = line.split()
+        # VEID user nice system uptime ...; skip version and header lines
+        if len(values) > 4 and values[0].isdigit():
+            vestat[values[0]] = tuple(int(v) for v in values[1:5])
+    return vestat
+
+
+def _read_vestat_uptimes():
+    """Return uptime in seconds of running CTs as reported by /proc/vz/vestat"""
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    return dict((ctid, values[3] / ticks) for ctid, values in _read_vestat().iteritems())
+
+
+def _read_ct_config(ctid):
+    """Return ON_BMOUNT, ON_OWNER and UUID of the CT with a single read of its config"""
+    res = {'bind_mounts': '', 'owner': '', 'uuid': None}
+    try:
+        with open('/etc/vz/conf/%s.conf' % ctid) as f:
+            lines = f.readlines()
+    except IOError:
+        return res
+    for line in lines:
+        if line.startswith('#UUID:'):
+            res['uuid'] = line.split(':', 1)[1].strip()
+            continue
+        option, sep, value = line.split('#', 1)[0].partition('=')
+        if not sep:
+            continue
+        option = option.strip()
+        if option == 'ON_BMOUNT':
+            res['bind_mounts'] = value.strip().strip('"')
+        elif option == 'ON_OWNER':
+            res['owner'] = value.strip().replace('"', '')
+    return res
+
+
+def get_inventory(ctids=None):
+    """
+    Return a table of CT parameters keyed by CTID. All parameters are collected
+    with a single vzlist call, uptime is read from /proc/vz/vestat and bind mounts
+    and owner from one read of the CT config, so the number of spawned processes
+    does not depend on the number of containers.
+
+    @param ctids: limit the query to the given CTIDs (all CTs by default)
+    """
+    cmd = "vzlist -H -o %s" % ','.join(INVENTORY_FIELDS)
+    cmd += (' ' + ' '.join(map(str, ctids))) if ctids else ' -a'
+    try:
+        output = execute(cmd)
+    except CommandException as ce:
+        if ce.code == 256:  # no containers found
+            return {}
+        raise
+
+    uptimes = _read_vestat_uptimes()
+    inventory = {}
+    for line in output.splitlines():
+        values = line.split()
+        if len(values) != len(INVENTORY_FIELDS):
+            continue
+        ct = _parse_inventory_row(values)
+        ctid = ct['ctid']
+        if ct['status'] == 'running':
+            ct['uptime'] = uptimes[ctid] if ctid in uptimes else get_uptime(ctid)
+        else:
+            ct['uptime'] = 0
+        ct.update(_read_ct_config(ctid))
+        inventory[ctid] = ct
+    return inventory
+
+
 def get_swap(ctid):
     """Swap memory in MB"""
-    return int(execute("vzlist %s -H -o swappages.l" % ctid)) * 4 / 1024
+    return _pages_to_mb(execute("vzlist %s -H -o swappages.l" % ctid))
 
 
 def get_memory(ctid):
     """Max memory in MB"""
-    res = int(execute("vzlist %s -H -o privvmpages.l" % ctid)) * 4 / 1024
+    res = _pages_to_mb(execute("vzlist %s -H -o privvmpages.l" % ctid))
     if res >= 2 ** 31 or res == 0:
-        res = int(execute("vzlist %s -H -o physpages.l" % ctid)) * 4 / 1024
+        res = _pages_to_mb(execute("vzlist %s -H -o physpages.l" % ctid))
     return res
 
 
@@ -570,17 +822,12 @@ def get_diskspace(ctid):
 
 def get_onboot(ctid):
     """Return onboot parameter of a specified CT"""
-    # XXX: If ONBOOT is unset in conf (default for vzctl) then we use it as no
-    encoding = {"yes": 1,
-                "no": 0,
-                "-": 0}
-    return encoding[execute("vzlist %s -H -o onboot" % ctid).strip()]
+    return ONBOOT_ENCODING[execute("vzlist %s -H -o onboot" % ctid).strip()]
 
 
 def get_bootorder(ctid):
     """Return the boot order of the container or None, if it's not defined"""
-    order = execute("vzlist %s -H -o bootorder" % ctid).strip()
-    return int(order) if order.isdigit() else ''
+    return _bootorder(execute("vzlist %s -H -o bootorder" % ctid).strip())
 
 
 def get_uptime(ctid):
@@ -593,9 +840,8 @@ def get_uptime(ctid):
 
 def get_cpulimit(ctid):
     """Max CPU usage limit"""
-    limit = int(execute("vzlist %s -H -o cpulimit" % ctid))
-    cpus = int(execute("vzlist %s -H -o cpus" % ctid))
-    return limit / cpus
+    limit, cpus = execute("vzlist %s -H -o cpulimit,cpus" % ctid).split()
+    return _cpulimit(limit, cpus)
 
 
 def detect_os(ctid):
@@ -611,20 +857,7 @@ def get_vcpu(ctid):
 def get_ioprio(ctid):
     """ Get VM I/O priority. If priority is entered manually
     or elsewhere, return approximate value based on value table"""
-    value = {'0': 0,
-             '1': 0,
-             '2': 0,
-             '3': 0,
-             '4': 4,
-             '5': 7,
-             '6': 7,
-             '7': 7
-              }
-    rv = execute("vzlist %s -H -o ioprio" % ctid).strip()
-    if rv == '-':
-        return 4
-    else:
-        return value[rv]
+    return _ioprio(execute("vzlist %s -H -o ioprio" % ctid).strip())
 
 
 def _update_bmounts(vm_id, bind_mounts):
@@ -672,64 +905,60 @@ def set_owner(conn, uuid, owner):
 def update_vm(conn, settings):
     """Perform modifications to the VM virtual hardware"""
     vm_id = get_ctid_by_uuid(conn, settings["uuid"])
+    changes = _ChangeSet(vm_id, get_inventory([vm_id]).get(str(vm_id)))
     if settings.get("diskspace"):
-        disk = float(settings["diskspace"])
-        execute("vzctl set %s --diskspace %sG --save" % (vm_id, disk))
+        changes.add('diskspace', settings["diskspace"])
     if settings.get("vcpu"):
-        execute("vzctl set %s --cpus %s --save" % (vm_id, int(settings.get("vcpu"))))
+        changes.add('cpus', settings["vcpu"])
     if settings.get("memory"):
-        mem = float(settings.get("memory"))
-        execute("vzctl set %s --ram %sG --save" % (vm_id, mem))
+        changes.add('ram', settings["memory"])
     if settings.get("swap"):
-        mem = float(settings.get("swap"))
-        execute("vzctl set %s --swap %sG --save" % (vm_id, mem))
+        changes.add('swap', settings["swap"])
     if "onboot" in settings:
-        vals = {0: "no",
-                1: "yes"}
-        execute("vzctl set %s --onboot %s --save" % (vm_id,
-                                                     vals[settings["onboot"]]))
+        changes.add('onboot', settings["onboot"])
     if settings.get("bootorder"):
-        order = int(settings.get("bootorder"))
-        execute("vzctl set %s --bootorder %s --save" % (vm_id, order))
+        changes.add('bootorder', settings["bootorder"])
 
     if settings.get("vcpulimit"):
-        vcpulimit = int(settings.get("vcpulimit"))
-        if "vcpu" in settings:
-            execute("vzctl set %s --cpulimit %d --save" %
-                    (vm_id, int(vcpulimit) * int(settings.get("vcpu"))))
-        else:
-            execute("vzctl set %s --cpulimit %s --save" % (vm_id, vcpulimit))
+        vcpulimit = settings["vcpulimit"]
+        if "vcpu" in settings and str(vcpulimit).isdigit() and str(settings["vcpu"]).isdigit():
+            vcpulimit = int(vcpulimit) * int(settings["vcpu"])
+        changes.add('cpulimit', vcpulimit)
+
+    if settings.get("hostname") and settings.get("hostname") != settings.get("name"):
+        # XXX: Execute only if hostname is changed.
+        changes.add('hostname', settings['hostname'])
+
+    if settings.get("ioprio") is not None and str(settings["ioprio"]) != str(settings.get("ioprio_old")):
+        changes.add('ioprio', settings["ioprio"])
+
+    changes.apply()
 
     if settings.get("bind_mounts") is not None:
         _update_bmounts(vm_id, settings["bind_mounts"])
 
-    if settings.get("hostname") != settings.get("name"):
-        # XXX: Execute only if hostname is changed.
-        execute("vzctl set %s --hostname %s --save" % (vm_id,
-                                                       settings['hostname']))
-
-    if settings.get("ioprio") is not None:
-        ioprio = int(settings.get("ioprio"))
-        if settings.get("ioprio_old") is not None:
-            if ioprio != int(settings.get("ioprio_old")):
-                execute("vzctl set %s --ioprio %s --save" % (vm_id, ioprio))
-        else:
-            execute("vzctl set %s --ioprio %s --save" % (vm_id, ioprio))
-
     if settings.get('ctid') is not None and \
             settings.get('ctid_old') is not None:
         if settings.get('ctid') != settings.get('ctid_old'):
-            execute('vzmlocal %(ctid_old)s:%(ctid)s' % settings)
+            change_ctid(settings['ctid_old'], settings['ctid'])
 
 
 def get_uuid_by_ctid(ctid):
     """Return UUID of the VM"""
-    return execute("grep \#UUID: /etc/vz/conf/%s.conf" % ctid).split(" ")[1]
+    uuid = uuidindex.uuid_of(ctid)
+    if uuid is None:
+        raise CommandException("No UUID in the config of CT %s" % ctid)
+    return uuid
 
 
 def get_ctid_by_uuid(conn, uuid):
     """Return container ID with a given UUID"""
-    return conn.lookupByUUIDString(uuid).name()
+    ctid = uuidindex.ctid_of(uuid)
+    if ctid is None:
+        # libvirt adds the UUID marker to the config
+        ctid = conn.lookupByUUIDString(uuid).name()
+        uuidindex.refresh(ctid)
+    return ctid
 
 
 def get_bmounts(ctid):
@@ -826,51 +1055,180 @@ def _get_remote_max_ctid(remote_host):
 
 
 def change_ctid(ctid, new_ctid):
-    execute('vzmlocal %s:%s' % (ctid, new_ctid))
+    try:
+        execute('vzmlocal %s:%s' % (ctid, new_ctid))
+    finally:
+        uuidindex.refresh(ctid, new_ctid)
 
 
 def clone_vm(ctid, new_ctid):
-    execute('vzmlocal -C %s:%s' % (ctid, new_ctid))
-
-
-def vm_metrics(conn, vm):
-
-    def cpu_usage():
-        time_list_now = map(int,
-                            execute("vzctl exec %s \"head -n 1 /proc/stat\"" % vm.ID()).split(' ')[2:6])
-        time_list_was = roll_data('/tmp/openvz-vm-cpu-%s' % vm.ID(), time_list_now, [0] * 6)
-        deltas = [yi - xi for yi, xi in zip(time_list_now, time_list_was)]
-        try:
-            cpu_pct = 1 - (float(deltas[-1]) / sum(deltas))
-        except ZeroDivisionError:
-            cpu_pct = 0
-        return cpu_pct
+    ctids.allocate(new_ctid)
+    try:
+        execute('vzmlocal -C %s:%s' % (ctid, new_ctid))
+    finally:
+        ctids.release(new_ctid)
+        uuidindex.refresh(new_ctid)
+
+
+def _read_beancounters(resource):
+    """Return the held value of a beancounter resource of all running CTs"""
+    held = {}
+    ctid = None
+    with open('/proc/user_beancounters') as f:
+        for line in f:
+            values = line.split()
+            if values and values[0].endswith(':') and values[0][:-1].isdigit():
+                ctid = values[0][:-1]
+                values = values[1:]
+            if ctid is not None and len(values) > 1 and values[0] == resource:
+                held[ctid] = int(values[1])
+    return held
+
+
+def _read_bc_meminfo(ctid):
+    """Return used memory of the CT without buffers and page cache in MB as
+    reported by /proc/bc/<ctid>/meminfo, or None if it is not available"""
+    info = {}
+    try:
+        with open('/proc/bc/%s/meminfo' % ctid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if value:
+                    info[key.strip()] = int(value.split()[0])
+    except (IOError, ValueError):
+        return None
+    if 'MemTotal' not in info or 'MemFree' not in info:
+        return None
+    return (info['MemTotal'] - info['MemFree'] - info.get('Buffers', 0) -
+            info.get('Cached', 0)) / 1024.0
+
+
+def _read_vzquota_usage():
+    """Return disk usage in MB of CTs with a simfs quota from /proc/vz/vzquota"""
+    usage = {}
+    ctid = None
+    try:
+        with open('/proc/vz/vzquota') as f:
+            for line in f:
+                values = line.split()
+                if values and values[0].endswith(':') and values[0][:-1].isdigit():
+                    ctid = values[0][:-1]
+                elif ctid is not None and len(values) > 1 and values[0] == '1k-blocks':
+                    usage[ctid] = int(values[1]) / 1024.0
+    except IOError:
+        pass
+    return usage
 
-    def load():
-        return float(execute("vzctl exec %s \"cat /proc/loadavg | awk '{print \$1}'\"" % vm.ID()))
 
-    def memory_usage():
-        return float(execute("vzctl exec %s \"free | tail -n 2 | head -n 1 |"
-                             " awk '{print \$3 / 1024}'\"" % vm.ID()))
+def _root_diskspace_usage(ctid):
+    """Return used space in MB of the mounted CT root, e.g. of ploop CTs"""
+    try:
+        st = os.statvfs('/vz/root/%s' % ctid)
+    except OSError:
+        return None
+    return (st.f_blocks - st.f_bfree) * st.f_frsize / 1024.0 / 1024
+
+
+def _read_vznetstat():
+    """Return (input bytes, output bytes) of running CTs summed over all net classes"""
+    lines = execute('vznetstat').splitlines()
+    if not lines:
+        return {}
+    header = lines[0].split()
+    ctid_col, in_col, out_col = [header.index(h) for h in ('CTID', 'Input(bytes)', 'Output(bytes)')]
+    stats = {}
+    for line in lines[1:]:
+        values = line.split()
+        if len(values) <= max(ctid_col, in_col, out_col) or not values[ctid_col].isdigit():
+            continue
+        rx, tx = stats.get(values[ctid_col], (0, 0))
+        stats[values[ctid_col]] = (rx + int(values[in_col]), tx + int(values[out_col]))
+    return stats
+
+
+def _read_loadavg_and_cpus():
+    """Return (1 minute load average, number of CPUs) of running CTs"""
+    result = {}
+    host_cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+    try:
+        output = execute('vzlist -H -o ctid,laverage,cpus')
+    except CommandException as ce:
+        if ce.code == 256:  # no running containers
+            return result
+        raise
+    for line in output.splitlines():
+        values = line.split()
+        if len(values) != 3:
+            continue
+        cpus = int(values[2]) if values[2].isdigit() else host_cpus
+        result[values[0]] = (float(values[1].split('/')[0]), min(cpus, host_cpus))
+    return result
 
-    def network_usage():
-        def get_netstats():
-            return [int(v) for v in execute("vzctl exec %s \"cat /proc/net/dev|grep venet0 | "
-                                            "awk -F: '{print \$2}' | awk '{print \$1, \$9}'\""
-                                            % vm.ID()).split(' ')]
 
-        t2, (rx2, tx2) = time.time(), get_netstats()
-        t1, rx1, tx1 = roll_data("/tmp/openvz-vm-network-%s" % vm.ID(), (t2, rx2, tx2), (0, 0, 0))
+def bulk_vm_metrics(conn, vms):
+    """
+    Metrics of running CTs read from the host side in a single pass over
+    vestat, beancounters, vzquota and vznetstat, without entering the CTs.
+    Return a dict of metrics keyed by VM UUID. A metric whose source can't
+    be read is None.
+    """
+    if not vms:
+        return {}
 
-        window = t2 - t1
-        return ((rx2 - rx1) / window, (tx2 - tx1) / window)
+    def read(source, *args):
+        try:
+            return source(*args)
+        except (CommandException, IOError, ValueError) as e:
+            get_logger().warning('Failed to read CT metrics with %s: %s', source.__name__, e)
+            return None
+
+    vestat = read(_read_vestat)
+    physpages = read(_read_beancounters, 'physpages') or {}
+    quota = read(_read_vzquota_usage)
+    netstat = read(_read_vznetstat)
+    loadavg = read(_read_loadavg_and_cpus)
+
+    def cpu_usage(ctid, uuid, cpus):
+        if vestat is None:
+            return None
+        if ctid not in vestat:
+            return 0
+        user, nice, system, uptime = vestat[ctid]
+        time_now = (user + nice + system, uptime)
+        # without an earlier sample the average since CT start is reported
+        deltas = (samples.deltas('openvz-cpu-%s' % uuid, time_now) or (None, time_now))[1]
+        try:
+            return min(float(deltas[0]) / deltas[1] / cpus, 1.0)
+        except ZeroDivisionError:
+            return 0
+
+    def memory_usage(ctid):
+        used = _read_bc_meminfo(ctid)
+        if used is None and ctid in physpages:
+            used = _pages_to_mb(physpages[ctid])
+        return used
+
+    def network_usage(ctid, uuid):
+        if netstat is None:
+            return None
+        if ctid not in netstat:
+            return 0
+        return max(samples.rates('openvz-network-%s' % uuid, netstat[ctid]) or (0, 0))
+
+    def diskspace_usage(ctid):
+        return quota[ctid] if quota and ctid in quota else _root_diskspace_usage(ctid)
+
+    metrics = {}
+    for vm in vms:
+        ctid, uuid = vm.name(), vm.UUIDString()
+        load, cpus = (None, 1) if loadavg is None else loadavg.get(ctid, (0.0, 1))
+        metrics[uuid] = dict(cpu_usage=cpu_usage(ctid, uuid, cpus),
+                             load=load,
+                             memory_usage=memory_usage(ctid),
+                             network_usage=network_usage(ctid, uuid),
+                             diskspace_usage=diskspace_usage(ctid))
+    return metrics
 
-    def diskspace_usage():
-        return float(execute("vzctl exec %s \"df -P | grep ' /\$' | head -n 1 | "
-                             "awk '{print \$3/1024}'\"" % vm.ID()))
 
-    return dict(cpu_usage=cpu_usage(),
-                load=load(),
-                memory_usage=memory_usage(),
-                network_usage=max(network_usage()),
-                diskspace_usage=diskspace_usage())
+def vm_metrics(conn, vm):
+    return bulk_vm_metrics(conn, [vm])[vm.UUIDString()]
@@ -3,190 +3,233 @@
 """
 
 import os
-from ovf import Ovf, OvfLibvirt
+import re
+from collections import namedtuple
 
 from opennode.cli.actions.utils import calculate_hash, save_to_tar
 from opennode.cli.config import get_config
 
 
+OvfSettings = namedtuple('OvfSettings', ['vm_type', 'os_type',
+                                         'memory_min', 'memory', 'memory_max',
+                                         'vcpu_min', 'vcpu', 'vcpu_max',
+                                         'networks', 'disks', 'features',
+                                         'root_password', 'admin_username'])
+
+
+def _memory_units():
+    """
+    Factors converting rasd:AllocationUnits of memory to kilobytes, keyed by
+    the unit string with whitespace removed.
+
+    @note: DSP0004 v2.5.0 outlines the Programmatic Unit forms for
+    OVF. This pertains specifically to rasd:AllocationUnits, which accepts
+    both the current and deprecated forms. New implementations should not
+    use Unit Qualifiers as this form is deprecated.
+        - PUnit form, as in "byte * 2^20"
+        - PUnit form w/ Units Qualifier(deprecated), as in "MegaBytes"
+    """
+    units = {}
+    for quantifier, factor in (('byte', 2.0 ** -10), ('bit', 2.0 ** -13)):
+        units[quantifier] = factor
+        for exponent in xrange(61):
+            units['%s*2^%d' % (quantifier, exponent)] = factor * 2 ** exponent
+        for exponent in xrange(19):
+            units['%s*10^%d' % (quantifier, exponent)] = factor * 10 ** exponent
+    for prefix, factor in (('Kilo', 1024 ** 0), ('Mega', 1024 ** 1), ('Giga', 1024 ** 2)):
+        units[prefix + 'Bytes'] = factor
+        units[prefix + 'Bits'] = factor / 8.0
+    return units
+
+_MEMORY_UNITS = _memory_units()
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _memory_gb(quantity, units):
+    """Convert a memory VirtualQuantity in the given AllocationUnits to a GB string"""
+    factor = _MEMORY_UNITS.get(_WHITESPACE.sub('', units))
+    if factor is None:
+        raise ValueError("Incompatible PUnit quantifier for memory.")
+    return str(float(quantity) * factor / 1024 ** 2)
+
+
+def _text(node):
+    return ''.join(child.data for child in node.childNodes
+                   if child.nodeType in (child.TEXT_NODE, child.CDATA_SECTION_NODE)).strip()
+
+
+def _elements(node):
+    return [child for child in node.childNodes if child.nodeType == child.ELEMENT_NODE]
+
+
+def _read_hardware_section(section, record):
+    """Collect system type, memory and vcpu bounds and network adapters"""
+    for item in _elements(section):
+        if item.nodeName == 'System':
+            for field in item.getElementsByTagName('vssd:VirtualSystemType'):
+                record.setdefault('vm_type', field.firstChild.nodeValue)
+            continue
+        if item.nodeName != 'Item':
+            continue
+        fields = dict((field.nodeName, _text(field)) for field in _elements(item))
+        resource_type = fields.get('rasd:ResourceType')
+        bound = item.getAttribute('ovf:bound') or 'normal'
+        if resource_type == '3':
+            record.setdefault('vcpu_' + bound, fields.get('rasd:VirtualQuantity', ''))
+        elif resource_type == '4' and 'memory_' + bound not in record:
+            record['memory_' + bound] = _memory_gb(fields['rasd:VirtualQuantity'],
+                                                   fields['rasd:AllocationUnits'])
+        elif resource_type == '10':
+            network = {'interfaceType': 'bridge', 'sourceName': fields.get('rasd:Connection')}
+            if fields.get('rasd:Address'):
+                network['macAddress'] = fields['rasd:Address']
+            record['networks'].append(network)
+
+
+def _read_os_section(section, record):
+    record['os_type'] = 'unknown'
+    for field in _elements(section):
+        if field.nodeName == 'Description':
+            record['os_type'] = _text(field)
+            break
+
+
+def _read_opennode_section(section, record):
+    for features in section.getElementsByTagName('Features')[:1]:
+        record['features'] = [str(feature.nodeName) for feature in _elements(features)]
+    for name, key in (('AdminPassword', 'root_password'), ('AdminUsername', 'admin_username')):
+        fields = section.getElementsByTagName(name)
+        if fields:
+            record[key] = fields[0].firstChild.nodeValue
+
+
+def _disks(files, disk_nodes):
+    fileref_dict = dict((file_dom.getAttribute('ovf:id'), file_dom.getAttribute('ovf:href'))
+                        for file_dom in files)
+    disk_list = []
+    for i, disk_dom in enumerate(disk_nodes):
+        disk = {
+            "template_name": fileref_dict[disk_dom.getAttribute("ovf:fileRef")],
+            "template_format": disk_dom.getAttribute("ovf:format"),
+            "deploy_type": "file",
+            "type": "file",
+            "template_capacity": disk_dom.getAttribute("ovf:capacity"),
+            "template_capacity_unit": disk_dom.getAttribute("ovf:capacityAllocationUnits") or "bytes",
+            "device": "disk",
+            "source_file": fileref_dict[disk_dom.getAttribute("ovf:fileRef")],
+            "target_dev": "vd%s" % chr(ord("a") + i),
+            "target_bus": "virtio"
+        }
+        disk_list.append(disk)
+    return disk_list
+
+
+def get_ovf_settings(ovf_file):
+    """
+    Reads the settings of a template from its Ovf file in a single walk over
+    the document: the first References, DiskSection, VirtualHardwareSection,
+    OperatingSystemSection and OpenNode section found are used.
+
+    Memory is in GB and vcpus as given by the Ovf file; bounds missing from
+    the file are empty strings.
+
+    @param ovf_file: Ovf template configuration file
+    @type ovf_file: OvfFile
+
+    @rtype: OvfSettings
+    """
+    record = {'os_type': 'redhat',  # default supported linux
+              'networks': [], 'features': [], 'root_password': None, 'admin_username': None}
+    files, disk_nodes = None, None
+    handlers = {'VirtualHardwareSection': _read_hardware_section,
+                'OperatingSystemSection': _read_os_section,
+                'opennodens:OpenNodeSection': _read_opennode_section}
+    pending = [ovf_file.document.documentElement]
+    while pending:
+        node = pending.pop()
+        name = node.nodeName
+        if name in handlers:
+            handlers.pop(name)(node, record)
+        elif name == 'References':
+            if files is None:
+                files = [child for child in _elements(node) if child.nodeName == 'File']
+        elif name == 'DiskSection':
+            if disk_nodes is None:
+                disk_nodes = [child for child in _elements(node) if child.nodeName == 'Disk']
+        else:
+            pending.extend(reversed(_elements(node)))
+
+    if 'vm_type' not in record:
+        raise ValueError("Ovf file does not specify a virtual system type.")
+    disks = _disks(files, disk_nodes) if files and disk_nodes else []
+    return OvfSettings(vm_type=record['vm_type'], os_type=record['os_type'],
+                       memory_min=record.get('memory_min', ''),
+                       memory=record.get('memory_normal', ''),
+                       memory_max=record.get('memory_max', ''),
+                       vcpu_min=record.get('vcpu_min', ''),
+                       vcpu=record.get('vcpu_normal', ''),
+                       vcpu_max=record.get('vcpu_max', ''),
+                       networks=record['networks'], disks=disks, features=record['features'],
+                       root_password=record['root_password'],
+                       admin_username=record['admin_username'])
+
+
 def get_vm_type(ovf_file):
     return ovf_file.document.getElementsByTagName("vssd:VirtualSystemType")[0].firstChild.nodeValue
 
 
 def get_ovf_os_type(ovf_file):
-    oss = ovf_file.document.getElementsByTagName("OperatingSystemSection")
-    if len(oss) == 0:
-        return 'redhat'  # default supported linux
-    os_section = oss[0]
-    for e in Ovf.getDict(os_section)['children']:
-        if e['name'] == u'Description':
-            return e['text']
-    return 'unknown'
+    return get_ovf_settings(ovf_file).os_type
 
 
 def get_ovf_min_vcpu(ovf_file):
-    return _get_ovf_vcpu(ovf_file, "min")
+    return get_ovf_settings(ovf_file).vcpu_min
 
 
 def get_ovf_normal_vcpu(ovf_file):
-    return _get_ovf_vcpu(ovf_file, "normal")
+    return get_ovf_settings(ovf_file).vcpu
 
 
 def get_ovf_max_vcpu(ovf_file):
-    return _get_ovf_vcpu(ovf_file, "max")
-
-
-def _get_ovf_vcpu(ovf_file, bound):
-    """
-    Retrieves the number of virtual CPUs to be allocated for the virtual
-    machine from the Ovf file.
-    """
-    vcpu = ''
-    virtual_hardware_node = ovf_file.document.getElementsByTagName("VirtualHardwareSection")[0]
-    rasd = Ovf.getDict(virtual_hardware_node)['children']
-    for resource in rasd:
-        if ('rasd:ResourceType' in resource and
-                resource['rasd:ResourceType'] == '3'):
-            _bound = resource.get('ovf:bound', 'normal')
-            if _bound == bound:
-                vcpu = resource['rasd:VirtualQuantity']
-                break
-    return vcpu
+    return get_ovf_settings(ovf_file).vcpu_max
 
 
 def get_networks(ovf_file):
     """
     Retrieves network interface information for the virtual machine from the Ovf file.
-    @return: list of dictionaries eg. {interfaceType = 'network', sourceName = 'vmbr0'}
+    @return: list of dictionaries eg. {interfaceType = 'bridge', sourceName = 'vmbr0'}
     @rtype: list
     """
-    virtual_hardware_node = ovf_file.document.getElementsByTagName("VirtualHardwareSection")[0]
-    nets = OvfLibvirt.getOvfNetworks(virtual_hardware_node)
-    return nets
+    return get_ovf_settings(ovf_file).networks
 
 
 def get_openode_features(ovf_file):
-    features = []
-    try:
-        on_dom = ovf_file.document.getElementsByTagName("opennodens:OpenNodeSection")[0]
-        feature_dom = on_dom.getElementsByTagName("Features")[0]
-        for feature in feature_dom.childNodes:
-            if (feature.nodeType == feature.ELEMENT_NODE):
-                features.append(str(feature.nodeName))
-    except:
-        pass
-    return features
+    return get_ovf_settings(ovf_file).features
 
 
 def get_disks(ovf_file):
-    envelope_dom = ovf_file.document.getElementsByTagName("Envelope")[0]
-    references_section_dom = envelope_dom.getElementsByTagName("References")[0]
-    file_dom_list = references_section_dom.getElementsByTagName("File")
-    fileref_dict = {}
-    for file_dom in file_dom_list:
-        fileref_dict[file_dom.getAttribute("ovf:id")] = file_dom.getAttribute("ovf:href")
-
-    disk_section_dom = envelope_dom.getElementsByTagName("DiskSection")[0]
-    disk_dom_list = disk_section_dom.getElementsByTagName("Disk")
-    disk_list = []
-    for i, disk_dom in enumerate(disk_dom_list):
-        disk = {
-            "template_name": fileref_dict[disk_dom.getAttribute("ovf:fileRef")],
-            "template_format": disk_dom.getAttribute("ovf:format"),
-            "deploy_type": "file",
-            "type": "file",
-            "template_capacity": disk_dom.getAttribute("ovf:capacity"),
-            "template_capacity_unit": disk_dom.getAttribute("ovf:capacityAllocationUnits") or "bytes",
-            "device": "disk",
-            "source_file": fileref_dict[disk_dom.getAttribute("ovf:fileRef")],
-            "target_dev": "vd%s" % chr(ord("a") + i),
-            "target_bus": "virtio"
-        }
-        disk_list.append(disk)
-    return disk_list
+    return get_ovf_settings(ovf_file).disks
 
 
 def get_ovf_normal_memory_gb(ovf_file):
-    return _get_ovf_memory_gb(ovf_file, "normal")
+    return get_ovf_settings(ovf_file).memory
 
 
 def get_ovf_max_memory_gb(ovf_file):
-    return _get_ovf_memory_gb(ovf_file, "max")
+    return get_ovf_settings(ovf_file).memory_max
 
 
 def get_ovf_min_memory_gb(ovf_file):
-    return _get_ovf_memory_gb(ovf_file, "min")
+    return get_ovf_settings(ovf_file).memory_min
 
 
-def _get_ovf_memory_gb(ovf_file, bound):
-    """
-    Retrieves the amount of memory (GB) to be allocated for the
-    virtual machine from the Ovf file.
-
-    @note: Implementation adopted from module ovf.Ovf
-    @note: DSP0004 v2.5.0 outlines the Programmatic Unit forms for
-    OVF. This pertains specifically to rasd:AllocationUnits, which accepts
-    both the current and deprecated forms. New implementations should not
-    use Unit Qualifiers as this form is deprecated.
-        - PUnit form, as in "byte * 2^20"
-        - PUnit form w/ Units Qualifier(deprecated), as in "MegaBytes"
-
-    @param ovf_file: Ovf template configuration file
-    @type ovf_file: OvfFile
-
-    @param bound: memory resource bound: min, max, normal
-    @type bound: String
-
-    @return: memory in GB or empty string if no information for the given bound is provided.
-    @rtype: String
-    """
-    memory = ''
-
-    virtual_hardware_node = ovf_file.document.getElementsByTagName("VirtualHardwareSection")[0]
-    rasd = Ovf.getDict(virtual_hardware_node)['children']
-    for resource in rasd:
-        if(resource.has_key('rasd:ResourceType') and
-                resource['rasd:ResourceType'] == '4'):
-            memoryQuantity = resource['rasd:VirtualQuantity']
-            memoryUnits = resource['rasd:AllocationUnits']
-            _bound = resource.get('ovf:bound', 'normal')
-            if _bound == bound:
-                if (memoryUnits.startswith('byte') or
-                        memoryUnits.startswith('bit')):
-                    # Calculate PUnit numerical factor
-                    memoryUnits = memoryUnits.replace('^', '**')
-
-                    # Determine PUnit Quantifier DMTF DSP0004, {byte, bit}
-                    # Convert to kilobytes
-                    memoryUnits = memoryUnits.split(' ', 1)
-                    quantifier = memoryUnits[0]
-                    if quantifier not in ['bit', 'byte']:
-                        raise ValueError("Incompatible PUnit quantifier for memory.")
-                    else:
-                        memoryUnits[0] = '2**-10' if quantifier is 'byte' else '2**-13'
-
-                    memoryUnits = ' '.join(memoryUnits)
-                    memoryFactor = int(eval(memoryUnits, {}, {}))
-                else:
-                    if memoryUnits.startswith('Kilo'):
-                        memoryFactor = 1024 ** 0
-                    elif memoryUnits.startswith('Mega'):
-                        memoryFactor = 1024 ** 1
-                    elif memoryUnits.startswith('Giga'):
-                        memoryFactor = 1024 ** 2
-                    else:
-                        raise ValueError("Incompatible PUnit quantifier for memory.")
+def get_root_password(ovf_file):
+    return get_ovf_settings(ovf_file).root_password
 
-                    if memoryUnits.endswith('Bytes'):
-                        memoryFactor *= 1
-                    elif memoryUnits.endswith('Bits'):
-                        memoryFactor /= 8.0
-                    else:
-                        raise ValueError("Incompatible PUnit quantifier for memory.")
 
-                memory = str(float(memoryQuantity) * memoryFactor / 1024 ** 2)
-                break
-    return memory
+def get_admin_username(ovf_file):
+    return get_ovf_settings(ovf_file).admin_username
 
 
 def save_cpu_mem_to_ovf(ovf_file, settings, ovf_file_name=None):
@@ -300,22 +343,6 @@ def _get_unpacked_base(vm_type):
                         vm_type, 'unpacked')
 
 
-def get_root_password(ovf_file):
-    section = ovf_file.document.getElementsByTagName('opennodens:OpenNodeSection')
-    admin_field = section[0].getElementsByTagName('AdminPassword')
-    if not admin_field:
-        return
-    return admin_field[0].firstChild.nodeValue
-
-
-def get_admin_username(ovf_file):
-    section = ovf_file.document.getElementsByTagName('opennodens:OpenNodeSection')
-    admin_field = section[0].getElementsByTagName('AdminUsername')
-    if not admin_field:
-        return
-    return admin_field[0].firstChild.nodeValue
-
-
 def update_template_and_name(vm_type, ovf_file, settings, new_name):
     """ update .ovf and rename template
     @param ovf_file: opened ovf.OvfFile object
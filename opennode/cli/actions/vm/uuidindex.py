@@ -0,0 +1,228 @@
+"""
+Index of VM UUIDs: OpenVZ CTIDs by the #UUID: markers of the CT configs in
+/etc/vz/conf and KVM domain names by the <uuid> of the persistent libvirt
+domain configs in /etc/libvirt/qemu.
+
+The index is persisted in uuid_index.<type>, so that a new process finds it
+ready. The configs are looked at again only after their directory changed,
+and only those with a new mtime are read, so a lookup costs a stat and no
+subprocess or libvirt call. Deploy, undeploy, clone and change_ctid refresh
+the VMs they touch right away, as a change within the mtime granularity
+would not be noticed otherwise. VMs missing from the index are looked up
+through libvirt by the callers.
+"""
+
+import cPickle as pickle
+import os
+import re
+import threading
+import time
+
+from opennode.cli.actions.utils import mkdir_p
+from opennode.cli.config import get_config
+from opennode.cli.log import get_logger
+
+
+CONF_DIR = '/etc/vz/conf'
+DOMAIN_DIR = '/etc/libvirt/qemu'
+
+_CONF_NAME = re.compile(r'^(\d+)\.conf$')
+_DOMAIN_NAME = re.compile(r'^(.+)\.xml$')
+_DOMAIN_UUID = re.compile(r'<uuid>\s*([^<\s]+)\s*</uuid>')
+
+
+def _read_uuid(fnm):
+    """Return the UUID of the #UUID: marker of a CT config"""
+    try:
+        with open(fnm) as f:
+            for line in f:
+                if line.startswith('#UUID:'):
+                    return line.split(':', 1)[1].strip()
+    except IOError:
+        pass
+
+
+def _read_domain_uuid(fnm):
+    """Return the UUID of a libvirt domain config"""
+    try:
+        with open(fnm) as f:
+            match = _DOMAIN_UUID.search(f.read())
+    except IOError:
+        return None
+    return match.group(1) if match else None
+
+
+def _mtime(fnm):
+    """Return the mtime of a file, or None if it is gone or so recent that a
+    later change could have the same mtime"""
+    try:
+        mtime = os.stat(fnm).st_mtime
+    except OSError:
+        return None
+    return mtime if mtime < time.time() - 1 else None
+
+
+class _UuidIndex(object):
+    """
+    UUIDs of the configs in conf_dir keyed by the name the file name gives
+    (CTID or domain name). Persisted in fnm unless it is None.
+    """
+
+    def __init__(self, conf_dir, name_pattern, read_uuid, fnm=None):
+        self.conf_dir = conf_dir
+        self.name_pattern = name_pattern
+        self.read_uuid = read_uuid
+        self.fnm = fnm
+        self._lock = threading.Lock()
+        self._loaded_mtime = None
+        self._dir_mtime = None
+        self._mtimes = {}  # name -> config mtime when it was read
+        self._uuids = {}  # name -> uuid
+        self._names = {}  # uuid -> name
+
+    def _set(self, name, uuid):
+        old = self._uuids.pop(name, None)
+        if old is not None and self._names.get(old) == name:
+            del self._names[old]
+        if uuid is not None:
+            self._uuids[name] = uuid
+            self._names[uuid] = name
+
+    def _load(self):
+        # pick up the index updated by other processes
+        if self.fnm is None:
+            return
+        try:
+            mtime = os.stat(self.fnm).st_mtime
+        except OSError:
+            return
+        if mtime == self._loaded_mtime:
+            return
+        try:
+            with open(self.fnm) as f:
+                dir_mtime, mtimes, uuids = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            get_logger().warning("Ignoring broken UUID index %s: %s", self.fnm, e)
+        else:
+            self._dir_mtime, self._mtimes, self._uuids = dir_mtime, mtimes, {}
+            self._names = {}
+            for name, uuid in uuids.iteritems():
+                self._set(name, uuid)
+        self._loaded_mtime = mtime
+
+    def _save(self):
+        if self.fnm is None:
+            return
+        try:
+            mkdir_p(os.path.dirname(self.fnm))
+            with open(self.fnm + '.tmp', 'w') as f:
+                pickle.dump((self._dir_mtime, self._mtimes, self._uuids), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(self.fnm + '.tmp', self.fnm)
+            self._loaded_mtime = os.stat(self.fnm).st_mtime
+        except (IOError, OSError) as e:
+            get_logger().debug("Cannot save UUID index %s: %s", self.fnm, e)
+
+    def _sync(self):
+        self._load()
+        dir_mtime = _mtime(self.conf_dir)
+        if dir_mtime is not None and dir_mtime == self._dir_mtime:
+            return
+        try:
+            files = os.listdir(self.conf_dir)
+        except OSError:
+            files = []
+        present = dict((m.group(1), os.path.join(self.conf_dir, m.group(0)))
+                       for m in map(self.name_pattern.match, files) if m)
+        changed = dir_mtime != self._dir_mtime
+        for name in set(self._mtimes) - set(present):
+            self._mtimes.pop(name)
+            self._set(name, None)
+        for name, fnm in present.iteritems():
+            mtime = _mtime(fnm)
+            if mtime is None or mtime != self._mtimes.get(name):
+                self._mtimes[name] = mtime
+                self._set(name, self.read_uuid(fnm))
+                changed = True
+        self._dir_mtime = dir_mtime
+        if changed:
+            self._save()
+
+    def refresh(self, name, fnm):
+        name = str(name)
+        with self._lock:
+            self._load()
+            if os.path.exists(fnm):
+                self._mtimes[name] = None
+                self._set(name, self.read_uuid(fnm))
+            else:
+                self._mtimes.pop(name, None)
+                self._set(name, None)
+            self._save()
+
+    def name_of(self, uuid):
+        with self._lock:
+            self._sync()
+            return self._names.get(uuid)
+
+    def uuid_of(self, name):
+        with self._lock:
+            self._sync()
+            return self._uuids.get(str(name))
+
+    def uuids(self):
+        with self._lock:
+            self._sync()
+            return set(self._names)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _index(vm_type):
+    with _indexes_lock:
+        if vm_type not in _indexes:
+            fnm = '%s.%s' % (get_config().getstring('general', 'uuid_index',
+                                                    '/var/cache/opennode/uuid-index'), vm_type)
+            if vm_type == 'openvz':
+                _indexes[vm_type] = _UuidIndex(CONF_DIR, _CONF_NAME, _read_uuid, fnm)
+            else:
+                _indexes[vm_type] = _UuidIndex(DOMAIN_DIR, _DOMAIN_NAME, _read_domain_uuid, fnm)
+        return _indexes[vm_type]
+
+
+def ctid_of(uuid):
+    """Return the CTID of the CT with the UUID, or None"""
+    return _index('openvz').name_of(uuid)
+
+
+def uuid_of(ctid):
+    """Return the UUID of the CT, or None"""
+    return _index('openvz').uuid_of(ctid)
+
+
+def uuids():
+    """Return the set of UUIDs of all CTs"""
+    return _index('openvz').uuids()
+
+
+def refresh(*ctids):
+    """Read the configs of the CTs again after they were created, removed or moved"""
+    for ctid in ctids:
+        _index('openvz').refresh(ctid, os.path.join(CONF_DIR, '%s.conf' % ctid))
+
+
+def domain_of(uuid):
+    """Return the name of the KVM domain with the UUID, or None"""
+    return _index('kvm').name_of(uuid)
+
+
+def domain_uuids():
+    """Return the set of UUIDs of all persistent KVM domains"""
+    return _index('kvm').uuids()
+
+
+def refresh_domains(*names):
+    """Read the configs of the KVM domains again after they were defined or undefined"""
+    for name in names:
+        _index('kvm').refresh(name, os.path.join(DOMAIN_DIR, '%s.xml' % name))
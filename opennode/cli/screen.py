@@ -20,7 +20,7 @@ from opennode.cli.forms import KvmTemplateEditForm
 from opennode.cli.forms import OpenvzModificationForm, OpenVZMigrationForm
 from opennode.cli.helpers import display_create_template, display_checkbox_selection
 from opennode.cli.helpers import display_selection, display_vm_type_select, display_info
-from opennode.cli.helpers import display_yesno
+from opennode.cli.helpers import display_yesno, DownloadMonitor
 
 
 VERSION = '2.0.0a'
@@ -255,9 +255,10 @@ class OpenNodeTUI(object):
                                     'Would you like to download OMS template?',
                                     [('No', 'main', 'F12'), ('Yes', 'download')])
         if result == 'download':
-            self.screen.finish()
-            actions.templates.sync_oms_template()
-            self.screen = SnackScreen()
+            monitor = DownloadMonitor(self.screen, TITLE, 1)
+            monitor.update_url(get_config().getstring('opennode-oms-template', 'template_name'))
+            actions.templates.sync_oms_template(silent=True, hook=monitor.download_hook)
+            self.screen.popWindow()
             display_info(self.screen, "Done", "Finished downloading OMS VM!")
         return self.display_oms()
 
@@ -498,8 +499,8 @@ class OpenNodeTUI(object):
 
         self.screen.finish()
         try:
-            conn = actions.vm._connection('openvz:///system')
-            vm.migrate(conn, vm_id, target_host, live=live)
+            with actions.vm._connected('openvz:///system') as conn:
+                vm.migrate(conn, vm_id, target_host, live=live)
             self.screen = SnackScreen()
         except libvirtError as e:
             errmsg = e.get_error_message()
@@ -559,8 +560,8 @@ class OpenNodeTUI(object):
                     display_info(self.screen, TITLE, "Please stop VM first - as only\nstopped VMs can be cloned!")
                     return self.display_vm_manage()
 
-                conn = actions.vm._connection('openvz:///system')
-                ctid = actions.vm.openvz.get_ctid_by_uuid(conn, vm_id)
+                with actions.vm._connected('openvz:///system') as conn:
+                    ctid = actions.vm.openvz.get_ctid_by_uuid(conn, vm_id)
                 storage_pool = actions.storage.get_default_pool()
                 vm = actions.vm.get_module(vm_type)
                 template_settings = vm.get_active_template_settings(ctid, storage_pool)
@@ -571,8 +572,8 @@ class OpenNodeTUI(object):
                 available_vms[vm_id]["cpuutilization"] = actions.vm.openvz.get_vzcpucheck()
                 available_vms[vm_id]["ioprio"] = actions.vm.openvz.get_ioprio(ctid)
                 available_vms[vm_id]["ioprio_old"] = available_vms[vm_id]["ioprio"]
-                available_vms[vm_id]["ctid"] = actions.vm.openvz._get_available_ct_id()
-                available_vms[vm_id]["ctid_old"] = actions.vm.openvz._get_available_ct_id()
+                available_vms[vm_id]["ctid"] = actions.vm.ctids.next_free()
+                available_vms[vm_id]["ctid_old"] = available_vms[vm_id]["ctid"]
 
                 form = OpenvzModificationForm(self.screen, TITLE, available_vms[vm_id])
                 user_settings = self._display_custom_form(form, available_vms[vm_id])
@@ -638,8 +639,8 @@ class OpenNodeTUI(object):
             vm_type = available_vms[vm_id]['vm_type']
 
             if vm_type == 'openvz':
-                conn = actions.vm._connection('openvz:///system')
-                ctid = actions.vm.openvz.get_ctid_by_uuid(conn, vm_id)
+                with actions.vm._connected('openvz:///system') as conn:
+                    ctid = actions.vm.openvz.get_ctid_by_uuid(conn, vm_id)
                 storage_pool = actions.storage.get_default_pool()
                 vm = actions.vm.get_module(vm_type)
                 template_settings = vm.get_active_template_settings(ctid, storage_pool)
@@ -764,6 +765,7 @@ class OpenNodeTUI(object):
 
     def run(self):
         """Main loop of the TUI"""
+        actions.samples.use_memory_store()
         self.screen = SnackScreen()
         self.screen.pushHelpLine("  <Tab>/<Alt-Tab> between elements   |  <Space> selects   |  <F12> Back / exit ")
 
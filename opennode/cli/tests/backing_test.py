@@ -0,0 +1,42 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from opennode.cli.actions.vm import backing
+
+
+class TestBackingRefs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmpdir, 'base.img')
+        with open(self.base, 'wb') as f:
+            f.write('\0' * 4096)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_overlay(self, name, base):
+        fnm = os.path.join(self.tmpdir, name)
+        with open(fnm, 'wb') as f:
+            f.write(struct.pack('>4sIQIIQ', 'QFI\xfb', 3, 72 if base else 0, len(base), 16, 2 ** 30))
+            f.write('\0' * 40 + base)
+        return fnm
+
+    def test_image_info(self):
+        overlay = self.make_overlay('vm.qcow2', self.base)
+        self.assertEqual(backing.image_info(self.base), ('raw', 4096, None))
+        self.assertEqual(backing.image_info(overlay), ('qcow2', 2 ** 30, self.base))
+
+    def test_stale_references_are_dropped(self):
+        used = self.make_overlay('used.qcow2', self.base)
+        flattened = self.make_overlay('flattened.qcow2', self.base)
+        backing.add_reference(used, self.base)
+        backing.add_reference(flattened, self.base)
+        backing.add_reference(os.path.join(self.tmpdir, 'removed.qcow2'), self.base)
+        self.make_overlay('flattened.qcow2', '')
+        self.assertEqual(backing.overlays_of(self.tmpdir, self.base), [used])
+        backing.remove_reference(used)
+        self.assertEqual(backing.overlays_of(self.tmpdir, self.base), [])
@@ -0,0 +1,18 @@
+import unittest
+
+from opennode.cli.actions.vm import ctids
+
+
+class TestCtidRanges(unittest.TestCase):
+
+    taken = [101, 102, 104, 150]
+
+    def test_after_highest(self):
+        self.assertEqual(ctids._free_in_range(self.taken, 101, 999, False), 151)
+        self.assertEqual(ctids._free_in_range(self.taken, 200, 299, False), 200)
+        self.assertEqual(ctids._free_in_range(self.taken, 101, 150, False), None)
+
+    def test_fill_gaps(self):
+        self.assertEqual(ctids._free_in_range(self.taken, 101, 999, True), 103)
+        self.assertEqual(ctids._free_in_range(self.taken, 104, 999, True), 105)
+        self.assertEqual(ctids._free_in_range([101, 102], 101, 102, True), None)
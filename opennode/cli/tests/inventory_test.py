@@ -0,0 +1,35 @@
+import unittest
+
+from opennode.cli.actions.vm import openvz
+
+
+class TestOpenVZInventory(unittest.TestCase):
+    """
+    Test conversion of batched vzlist output into the CT inventory table
+    """
+
+    def test_parse_running_ct(self):
+        line = ('101 web.example.com centos-6-x86_64 9223372036854775807 262144 131072 '
+                '10485760 2 200 yes 10 4 running')
+        ct = openvz._parse_inventory_row(line.split())
+        self.assertEqual(ct['ctid'], '101')
+        self.assertEqual(ct['hostname'], 'web.example.com')
+        self.assertEqual(ct['template'], 'centos-6-x86_64')
+        # unlimited privvmpages falls back to physpages
+        self.assertEqual(ct['memory'], 1024)
+        self.assertEqual(ct['swap'], 512)
+        self.assertEqual(ct['diskspace'], 10240.0)
+        self.assertEqual(ct['vcpu'], 2)
+        self.assertEqual(ct['vcpulimit'], 100)
+        self.assertEqual(ct['onboot'], 1)
+        self.assertEqual(ct['bootorder'], 10)
+        self.assertEqual(ct['ioprio'], 4)
+
+    def test_parse_unset_values(self):
+        line = '102 - debian 65536 - - - - - - - - stopped'
+        ct = openvz._parse_inventory_row(line.split())
+        self.assertEqual(ct['memory'], 256)
+        self.assertEqual(ct['swap'], None)
+        self.assertEqual(ct['onboot'], 0)
+        self.assertEqual(ct['bootorder'], '')
+        self.assertEqual(ct['status'], 'stopped')
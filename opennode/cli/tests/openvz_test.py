@@ -1,10 +1,12 @@
 import os
 import threading
+import unittest
 from uuid import uuid4
 
 from opennode.cli.actions import templates
 from opennode.cli.actions import storage
 from opennode.cli.actions import vm
+from opennode.cli.actions.vm import openvz
 
 from opennode.cli.tests import BaseTestCase, signal_when_called
 
@@ -140,3 +142,21 @@ class TestOpenVZ(BaseTestCase):
             self.assertFalse(os.path.exists(expected_path), expected_path)
         finally:
             sync_thread.join()
+
+
+class TestChangeSet(unittest.TestCase):
+
+    current = {'hostname': 'ct.openvz', 'memory': 1024, 'diskspace': 10240.0,
+               'vcpu': 2, 'onboot': 1, 'bootorder': '', 'ioprio': 4}
+
+    def test_noop_settings_are_skipped(self):
+        changes = openvz._ChangeSet(101, self.current)
+        changes.add('ram', '1').add('diskspace', 10).add('cpus', 2).add('onboot', 1)
+        changes.add('hostname', 'ct.openvz').add('bootorder', 3)
+        self.assertEqual(changes.options, [('bootorder', '3')])
+
+    def test_invalid_settings_fail_before_running(self):
+        changes = openvz._ChangeSet(101, self.current)
+        changes.add('ram', '2').add('hostname', 'bad host').add('ipadd', '10.0.0.300')
+        self.assertRaises(ValueError, changes.apply)
+        self.assertEqual([option for option, _ in changes.errors], ['hostname', 'ipadd'])
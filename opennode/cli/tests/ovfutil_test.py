@@ -0,0 +1,83 @@
+import unittest
+from xml.dom import minidom
+
+from opennode.cli.actions.vm import ovfutil
+
+
+OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1"
+          xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"
+          xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData"
+          xmlns:vssd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_VirtualSystemSettingData"
+          xmlns:opennodens="http://opennode.activesys.org/ovf">
+  <References>
+    <File ovf:href="debian.img" ovf:id="diskfile1"/>
+  </References>
+  <DiskSection>
+    <Disk ovf:capacity="10" ovf:capacityAllocationUnits="byte * 2^30" ovf:diskId="disk1"
+          ovf:fileRef="diskfile1" ovf:format="qcow2"/>
+  </DiskSection>
+  <VirtualSystem ovf:id="debian">
+    <OperatingSystemSection ovf:id="96">
+      <Description>debian</Description>
+    </OperatingSystemSection>
+    <VirtualHardwareSection>
+      <System>
+        <vssd:VirtualSystemType>kvm-x86_64</vssd:VirtualSystemType>
+      </System>
+      <Item ovf:bound="min">
+        <rasd:ResourceType>3</rasd:ResourceType>
+        <rasd:VirtualQuantity>1</rasd:VirtualQuantity>
+      </Item>
+      <Item>
+        <rasd:ResourceType>3</rasd:ResourceType>
+        <rasd:VirtualQuantity>2</rasd:VirtualQuantity>
+      </Item>
+      <Item ovf:bound="min">
+        <rasd:AllocationUnits>MegaBytes</rasd:AllocationUnits>
+        <rasd:ResourceType>4</rasd:ResourceType>
+        <rasd:VirtualQuantity>256</rasd:VirtualQuantity>
+      </Item>
+      <Item>
+        <rasd:AllocationUnits>byte * 2^20</rasd:AllocationUnits>
+        <rasd:ResourceType>4</rasd:ResourceType>
+        <rasd:VirtualQuantity>1024</rasd:VirtualQuantity>
+      </Item>
+      <Item>
+        <rasd:Connection>vmbr0</rasd:Connection>
+        <rasd:ResourceType>10</rasd:ResourceType>
+      </Item>
+    </VirtualHardwareSection>
+    <opennodens:OpenNodeSection>
+      <Features><ACPI/><APIC/></Features>
+      <AdminPassword>secret</AdminPassword>
+    </opennodens:OpenNodeSection>
+  </VirtualSystem>
+</Envelope>
+"""
+
+
+class _Ovf(object):
+
+    def __init__(self, xml):
+        self.document = minidom.parseString(xml)
+
+
+class TestOvfSettings(unittest.TestCase):
+
+    def test_settings_are_read_in_one_pass(self):
+        settings = ovfutil.get_ovf_settings(_Ovf(OVF))
+        self.assertEqual(settings.vm_type, 'kvm-x86_64')
+        self.assertEqual(settings.os_type, 'debian')
+        self.assertEqual((settings.memory_min, settings.memory, settings.memory_max),
+                         ('0.25', '1.0', ''))
+        self.assertEqual((settings.vcpu_min, settings.vcpu, settings.vcpu_max), ('1', '2', ''))
+        self.assertEqual([n['sourceName'] for n in settings.networks], ['vmbr0'])
+        self.assertEqual([d['source_file'] for d in settings.disks], ['debian.img'])
+        self.assertEqual(settings.features, ['ACPI', 'APIC'])
+        self.assertEqual((settings.root_password, settings.admin_username), ('secret', None))
+
+    def test_memory_units(self):
+        self.assertEqual(ovfutil._memory_gb('2', 'byte*2^30'), '2.0')
+        self.assertEqual(ovfutil._memory_gb('8192', 'KiloBits'), '0.0009765625')
+        self.assertRaises(ValueError, ovfutil._memory_gb, '1', '__import__("os")')
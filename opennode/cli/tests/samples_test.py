@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from opennode.cli.actions import samples
+
+
+class TestSampleStores(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_store(self, store):
+        self.assertEqual(store.record('cpu', [10, 20], 100.0, 5, 900), None)
+        # too recent samples are used only when there's nothing older
+        self.assertEqual(store.record('cpu', [11, 21], 101.0, 5, 900), (100.0, (10, 20)))
+        self.assertEqual(store.record('cpu', [17, 27], 107.0, 5, 900), (101.0, (11, 21)))
+        self.assertEqual(store.record('cpu', [18, 28], 108.0, 5, 900), (101.0, (11, 21)))
+        # samples older than max_age are ignored
+        self.assertEqual(store.record('cpu', [19, 29], 2000.0, 5, 900), None)
+        self.assertEqual(store.record('net', [1], 100.0, 5, 900), None)
+
+    def test_memory_store(self):
+        self.check_store(samples._MemoryStore())
+
+    def test_file_store(self):
+        filename = os.path.join(self.tmpdir, 'samples')
+        self.check_store(samples._FileStore(filename))
+        # another process sees the same history
+        self.assertEqual(samples._FileStore(filename).record('net', [2], 110.0, 5, 900),
+                         (100.0, (1.0,)))
+
+    def test_ring_wraps(self):
+        store = samples._FileStore(os.path.join(self.tmpdir, 'samples'))
+        for t in range(samples.SLOTS * 2):
+            store.record('s', [t], float(t), 0, 900)
+        self.assertEqual(store.record('s', [0], 100.0, 0, 900)[0], samples.SLOTS * 2 - 1)
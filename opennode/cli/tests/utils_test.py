@@ -0,0 +1,76 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from opennode.cli.actions.utils import copy_file, parallel_map, ParallelGzipWriter
+
+
+class TestParallelMap(unittest.TestCase):
+
+    def test_order_is_preserved(self):
+        def slow_double(x):
+            time.sleep(0.01 * (5 - x))
+            return x * 2
+
+        self.assertEqual(parallel_map(slow_double, range(5), workers=3), [0, 2, 4, 6, 8])
+
+    def test_exception_is_reraised(self):
+        self.assertRaises(ZeroDivisionError, parallel_map, lambda x: 1 / x, [1, 0, 2], 3)
+
+    def test_stuck_item_times_out(self):
+        def work(x):
+            if x == 1:
+                time.sleep(10)
+            return x
+
+        started = time.time()
+        result = parallel_map(work, range(4), workers=2, timeout=0.2,
+                              timed_out=lambda x: 'timeout')
+        self.assertEqual(result, [0, 'timeout', 2, 3])
+        self.assertTrue(time.time() - started < 5)
+
+
+class TestCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_holes_are_preserved(self):
+        src, dst = os.path.join(self.tmpdir, 'src.img'), os.path.join(self.tmpdir, 'dst.img')
+        with open(src, 'wb') as f:
+            f.write('a' * 5000)
+            f.seek(32 * 1024 * 1024)
+            f.write('b' * 3000)
+            f.truncate(64 * 1024 * 1024)
+        method, size, _ = copy_file(src, dst)
+        self.assertEqual(size, 64 * 1024 * 1024)
+        with open(src, 'rb') as a:
+            with open(dst, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+        self.assertTrue(method == 'reflink' or os.stat(dst).st_blocks * 512 < 4 * 1024 * 1024)
+
+
+class TestParallelGzipWriter(unittest.TestCase):
+
+    def test_output_is_gzip(self):
+        fnm = tempfile.mktemp(suffix='.gz')
+        data = ''.join('line %d\n' % i for i in xrange(100000))
+        gz = ParallelGzipWriter(fnm, workers=3, level=6, block_size=64 * 1024)
+        for i in xrange(0, len(data), 10000):
+            gz.write(data[i:i + 10000])
+        gz.close()
+        try:
+            self.assertEqual(gzip.open(fnm).read(), data)
+            with open(fnm, 'rb') as f:
+                compressed = f.read()
+            self.assertEqual(gz.size, len(compressed))
+            self.assertEqual(gz.sha1.hexdigest(), hashlib.sha1(compressed).hexdigest())
+        finally:
+            os.unlink(fnm)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from opennode.cli.actions.vm import uuidindex
+
+
+class TestUuidIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.conf_dir = tempfile.mkdtemp()
+        self.index_fnm = os.path.join(self.conf_dir, 'index', 'uuid-index.openvz')
+        self.index = self._index()
+        self._write('101', 'aaaa')
+        self._write('102', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.conf_dir)
+
+    def _index(self):
+        return uuidindex._UuidIndex(self.conf_dir, uuidindex._CONF_NAME, uuidindex._read_uuid,
+                                    self.index_fnm)
+
+    def _conf(self, ctid):
+        return os.path.join(self.conf_dir, '%s.conf' % ctid)
+
+    def _write(self, ctid, uuid):
+        with open(self._conf(ctid), 'w') as f:
+            f.write('HOSTNAME="ct%s"\n' % ctid)
+            if uuid:
+                f.write('\n#UUID: %s\n' % uuid)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.name_of('aaaa'), '101')
+        self.assertEqual(self.index.uuid_of(101), 'aaaa')
+        self.assertEqual(self.index.uuid_of(102), None)
+        self.assertEqual(self.index.uuids(), set(['aaaa']))
+
+    def test_refresh(self):
+        self.index.uuids()
+        os.rename(self._conf('101'), self._conf('201'))
+        self._write('102', 'bbbb')
+        for ctid in ('101', '201', '102'):
+            self.index.refresh(ctid, self._conf(ctid))
+        self.assertEqual(self.index.name_of('aaaa'), '201')
+        self.assertEqual(self.index.uuid_of('101'), None)
+        self.assertEqual(self.index.name_of('bbbb'), '102')
+
+    def test_persisted(self):
+        for fnm in (self._conf('101'), self._conf('102'), self.conf_dir):
+            os.utime(fnm, (1000, 1000))
+        self.index.uuids()
+        # a new process uses the persisted index while the directory is unchanged
+        os.unlink(self._conf('101'))
+        os.utime(self.conf_dir, (1000, 1000))
+        self.assertEqual(self._index().name_of('aaaa'), '101')
+        os.utime(self.conf_dir, (2000, 2000))
+        self.assertEqual(self._index().name_of('aaaa'), None)
+
+    def test_domain_uuid(self):
+        fnm = os.path.join(self.conf_dir, 'vm1.xml')
+        with open(fnm, 'w') as f:
+            f.write('<domain type="kvm">\n  <name>vm1</name>\n  <uuid>cccc</uuid>\n</domain>\n')
+        self.assertEqual(uuidindex._read_domain_uuid(fnm), 'cccc')